@@ -15,18 +15,26 @@ import uuid
 import smtplib
 import ssl
 import json
+import copy
 import base64
+import csv
+import io
 import logging
 import hmac
 import hashlib
+import atexit
+import queue
+import secrets
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
 from typing import Optional, Tuple, List, Dict, Any
 from functools import wraps
+from collections import OrderedDict, deque
+from contextlib import nullcontext
 
-from flask import Flask, jsonify, send_from_directory, abort, request, render_template_string
+from flask import Flask, Response, jsonify, send_from_directory, abort, request, render_template_string, g, has_request_context
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from dotenv import load_dotenv
@@ -109,6 +117,79 @@ class Config:
     SUPABASE_URL = (os.getenv("SUPABASE_URL") or "").strip()
     SUPABASE_KEY = (os.getenv("SUPABASE_KEY") or os.getenv("SUPABASE_SERVICE_ROLE_KEY") or "").strip()
 
+    # Data access: "supabase" (PostgREST over HTTPS), "postgres" (direct
+    # connection pool, postgres_backend.py; needs DATABASE_URL) or "sqlite"
+    # (local file, sqlite_backend.py; single node and tests)
+    DB_BACKEND = (os.getenv("DB_BACKEND") or "supabase").strip().lower()
+    DATABASE_URL = (os.getenv("DATABASE_URL") or "").strip()
+    PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+    PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "8"))
+    # Executions before a statement is server-side prepared ("none" behind a transaction-mode pooler)
+    PG_PREPARE_THRESHOLD = (os.getenv("PG_PREPARE_THRESHOLD") or "5").strip().lower()
+    PG_PREPARE_THRESHOLD = None if PG_PREPARE_THRESHOLD == "none" else int(PG_PREPARE_THRESHOLD)
+    SQLITE_PATH = (os.getenv("SQLITE_PATH") or "").strip()  # default: data/app.db
+    # Read replica for heavy admin/analytics reads: a Supabase replica API URL
+    # (same key) or, with DB_BACKEND=postgres, a replica DSN. Used only while
+    # its lag is at most REPLICA_MAX_LAG seconds; otherwise reads go to the primary.
+    READ_REPLICA_URL = (os.getenv("READ_REPLICA_URL") or "").strip()
+    REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "30"))
+    REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "5"))
+
+    # Talktime billing: "direct" writes every heartbeat to Supabase,
+    # "ledger" keeps live balances in Redis and writes them back in batches,
+    # "lease" debits time up front in leases and refunds what isn't used
+    BILLING_MODE = (os.getenv("BILLING_MODE") or "direct").strip().lower()
+    LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", "5"))
+    LEDGER_FLUSH_BATCH = int(os.getenv("LEDGER_FLUSH_BATCH", "200"))
+    LEASE_SECONDS = float(os.getenv("LEASE_SECONDS", "120"))
+    LEASE_MIN_SECONDS = float(os.getenv("LEASE_MIN_SECONDS", "60"))
+    LEASE_MAX_SECONDS = float(os.getenv("LEASE_MAX_SECONDS", "600"))
+    LEASE_RENEW_MARGIN = float(os.getenv("LEASE_RENEW_MARGIN", "15"))
+    LEASE_KEEPALIVE_SECONDS = float(os.getenv("LEASE_KEEPALIVE_SECONDS", "10"))
+    LEASE_LOAD_SCALE = int(os.getenv("LEASE_LOAD_SCALE", "1000"))
+    # Set when reaper.py is running: abandoned sessions are settled by it, so
+    # balance reads no longer flush pending time and workers skip the lease sweeper
+    SESSION_REAPER = os.getenv("SESSION_REAPER", "false").lower() == "true"
+    REAPER_BATCH = int(os.getenv("REAPER_BATCH", "100"))
+    REAPER_RECONCILE_INTERVAL = float(os.getenv("REAPER_RECONCILE_INTERVAL", "60"))
+    # /api/session/state poll intervals (seconds) handed to the client
+    STATE_ACTIVE_INTERVAL = float(os.getenv("STATE_ACTIVE_INTERVAL", "6"))
+    STATE_IDLE_INTERVAL = float(os.getenv("STATE_IDLE_INTERVAL", "60"))
+    # /api/events/stream (served by gunicorn_sse.py)
+    SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+    SSE_TICKET_TTL = int(os.getenv("SSE_TICKET_TTL", "60"))
+    # Presence index: "online" = active within this many seconds
+    PRESENCE_ONLINE_WINDOW = int(os.getenv("PRESENCE_ONLINE_WINDOW", "900"))
+    PRESENCE_RETENTION_DAYS = int(os.getenv("PRESENCE_RETENTION_DAYS", "35"))
+
+    # /api/admin/export: rows fetched per keyset page
+    EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "1000"))
+
+    # /api/admin/analytics: columnar users snapshot under DATA_DIR (needs numpy)
+    SNAPSHOT_SYNC_INTERVAL = int(os.getenv("SNAPSHOT_SYNC_INTERVAL", "60"))
+    SNAPSHOT_BATCH = int(os.getenv("SNAPSHOT_BATCH", "5000"))
+    SNAPSHOT_REBUILD_INTERVAL = int(os.getenv("SNAPSHOT_REBUILD_INTERVAL", "86400"))
+
+    # Time-series rollups: per-minute counters in Redis, folded into hour/day buckets
+    METRICS_COMPACT_INTERVAL = int(os.getenv("METRICS_COMPACT_INTERVAL", "30"))
+    METRICS_MINUTE_RETENTION_HOURS = int(os.getenv("METRICS_MINUTE_RETENTION_HOURS", "6"))
+
+    # /api/admin/search: seconds to cache recent query results
+    SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "30"))
+
+    # /api/admin/stats: seconds to cache the admin_user_stats() aggregate
+    ADMIN_STATS_CACHE_TTL = int(os.getenv("ADMIN_STATS_CACHE_TTL", "15"))
+
+    # User row cache (per-process LRU + shared Redis tier)
+    USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "2048"))
+    USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+    USER_CACHE_VOLATILE_TTL = float(os.getenv("USER_CACHE_VOLATILE_TTL", "5"))
+
+    # Write-behind queue for presence/audit fields
+    WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "2"))
+    WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "500"))
+    WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "500"))
+
 ROOT_DIR = Path(__file__).parent
 PUBLIC_DIR = ROOT_DIR / "public"
 DATA_DIR = ROOT_DIR / "data"
@@ -121,8 +202,27 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
 
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
+# supabase Client, or PostgresClient/SQLiteClient with the same table()/rpc() surface
 supabase: Optional[Client] = None
-if Config.SUPABASE_URL and Config.SUPABASE_KEY:
+if Config.DB_BACKEND == "postgres":
+    if not Config.DATABASE_URL:
+        raise RuntimeError("DB_BACKEND=postgres requires DATABASE_URL")
+    try:
+        from postgres_backend import PostgresClient
+    except ImportError as e:
+        raise RuntimeError(f"DB_BACKEND=postgres requires psycopg and psycopg-pool ({e})")
+    supabase = PostgresClient(
+        Config.DATABASE_URL,
+        min_size=Config.PG_POOL_MIN,
+        max_size=Config.PG_POOL_MAX,
+        prepare_threshold=Config.PG_PREPARE_THRESHOLD,
+    )
+    logger.info("✅ Postgres backend initialized (direct connection pool)")
+elif Config.DB_BACKEND == "sqlite":
+    from sqlite_backend import SQLiteClient
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    supabase = SQLiteClient(Config.SQLITE_PATH or str(DATA_DIR / "app.db"))
+elif Config.SUPABASE_URL and Config.SUPABASE_KEY:
     try:
         supabase = create_client(Config.SUPABASE_URL, Config.SUPABASE_KEY)
         logger.info("✅ Supabase client initialized successfully")
@@ -130,16 +230,189 @@ if Config.SUPABASE_URL and Config.SUPABASE_KEY:
         logger.error(f"❌ Failed to initialize Supabase client: {e}")
         raise RuntimeError("Supabase connection is required. Application cannot start without database connection.")
 
+def db_transaction():
+    """
+    Run the enclosed database calls in one transaction. Only the postgres
+    and sqlite backends have them; with PostgREST each call still commits on its own.
+    """
+    transaction = getattr(supabase, "transaction", None)
+    return transaction() if transaction else nullcontext()
+
+def after_commit(callback):
+    """Run callback once the enclosing db_transaction() commits (right away outside one)."""
+    on_commit = getattr(supabase, "on_commit", None)
+    if on_commit:
+        on_commit(callback)
+    else:
+        callback()
+
+# ===== Read Replica =====
+# read_db() is the client for heavy read-only admin/analytics queries (user
+# list, search, stats, flagged, export, analytics snapshot). It is the replica
+# while its measured lag is within REPLICA_MAX_LAG and it has replayed past
+# the last admin write, so an admin sees their own changes; otherwise the
+# primary. Writes and per-user reads always use `supabase`.
+replica_db = None
+if Config.READ_REPLICA_URL:
+    if Config.DB_BACKEND == "postgres":
+        replica_db = PostgresClient(
+            Config.READ_REPLICA_URL,
+            min_size=Config.PG_POOL_MIN,
+            max_size=Config.PG_POOL_MAX,
+            prepare_threshold=Config.PG_PREPARE_THRESHOLD,
+        )
+    elif Config.DB_BACKEND == "supabase" and supabase:
+        replica_db = create_client(Config.READ_REPLICA_URL, Config.SUPABASE_KEY)
+    else:
+        logger.warning(f"⚠️ READ_REPLICA_URL is not supported with DB_BACKEND={Config.DB_BACKEND}; ignoring it")
+    if replica_db:
+        logger.info(f"✅ Read replica configured (max lag {Config.REPLICA_MAX_LAG:g}s)")
+
+# Lag is measured from WAL positions (db_scripts/read_replica.sql): each check
+# samples the primary's position and the replica's replay position, and the
+# lag is how long ago the primary was where the replica is now. Admin writes
+# store the primary's position in Redis, so every worker keeps admin reads on
+# the primary until the replica has replayed past it.
+REPLICA_PIN_KEY = "replica:pin_lsn"
+REPLICA_PIN_TTL = 3600  # seconds; a replica this far behind is over REPLICA_MAX_LAG anyway
+
+_replica_state: Dict[str, Any] = {"lag": None, "checked_at": 0.0, "error": None, "replay_lsn": None}
+_replica_samples: deque = deque()  # (time, primary WAL position), oldest first
+_replica_check_lock = Lock()
+
+_REPLICA_PIN_LUA = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '-1')
+if tonumber(ARGV[1]) > current then
+  redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+end
+return 1
+"""
+
+def _wal_position(client) -> Optional[int]:
+    position = client.rpc("wal_position", {}).execute().data
+    if isinstance(position, list):
+        position = position[0] if position else None
+    if isinstance(position, dict):
+        position = next(iter(position.values()), None)
+    return None if position is None else int(position)
+
+def _measure_replica_lag(now: float) -> Tuple[Optional[float], Optional[int]]:
+    """(lag seconds, replica replay position). Lag is None while it can't be bounded yet."""
+    primary = _wal_position(supabase)
+    replayed = _wal_position(replica_db)
+    _replica_samples.append((now, primary))
+    # Keep one sample older than REPLICA_MAX_LAG so a stalled replica reads as lagging
+    while len(_replica_samples) > 2 and _replica_samples[1][0] <= now - Config.REPLICA_MAX_LAG:
+        _replica_samples.popleft()
+    if replayed is None or primary is None:
+        return None, replayed
+    if replayed >= primary:
+        return 0.0, replayed
+    # The newest sample the replica has replayed past: it is at most that far behind
+    caught_up = [t for t, position in _replica_samples if position <= replayed]
+    if caught_up:
+        return now - caught_up[-1], replayed
+    oldest = _replica_samples[0][0]
+    return (now - oldest if now - oldest >= Config.REPLICA_MAX_LAG else None), replayed
+
+def replica_lag() -> Optional[float]:
+    """Replica lag in seconds, re-measured at most every REPLICA_LAG_CHECK_INTERVAL (None if unknown)."""
+    if not replica_db:
+        return None
+    now = time.time()
+    if now - _replica_state["checked_at"] >= Config.REPLICA_LAG_CHECK_INTERVAL and _replica_check_lock.acquire(blocking=False):
+        # One thread measures; the others use the previous reading
+        try:
+            lag, replayed = _measure_replica_lag(now)
+            _replica_state.update(lag=lag, replay_lsn=replayed, error=None)
+        except Exception as e:
+            if _replica_state["error"] is None:
+                logger.warning(f"⚠️ Replica lag check failed, reading from primary: {e}")
+            _replica_state.update(lag=None, replay_lsn=None, error=str(e))
+        finally:
+            _replica_state["checked_at"] = now
+            _replica_check_lock.release()
+    return _replica_state["lag"]
+
+def note_primary_write():
+    """Keep read_db() on the primary, in every worker, until the replica has replayed this write."""
+    try:
+        position, ttl = _wal_position(supabase), REPLICA_PIN_TTL
+    except Exception as e:
+        # Position unknown: stay on the primary for as long as the replica may lag
+        logger.warning(f"⚠️ Could not read the primary WAL position: {e}")
+        position, ttl = 2 ** 62, Config.REPLICA_MAX_LAG
+    if position is not None:
+        _replica_pin_script(keys=[REPLICA_PIN_KEY], args=[position, int(ttl * 1000)])
+
+def _replica_pinned() -> bool:
+    """Whether an admin write is newer than the replica's last measured replay position."""
+    replayed = _replica_state["replay_lsn"]
+    try:
+        pin = redis_client.get(REPLICA_PIN_KEY)
+    except Exception as e:
+        logger.warning(f"Replica pin read failed: {e}")
+        return True
+    return pin is not None and (replayed is None or replayed < int(float(pin)))
+
+def read_db():
+    """Client for heavy admin/analytics reads: the replica when fresh enough, else the primary."""
+    lag = replica_lag()
+    if lag is None or lag > Config.REPLICA_MAX_LAG or _replica_pinned():
+        return supabase
+    return replica_db
+
+@app.after_request
+def pin_admin_reads_to_primary(response):
+    """A successful admin change keeps admin reads on the primary until the replica catches up."""
+    if (replica_db and request.method in ("POST", "PUT", "PATCH", "DELETE")
+            and request.path.startswith("/api/admin/") and request.path != "/api/admin/login"
+            and response.status_code < 400):
+        note_primary_write()
+    return response
+
+def replica_status() -> Dict[str, Any]:
+    """Replica section of the health output."""
+    if not replica_db:
+        return {"configured": False}
+    lag = replica_lag()
+    if lag is None:
+        state = "unavailable"
+    elif lag > Config.REPLICA_MAX_LAG:
+        state = "lagging"
+    else:
+        state = "ok"
+    return {
+        "configured": True,
+        "status": state,
+        "lag_seconds": None if lag is None else round(lag, 3),
+        "max_lag_seconds": Config.REPLICA_MAX_LAG,
+        "serving_reads": read_db() is replica_db,
+        "checked_at": datetime.fromtimestamp(_replica_state["checked_at"], timezone.utc).isoformat(),
+    }
+
 # ===== Redis Configuration =====
 # MANDATORY: Redis for Session Persistence
+# REDIS_URL=memory:// keeps it in this process (fakeredis): single-process
+# deployments and tests only, nothing is shared with other processes
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 try:
-    redis_client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    if REDIS_URL.startswith("memory://"):
+        try:
+            import fakeredis
+        except ImportError as e:
+            raise RuntimeError(f"REDIS_URL=memory:// requires fakeredis[lua] ({e})")
+        redis_client = fakeredis.FakeRedis()
+    else:
+        redis_client = redis.from_url(REDIS_URL)
     redis_client.ping()
     logger.info("✅ Redis Connected Successfully")
 except Exception as e:
     logger.critical(f"❌ Redis connection failed: {e}. FATAL ERROR: Cannot start without Redis.")
     raise RuntimeError("Redis connection is required for production.")
 
+_replica_pin_script = redis_client.register_script(_REPLICA_PIN_LUA)
+
 # ===== Security Headers =====
 @app.after_request
 def set_security_headers(response):
@@ -203,40 +476,643 @@ TOKEN_CACHE_TTL = timedelta(seconds=480)  # 8 minutes
 # ==========================================
 
 SESSION_TTL = 3600  # Session expires after 1 hour of inactivity
+MAX_HEARTBEAT_GAP = 30.0  # Heartbeat runs every 2s, allow up to 30s gap for network delays/tab switches
+MAX_PENDING_FLUSH = 15.0  # Most we charge for time since the last heartbeat when flushing
 
 # 3. REDIS SESSION MANAGER
 # No in-memory fallback allowed.
 
+# Every live session also owns deadline:{email}, a key that expires
+# MAX_HEARTBEAT_GAP after the last heartbeat. reaper.py listens for its
+# expiry event and settles the session straight away; sessions:live lets the
+# reaper catch up on events it missed without scanning the keyspace.
+SESSION_DEADLINE_PREFIX = "deadline:"
+LIVE_SESSIONS_KEY = "sessions:live"
+
+def _deadline_key(email: str) -> str:
+    return f"{SESSION_DEADLINE_PREFIX}{email.lower()}"
+
+def touch_session_deadline(email: str, seconds: float = MAX_HEARTBEAT_GAP, pipe=None):
+    """(Re)arm the reaper deadline for a live session."""
+    target = pipe if pipe is not None else redis_client.pipeline(transaction=False)
+    target.set(_deadline_key(email), 1, px=int(seconds * 1000))
+    target.sadd(LIVE_SESSIONS_KEY, email.lower())
+    if pipe is None:
+        target.execute()
+
+def clear_session_deadline(email: str):
+    """Disarm the reaper deadline once a session has been settled."""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.delete(_deadline_key(email))
+    pipe.srem(LIVE_SESSIONS_KEY, email.lower())
+    pipe.execute()
+
+# ==========================================
+# REDIS TALKTIME LEDGER (BILLING_MODE=ledger)
+# ==========================================
+# While a user is in a session, ledger:{email} holds the live balance and
+# last heartbeat. Every heartbeat is one Lua call; dirty balances are written
+# back to the users table in batches by a background flusher.
+# Every balance read for a write-back (flush, settle, termination) takes a
+# version from ledger:version in the same script, and the database only
+# accepts a write-back newer than the last one it stored, so a flush that
+# read its balance before a settle can never overwrite the settled balance.
+
+LEDGER_DIRTY_KEY = "ledger:dirty"
+LEDGER_VERSION_KEY = "ledger:version"
+
+# Microsecond clock, forced to increase: still ahead of stored versions if Redis is emptied
+_LEDGER_VERSION_LUA = """
+local function next_version(key)
+  local t = redis.call('TIME')
+  local v = math.max(tonumber(t[1]) * 1000000 + tonumber(t[2]), tonumber(redis.call('GET', key) or '0') + 1)
+  local s = string.format('%.0f', v)
+  redis.call('SET', key, s)
+  return s
+end
+"""
+
+_LEDGER_OPEN_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  redis.call('HSET', KEYS[1], 'balance', ARGV[1])
+end
+redis.call('HSET', KEYS[1], 'last_heartbeat', ARGV[2], 'session_id', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return redis.call('HGET', KEYS[1], 'balance')
+"""
+
+_LEDGER_HEARTBEAT_LUA = _LEDGER_VERSION_LUA + """
+local balance = redis.call('HGET', KEYS[1], 'balance')
+if not balance then
+  return {'missing', '0', '0'}
+end
+balance = tonumber(balance)
+local now = tonumber(ARGV[1])
+local last = tonumber(redis.call('HGET', KEYS[1], 'last_heartbeat') or ARGV[1])
+local delta = now - last
+if delta < 0 then delta = 0 end
+local max_gap = tonumber(ARGV[2])
+if delta > max_gap then
+  balance = math.max(0, balance - max_gap)
+  redis.call('DEL', KEYS[1])
+  redis.call('SREM', KEYS[2], ARGV[5])
+  return {'timeout', tostring(balance), tostring(max_gap), next_version(KEYS[4])}
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('SET', KEYS[3], '1', 'PX', ARGV[6])
+if delta < tonumber(ARGV[3]) then
+  return {'idle', tostring(balance), '0'}
+end
+balance = balance - delta
+if balance <= 0 then
+  redis.call('DEL', KEYS[1])
+  redis.call('SREM', KEYS[2], ARGV[5])
+  return {'exhausted', '0', tostring(delta), next_version(KEYS[4])}
+end
+redis.call('HSET', KEYS[1], 'balance', tostring(balance), 'last_heartbeat', ARGV[1])
+redis.call('SADD', KEYS[2], ARGV[5])
+return {'ok', tostring(balance), tostring(delta)}
+"""
+
+_LEDGER_SETTLE_LUA = _LEDGER_VERSION_LUA + """
+local balance = redis.call('HGET', KEYS[1], 'balance')
+if not balance then
+  return false
+end
+balance = tonumber(balance)
+local now = tonumber(ARGV[1])
+local last = tonumber(redis.call('HGET', KEYS[1], 'last_heartbeat') or ARGV[1])
+local delta = now - last
+if delta < tonumber(ARGV[3]) then
+  return {'live', tostring(balance)}
+end
+if delta < 0 then delta = 0 end
+if delta > tonumber(ARGV[2]) then delta = tonumber(ARGV[2]) end
+local charged = math.min(balance, delta)
+balance = balance - charged
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], ARGV[4])
+return {'settled', tostring(balance), tostring(charged), next_version(KEYS[3])}
+"""
+
+_LEDGER_ADJUST_LUA = """
+local balance = redis.call('HGET', KEYS[1], 'balance')
+if not balance then
+  return false
+end
+local new_balance
+if ARGV[1] == 'set' then
+  new_balance = tonumber(ARGV[2])
+else
+  new_balance = tonumber(balance) + tonumber(ARGV[2])
+end
+if new_balance < 0 then new_balance = 0 end
+redis.call('HSET', KEYS[1], 'balance', tostring(new_balance))
+redis.call('SADD', KEYS[2], ARGV[3])
+return tostring(new_balance)
+"""
+
+# SPOP dirty emails and read their balances in one step: {email, balance, version, ...}
+_LEDGER_FLUSH_LUA = _LEDGER_VERSION_LUA + """
+local emails = redis.call('SPOP', KEYS[1], ARGV[1])
+local out = {}
+for _, email in ipairs(emails) do
+  local balance = redis.call('HGET', ARGV[2] .. email, 'balance')
+  if balance then
+    out[#out + 1] = email
+    out[#out + 1] = balance
+    out[#out + 1] = next_version(KEYS[2])
+  end
+end
+return out
+"""
+
+_ledger_open_script = redis_client.register_script(_LEDGER_OPEN_LUA)
+_ledger_heartbeat_script = redis_client.register_script(_LEDGER_HEARTBEAT_LUA)
+_ledger_settle_script = redis_client.register_script(_LEDGER_SETTLE_LUA)
+_ledger_adjust_script = redis_client.register_script(_LEDGER_ADJUST_LUA)
+_ledger_flush_script = redis_client.register_script(_LEDGER_FLUSH_LUA)
+
+_ledger_flusher_pid: Optional[int] = None
+_ledger_flusher_lock = Lock()
+
+def _ledger_key(email: str) -> str:
+    return f"ledger:{email.lower()}"
+
+def _ensure_ledger_flusher():
+    """Start the write-behind flusher once per (post-fork) worker process."""
+    global _ledger_flusher_pid
+    if _ledger_flusher_pid == os.getpid():
+        return
+    with _ledger_flusher_lock:
+        if _ledger_flusher_pid == os.getpid():
+            return
+        _ledger_flusher_pid = os.getpid()
+        threading.Thread(target=_ledger_flush_loop, name="ledger-flusher", daemon=True).start()
+
+def ledger_open(email: str, session_id: str, balance: float) -> float:
+    """Open (or resume) a live ledger seeded with the database balance. Returns the live balance."""
+    _ensure_ledger_flusher()
+    live = _ledger_open_script(
+        keys=[_ledger_key(email)],
+        args=[balance, time.time(), session_id, SESSION_TTL]
+    )
+    touch_session_deadline(email)
+    return float(live)
+
+def ledger_heartbeat(email: str) -> Tuple[str, float, float]:
+    """
+    Apply one heartbeat tick atomically in Redis.
+    Returns (status, balance, deducted) where status is one of
+    'ok', 'idle', 'missing', 'timeout' or 'exhausted'.
+    """
+    _ensure_ledger_flusher()
+    result = _ledger_heartbeat_script(
+        keys=[_ledger_key(email), LEDGER_DIRTY_KEY, _deadline_key(email), LEDGER_VERSION_KEY],
+        args=[time.time(), MAX_HEARTBEAT_GAP, 1.0, SESSION_TTL, email.lower(), int(MAX_HEARTBEAT_GAP * 1000)]
+    )
+    status, balance, deducted = result[0].decode(), float(result[1]), float(result[2])
+    record_metric("talktime_seconds", deducted)
+    if status in ("timeout", "exhausted"):
+        # The script closed the ledger: write its final balance back
+        set_user_talktime(email, balance, version=int(result[3]))
+        record_metric("sessions_ended")
+    return status, balance, deducted
+
+def ledger_settle(email: str, idle_after: float = 0) -> Tuple[Optional[str], Optional[float]]:
+    """
+    Close a ledger, charging pending time (capped) and writing the balance back.
+    Ledgers that heartbeated within `idle_after` seconds are left running.
+    Returns ('live' | 'settled' | None, balance).
+    """
+    result = _ledger_settle_script(
+        keys=[_ledger_key(email), LEDGER_DIRTY_KEY, LEDGER_VERSION_KEY],
+        args=[time.time(), MAX_PENDING_FLUSH, idle_after, email.lower()]
+    )
+    if not result:
+        return None, None
+    status, balance = result[0].decode(), float(result[1])
+    if status == "settled":
+        record_metric("talktime_seconds", float(result[2]))
+        set_user_talktime(email, balance, version=int(result[3]))
+        clear_session_deadline(email)
+        record_metric("sessions_ended")
+    return status, balance
+
+def ledger_adjust(email: str, amount: float, mode: str = "add") -> Optional[float]:
+    """Credit/debit ('add') or overwrite ('set') a live ledger. Returns None when no ledger is open."""
+    if Config.BILLING_MODE != "ledger":
+        return None
+    live = _ledger_adjust_script(
+        keys=[_ledger_key(email), LEDGER_DIRTY_KEY],
+        args=[mode, amount, email.lower()]
+    )
+    return float(live) if live is not None else None
+
+def ledger_drop(email: str):
+    """Forget a ledger without writing it back (used when the user is deleted)."""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.delete(_ledger_key(email))
+    pipe.srem(LEDGER_DIRTY_KEY, email.lower())
+    pipe.execute()
+
+def flush_ledger_balances(limit: int) -> int:
+    """Write up to `limit` dirty ledger balances back to user_balances in one call."""
+    result = [v.decode() if isinstance(v, bytes) else v for v in _ledger_flush_script(
+        keys=[LEDGER_DIRTY_KEY, LEDGER_VERSION_KEY],
+        args=[limit, _ledger_key("")]
+    )]
+    # A write-back older than one already stored (e.g. a settle) is skipped by set_talktime_batch
+    rows = [
+        {"email": result[i], "talktime": float(result[i + 1]), "version": int(result[i + 2])}
+        for i in range(0, len(result), 3)
+    ]
+    if not rows:
+        return 0
+    emails = [row["email"] for row in rows]
+
+    try:
+        supabase.rpc("set_talktime_batch", {"p_balances": rows}).execute()
+        user_cache.invalidate(*[row["email"] for row in rows])
+    except Exception as e:
+        # Put them back so the next pass retries
+        redis_client.sadd(LEDGER_DIRTY_KEY, *emails)
+        logger.error(f"Ledger flush failed for {len(rows)} balances: {e}")
+        return 0
+
+    logger.debug(f"Ledger flushed {len(rows)} balances")
+    return len(rows)
+
+def _ledger_flush_loop():
+    while True:
+        time.sleep(Config.LEDGER_FLUSH_INTERVAL)
+        try:
+            while flush_ledger_balances(Config.LEDGER_FLUSH_BATCH) >= Config.LEDGER_FLUSH_BATCH:
+                pass
+        except Exception as e:
+            logger.error(f"Ledger flusher error: {e}")
+
+# ==========================================
+# TALKTIME LEASES (BILLING_MODE=lease)
+# ==========================================
+# /api/session/start debits a lease of N seconds up front. Heartbeats become
+# Redis-only keepalives (they keep the 30s disconnect protection) and the client
+# renews the lease shortly before it runs out. On /api/session/end, or once a
+# lease's deadline passes, unused time is refunded. Usage is wall-clock time
+# from the start, up to the last keepalive + MAX_HEARTBEAT_GAP.
+
+LEASE_DEADLINES_KEY = "leases:deadline"
+
+_LEASE_KEEPALIVE_LUA = """
+local started = redis.call('HGET', KEYS[1], 'started')
+if not started then
+  return {'missing', '0', '0'}
+end
+local now = tonumber(ARGV[1])
+local max_gap = tonumber(ARGV[2])
+local last_seen = tonumber(redis.call('HGET', KEYS[1], 'last_seen'))
+local expires = tonumber(redis.call('HGET', KEYS[1], 'expires'))
+local balance = redis.call('HGET', KEYS[1], 'balance')
+if now - last_seen > max_gap then
+  return {'timeout', tostring(expires), balance}
+end
+if now >= expires then
+  return {'expired', tostring(expires), balance}
+end
+local deadline = math.min(expires, now + max_gap)
+redis.call('HSET', KEYS[1], 'last_seen', ARGV[1])
+redis.call('ZADD', KEYS[2], deadline, ARGV[3])
+redis.call('SET', KEYS[3], '1', 'PX', math.floor((deadline - now + tonumber(ARGV[4])) * 1000))
+return {'ok', tostring(expires), balance}
+"""
+
+_LEASE_OPEN_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  return 0
+end
+local now = tonumber(ARGV[2])
+local expires = tonumber(ARGV[4])
+local deadline = math.min(expires, now + tonumber(ARGV[7]))
+redis.call('HSET', KEYS[1], 'session_id', ARGV[1], 'started', ARGV[2], 'granted', ARGV[3],
+           'expires', ARGV[4], 'last_seen', ARGV[2], 'balance', ARGV[5])
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+redis.call('ZADD', KEYS[2], deadline, ARGV[8])
+redis.call('SET', KEYS[3], '1', 'PX', math.floor((deadline - now + tonumber(ARGV[9])) * 1000))
+redis.call('SADD', KEYS[4], ARGV[8])
+return 1
+"""
+
+_LEASE_EXTEND_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return false
+end
+local granted = tonumber(redis.call('HINCRBYFLOAT', KEYS[1], 'granted', ARGV[1]))
+local expires = tonumber(redis.call('HGET', KEYS[1], 'started')) + granted
+local now = tonumber(ARGV[3])
+local deadline = math.min(expires, now + tonumber(ARGV[4]))
+redis.call('HSET', KEYS[1], 'expires', tostring(expires), 'balance', ARGV[2], 'last_seen', ARGV[3])
+redis.call('ZADD', KEYS[2], deadline, ARGV[5])
+redis.call('SET', KEYS[3], '1', 'PX', math.floor((deadline - now + tonumber(ARGV[6])) * 1000))
+return tostring(expires)
+"""
+
+_LEASE_TAKE_LUA = """
+local fields = redis.call('HGETALL', KEYS[1])
+if #fields == 0 then
+  return false
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+return fields
+"""
+
+_LEASE_SYNC_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  redis.call('HSET', KEYS[1], 'balance', ARGV[1])
+end
+return 1
+"""
+
+_lease_open_script = redis_client.register_script(_LEASE_OPEN_LUA)
+_lease_keepalive_script = redis_client.register_script(_LEASE_KEEPALIVE_LUA)
+_lease_extend_script = redis_client.register_script(_LEASE_EXTEND_LUA)
+_lease_take_script = redis_client.register_script(_LEASE_TAKE_LUA)
+_lease_sync_script = redis_client.register_script(_LEASE_SYNC_LUA)
+
+_lease_sweeper_pid: Optional[int] = None
+_lease_sweeper_lock = Lock()
+
+def _lease_key(email: str) -> str:
+    return f"lease:{email.lower()}"
+
+def _lease_load() -> float:
+    """Active leases relative to LEASE_LOAD_SCALE (1.0 = one scale unit of concurrent callers)."""
+    return redis_client.zcard(LEASE_DEADLINES_KEY) / max(1, Config.LEASE_LOAD_SCALE)
+
+def lease_terms(balance: Optional[float] = None) -> Tuple[float, float]:
+    """
+    (lease length, keepalive interval), the length capped at `balance` when given.
+    Busier servers hand out longer leases and ask for sparser keepalives.
+    """
+    load = _lease_load()
+    length = Config.LEASE_SECONDS * (1 + load)
+    length = max(Config.LEASE_MIN_SECONDS, min(Config.LEASE_MAX_SECONDS, length))
+    keepalive = min(MAX_HEARTBEAT_GAP / 2, Config.LEASE_KEEPALIVE_SECONDS * (1 + load))
+    if balance is not None:
+        length = min(length, max(0, balance))
+    return length, keepalive
+
+def _lease_status(expires: float, balance: float, keepalive: float) -> Dict[str, Any]:
+    """Fields every lease response carries so the client knows when to call back."""
+    now = time.time()
+    lease_left = max(0.0, expires - now)
+    renew_in = max(0.0, lease_left - Config.LEASE_RENEW_MARGIN) if balance > 0 else None
+    return {
+        "remaining_seconds": round(balance + lease_left, 3),
+        "lease_expires_in": round(lease_left, 3),
+        "renew_in": round(renew_in, 3) if renew_in is not None else None,
+        "next_heartbeat_in": round(keepalive, 3),
+    }
+
+def _ensure_lease_sweeper():
+    """Start the expired-lease sweeper once per (post-fork) worker process."""
+    global _lease_sweeper_pid
+    if _lease_sweeper_pid == os.getpid():
+        return
+    with _lease_sweeper_lock:
+        if _lease_sweeper_pid == os.getpid():
+            return
+        _lease_sweeper_pid = os.getpid()
+        threading.Thread(target=_lease_sweep_loop, name="lease-sweeper", daemon=True).start()
+
+def lease_open(email: str, session_id: str) -> Optional[Dict[str, Any]]:
+    """Settle any previous lease, debit a new one up front and record it. None if nothing to lease."""
+    if not Config.SESSION_REAPER:
+        _ensure_lease_sweeper()
+    lease_settle(email)
+
+    # The debit is capped by the stored balance, so the lease is exactly what was paid for
+    length, keepalive = lease_terms()
+    debit = debit_talktime(email, length)
+    if debit is None or debit[0] <= 0:
+        return None
+    length, new_balance = debit
+
+    now = time.time()
+    expires = now + length
+    opened = _lease_open_script(
+        keys=[_lease_key(email), LEASE_DEADLINES_KEY, _deadline_key(email), LIVE_SESSIONS_KEY],
+        args=[session_id, now, length, expires, new_balance, SESSION_TTL,
+              MAX_HEARTBEAT_GAP, email.lower(), Config.LEASE_RENEW_MARGIN]
+    )
+    if not opened:
+        # A concurrent start opened a lease first: refund ours and join theirs
+        add_talktime_to_user(email, length)
+        session_id, expires, balance = redis_client.hmget(_lease_key(email), "session_id", "expires", "balance")
+        if session_id is None:
+            return None
+        logger.info(f"Lease already open for {email}, refunded {length:.0f}s")
+        return {"session_id": session_id.decode(), **_lease_status(float(expires), float(balance or 0), keepalive)}
+
+    logger.info(f"Lease granted: {email} {length:.0f}s (session {session_id})")
+    return {"session_id": session_id, **_lease_status(expires, new_balance, keepalive)}
+
+def lease_keepalive(email: str) -> Tuple[str, float, float]:
+    """Record a keepalive. Returns (status, expires, balance outside the lease)."""
+    status, expires, balance = _lease_keepalive_script(
+        keys=[_lease_key(email), LEASE_DEADLINES_KEY, _deadline_key(email)],
+        args=[time.time(), MAX_HEARTBEAT_GAP, email.lower(), Config.LEASE_RENEW_MARGIN]
+    )
+    return status.decode(), float(expires), float(balance or 0)
+
+def lease_extend(email: str) -> Optional[Dict[str, Any]]:
+    """Debit another lease period onto the open lease. None when the lease is gone."""
+    length, keepalive = lease_terms()
+    debit = debit_talktime(email, length)
+    if debit is None:
+        return None
+    length, new_balance = debit
+
+    expires = _lease_extend_script(
+        keys=[_lease_key(email), LEASE_DEADLINES_KEY, _deadline_key(email)],
+        args=[length, new_balance, time.time(), MAX_HEARTBEAT_GAP, email.lower(), Config.LEASE_RENEW_MARGIN]
+    )
+    if expires is None:
+        # Settled underneath us: give the seconds straight back
+        if length > 0:
+            add_talktime_to_user(email, length)
+        return None
+    return _lease_status(float(expires), new_balance, keepalive)
+
+def lease_settle(email: str) -> Optional[float]:
+    """Close the open lease and refund its unused seconds. Returns the new balance if one was open."""
+    raw = _lease_take_script(keys=[_lease_key(email), LEASE_DEADLINES_KEY], args=[email.lower()])
+    if not raw:
+        return None
+    lease = {raw[i].decode(): raw[i + 1].decode() for i in range(0, len(raw), 2)}
+    clear_session_deadline(email)
+
+    started = float(lease["started"])
+    granted = float(lease["granted"])
+    end = min(time.time(), float(lease["last_seen"]) + MAX_HEARTBEAT_GAP, started + granted)
+    used = max(0.0, end - started)
+    refund = granted - used
+
+    logger.info(f"Lease settled: {email} used {used:.0f}s of {granted:.0f}s")
+    record_metric("talktime_seconds", used)
+    record_metric("sessions_ended")
+    if refund > 0:
+        return add_talktime_to_user(email, refund)
+    return float(lease.get("balance", 0))
+
+def lease_live_balance(email: str) -> Optional[float]:
+    """Balance including the unused part of a live lease; settles leases whose client went away."""
+    started, expires, last_seen, balance = redis_client.hmget(
+        _lease_key(email), "started", "expires", "last_seen", "balance"
+    )
+    if started is None:
+        return None
+    if time.time() - float(last_seen) > MAX_HEARTBEAT_GAP:
+        lease_settle(email)
+        return None
+    return float(balance or 0) + max(0.0, float(expires) - time.time())
+
+def lease_sync_balance(email: str, balance: float):
+    """Keep the balance stored on an open lease in step with the users table."""
+    _lease_sync_script(keys=[_lease_key(email)], args=[balance])
+
+def settle_expired_leases(limit: int = 100) -> int:
+    """Settle leases whose deadline (expiry or missed keepalives) has passed."""
+    cutoff = time.time() - Config.LEASE_RENEW_MARGIN
+    emails = redis_client.zrangebyscore(LEASE_DEADLINES_KEY, "-inf", cutoff, start=0, num=limit)
+    settled = 0
+    for email in emails:
+        email = email.decode() if isinstance(email, bytes) else email
+        try:
+            if lease_settle(email) is not None:
+                settled += 1
+        except Exception as e:
+            logger.error(f"Failed to settle lease for {email}: {e}")
+    return settled
+
+def _lease_sweep_loop():
+    while True:
+        time.sleep(5)
+        try:
+            settle_expired_leases()
+        except Exception as e:
+            logger.error(f"Lease sweeper error: {e}")
+
 # [STRICT MODE] Helper to Flush Pending Time
-def flush_pending_time(email):
-    """Calculates and deducts any time pending in Redis before checking DB."""
+def flush_pending_time(email) -> Optional[float]:
+    """
+    Calculates and deducts any time pending in Redis before checking DB.
+    In ledger/lease mode a session that is still heartbeating is left running
+    and its live balance is returned instead.
+    """
+    if Config.BILLING_MODE == "ledger":
+        try:
+            status, balance = ledger_settle(email, idle_after=MAX_HEARTBEAT_GAP)
+            return balance if status == "live" else None
+        except Exception as e:
+            logger.error(f"Failed to settle ledger for {email}: {e}")
+            return None
+
+    if Config.BILLING_MODE == "lease":
+        try:
+            return lease_live_balance(email)
+        except Exception as e:
+            logger.error(f"Failed to read lease for {email}: {e}")
+            return None
+
     try:
-        raw = redis_client.get(f"session:{email}")
-        if raw:
-            session_data = json.loads(raw)
-            # Flush means we are syncing/ending, so we remove the session key
-            redis_client.delete(f"session:{email}")
-            
-            last_hb_str = session_data.get("last_heartbeat", session_data.get("last_seen"))
-            last_heartbeat = datetime.fromisoformat(last_hb_str)
-            if last_heartbeat.tzinfo is None:
-                last_heartbeat = last_heartbeat.replace(tzinfo=timezone.utc)
-                
-            now = datetime.now(timezone.utc)
-            delta_seconds = (now - last_heartbeat).total_seconds()
-            
-            # Sanity check
-            if delta_seconds > 15: delta_seconds = 15
-            if delta_seconds < 0: delta_seconds = 0
-            
-            if delta_seconds > 0:
-                # Deduct immediately
-                user = get_user(email)
-                current = float(user.get("talktime", 0))
-                new_bal = max(0, current - delta_seconds)
-                update_user(email, {"talktime": new_bal})
+        delta_seconds = _take_pending_seconds(email)
+        if delta_seconds:
+            # Deduct immediately
+            deduct_talktime(email, delta_seconds)
     except Exception as e:
         logger.error(f"Failed to flush pending time for {email}: {e}")
+    return None
+
+def _take_pending_seconds(email: str) -> Optional[float]:
+    """Remove session:{email} and return the (capped) seconds since its last heartbeat. None if there was none."""
+    raw = redis_client.get(f"session:{email}")
+    if not raw:
+        return None
+    session_data = json.loads(raw)
+    # Flush means we are syncing/ending, so we remove the session key
+    redis_client.delete(f"session:{email}")
+    clear_session_deadline(email)
+
+    last_hb_str = session_data.get("last_heartbeat", session_data.get("last_seen"))
+    last_heartbeat = datetime.fromisoformat(last_hb_str)
+    if last_heartbeat.tzinfo is None:
+        last_heartbeat = last_heartbeat.replace(tzinfo=timezone.utc)
+
+    now = datetime.now(timezone.utc)
+    delta_seconds = (now - last_heartbeat).total_seconds()
+
+    # Sanity check
+    if delta_seconds > MAX_PENDING_FLUSH: delta_seconds = MAX_PENDING_FLUSH
+    if delta_seconds < 0: delta_seconds = 0
+    record_metric("talktime_seconds", delta_seconds)
+    return delta_seconds
+
+def reap_sessions(emails: List[str]) -> int:
+    """
+    Settle sessions whose reaper deadline expired (reaper.py).
+    Direct-mode charges go out in one deduct_talktime_batch call and every
+    reaped user gets session_status='ended'. Returns the number reaped.
+    """
+    charges: Dict[str, float] = {}
+    reaped = []
+    for email in dict.fromkeys(e.lower() for e in emails):
+        if redis_client.exists(_deadline_key(email)):
+            continue  # A heartbeat re-armed it since the event fired
+
+        try:
+            if Config.BILLING_MODE == "lease":
+                lease_settle(email)
+            elif Config.BILLING_MODE == "ledger":
+                ledger_settle(email)
+            else:
+                lock = redis_client.lock(f"lock:{email}", timeout=5)
+                if not lock.acquire(blocking=False):
+                    continue  # Heartbeat in flight, so the client is still there
+                try:
+                    seconds = _take_pending_seconds(email)
+                finally:
+                    try:
+                        lock.release()
+                    except Exception:
+                        pass
+                if seconds is not None:
+                    # Lease and ledger settles count their own ends
+                    record_metric("sessions_ended")
+                if seconds:
+                    charges[email] = seconds
+        except Exception as e:
+            logger.error(f"Failed to reap session for {email}: {e}")
+            continue
+
+        reaped.append(email)
+        update_user_deferred(email, {"session_status": "ended"})
+        publish_user_event(email, "terminate", {"reason": "session_expired"})
+
+    if charges:
+        try:
+            result = supabase.rpc("deduct_talktime_batch", {
+                "p_charges": [{"email": e, "seconds": s} for e, s in charges.items()]
+            }).execute()
+            for row in result.data or []:
+                _user_written(row["email"], {"talktime": float(row["talktime"])})
+        except Exception as e:
+            logger.error(f"Batch deduct failed for {len(charges)} reaped sessions: {e}")
+
+    if reaped:
+        redis_client.srem(LIVE_SESSIONS_KEY, *reaped)
+        logger.info(f"🧹 Reaped {len(reaped)} abandoned sessions")
+    return len(reaped)
 
 def check_and_refill_community_bonus(email: str) -> bool:
     """
@@ -245,11 +1121,10 @@ def check_and_refill_community_bonus(email: str) -> bool:
     Returns True if reset was applied, False otherwise.
     """
     try:
-        response = supabase.table("users").select("*").eq("email", email).execute()
-        if not response.data:
+        user = get_user(email, "balance")
+        if not user:
             return False
 
-        user = response.data[0]
         if not user.get("is_community_member"):
             return False
 
@@ -279,10 +1154,11 @@ def check_and_refill_community_bonus(email: str) -> bool:
         if should_refill:
             try:
                 # Always SET to 15 minutes — never add on top of existing balance
-                supabase.table("users").update({
+                refill = {
                     "talktime": 900,
                     "last_community_refill": now.isoformat()
-                }).eq("email", email).execute()
+                }
+                update_user(email, refill)
 
                 logger.info(f"Community Reset: Set 15 mins for {email}")
                 return True
@@ -308,18 +1184,21 @@ def is_transaction_processed(order_id: str) -> bool:
     except Exception:
         return False
 
-def record_transaction(email: str, order_id: str, amount: int):
-    """Record a processed transaction."""
-    if not supabase: return
-    try:
-        supabase.table("transactions").insert({
-            "order_id": order_id,
-            "email": email,
-            "amount": amount,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }).execute()
-    except Exception as e:
-        logger.error(f"Failed to record transaction: {e}")
+def claim_transaction(email: str, order_id: str, amount: int) -> bool:
+    """
+    Record a processed transaction unless its order is already recorded.
+    Returns False for a duplicate; database errors propagate.
+    """
+    if not supabase:
+        raise RuntimeError("Supabase connection is required")
+    # Insert-if-absent on the unique order_id: only an inserted row comes back
+    res = supabase.table("transactions").upsert({
+        "order_id": order_id,
+        "email": email,
+        "amount": amount,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }, on_conflict="order_id", ignore_duplicates=True).execute()
+    return bool(res.data)
 
 
 def validate_email(email: str) -> bool:
@@ -511,6 +1390,9 @@ def token_required(f):
             if not current_user_email:
                 raise AppError("Invalid token payload", status_code=401)
             
+            # Helpers read the caller through current_user()/get_user(), loaded once per request
+            g.current_user_email = current_user_email.lower()
+            
             # Inject current_user_email into the route function
             return f(*args, current_user_email=current_user_email, **kwargs)
             
@@ -525,15 +1407,344 @@ def token_required(f):
     
     return decorated_function
 
+# ==========================================
+# USER ROW CACHE (per-process LRU + Redis)
+# ==========================================
+# get_user() is read-through: local LRU -> usercache:{email} in Redis -> Supabase.
+# Writes invalidate both tiers and broadcast on USER_CACHE_CHANNEL so every
+# gunicorn worker drops its local copy. Fields listed in USER_CACHE_FIELD_TTL
+# expire sooner than the rest of the row and are refreshed with a narrow select.
+# Every invalidation also INCRs usercache:gen:{email}; a fetch captures that
+# value before it reads and writes its row back only if it is unchanged, so a
+# read that raced a write in another worker never repopulates the old row.
+
+USER_CACHE_CHANNEL = "usercache:invalidate"
+
+USER_CACHE_FIELD_TTL = {
+    "talktime": Config.USER_CACHE_VOLATILE_TTL,
+    "session_status": Config.USER_CACHE_VOLATILE_TTL,
+    "last_active_heartbeat": Config.USER_CACHE_VOLATILE_TTL,
+    "is_community_member": Config.USER_CACHE_VOLATILE_TTL * 6,
+    "last_community_refill": Config.USER_CACHE_VOLATILE_TTL * 6,
+}
+
+# Writes the entry only if the email's generation still matches the fetch's
+_USER_CACHE_STORE_LUA = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+  return 0
+end
+redis.call('SETEX', KEYS[1], ARGV[2], ARGV[3])
+return 1
+"""
+
+class UserCache:
+    """Two-tier read-through cache for user rows with per-field TTLs."""
+
+    def __init__(self, redis_conn, max_entries: int, ttl: float, field_ttl: Dict[str, float]):
+        self._redis = redis_conn
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._field_ttl = field_ttl
+        self._local: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._store_script = redis_conn.register_script(_USER_CACHE_STORE_LUA)
+        # Generation keys outlive any in-flight fetch, then expire with the entries
+        self._generation_ttl = max(int(ttl) * 2, 3600)
+        # Local invalidation sequence per recently invalidated email, bounded like
+        # _local; evicted emails report the highest evicted sequence instead
+        self._generation: "OrderedDict[str, int]" = OrderedDict()
+        self._generation_seq = 0
+        self._generation_floor = 0
+        self._lock = Lock()
+        self._listener_pid: Optional[int] = None
+        self.stats = {
+            "local_hits": 0,
+            "redis_hits": 0,
+            "misses": 0,
+            "partial_refreshes": 0,
+            "invalidations": 0,
+        }
+
+    @staticmethod
+    def _key(email: str) -> str:
+        return f"usercache:{email}"
+
+    @staticmethod
+    def _generation_key(email: str) -> str:
+        return f"usercache:gen:{email}"
+
+    def count(self, stat: str):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def generation(self, email: str) -> Tuple[Optional[bytes], int]:
+        """
+        Capture before reading the database: the shared generation from Redis
+        (None if Redis is unavailable) and this worker's local sequence.
+        """
+        with self._lock:
+            local = self._generation.get(email, self._generation_floor)
+        try:
+            shared = self._redis.get(self._generation_key(email)) or b"0"
+        except Exception as e:
+            logger.warning(f"User cache generation read failed: {e}")
+            shared = None
+        return shared, local
+
+    def lookup(self, email: str) -> Optional[Dict[str, Any]]:
+        """Return the cached entry ({"row", "stamps"}) from either tier, or None."""
+        self._ensure_listener()
+        with self._lock:
+            entry = self._local.get(email)
+            if entry is not None:
+                self._local.move_to_end(email)
+                self.stats["local_hits"] += 1
+                return entry
+
+        try:
+            raw = self._redis.get(self._key(email))
+        except Exception as e:
+            logger.warning(f"User cache Redis read failed: {e}")
+            raw = None
+        if raw:
+            entry = json.loads(raw)
+            self._put_local(email, entry)
+            self.count("redis_hits")
+            return entry
+
+        self.count("misses")
+        return None
+
+    def stale_fields(self, entry: Dict[str, Any], now: float) -> List[str]:
+        """Fields whose TTL has lapsed; ["*"] means the whole row is stale."""
+        stamps = entry.get("stamps", {})
+        if now - stamps.get("*", 0) > self._ttl:
+            return ["*"]
+        return [
+            field for field, ttl in self._field_ttl.items()
+            if field in entry["row"] and now - stamps.get(field, 0) > ttl
+        ]
+
+    def store(self, email: str, row: Dict[str, Any], generation: Tuple[Optional[bytes], int],
+              entry: Optional[Dict[str, Any]] = None, fields: Optional[List[str]] = None,
+              columns: Optional[Tuple[str, ...]] = None):
+        """
+        Cache a freshly fetched row holding `columns` (None = every column), or
+        merge freshly fetched `fields` into `entry`.
+        Skipped if the email was invalidated, in any worker, since `generation`
+        was captured.
+        """
+        shared, local = generation
+        if shared is None:
+            return
+        now = time.time()
+        if entry is None or fields is None:
+            entry = {
+                "row": row,
+                "stamps": {"*": now, **{f: now for f in self._field_ttl}},
+                "columns": list(columns) if columns is not None else None,
+            }
+        else:
+            held = entry.get("columns")
+            entry = {
+                "row": {**entry["row"], **row},
+                "stamps": {**entry["stamps"], **{f: now for f in fields}},
+                "columns": None if held is None else list(dict.fromkeys(held + list(fields))),
+            }
+
+        try:
+            stored = self._store_script(
+                keys=[self._key(email), self._generation_key(email)],
+                args=[shared, int(self._ttl), json.dumps(entry, default=str)],
+            )
+        except Exception as e:
+            logger.warning(f"User cache Redis write failed: {e}")
+            return
+        if stored:
+            self._put_local(email, entry, local)
+
+    def _put_local(self, email: str, entry: Dict[str, Any], generation: Optional[int] = None):
+        with self._lock:
+            # A broadcast that dropped this email since the fetch wins
+            if generation is not None and self._generation.get(email, self._generation_floor) != generation:
+                return
+            self._local[email] = entry
+            self._local.move_to_end(email)
+            while len(self._local) > self._max_entries:
+                self._local.popitem(last=False)
+
+    def _drop_local(self, email: str):
+        with self._lock:
+            self._local.pop(email, None)
+            self._generation_seq += 1
+            self._generation[email] = self._generation_seq
+            self._generation.move_to_end(email)
+            while len(self._generation) > self._max_entries:
+                # A fetch that started before an evicted invalidation still sees a changed value
+                _, seq = self._generation.popitem(last=False)
+                self._generation_floor = max(self._generation_floor, seq)
+
+    def invalidate(self, *emails: str):
+        """Drop users from both tiers and tell the other workers to do the same."""
+        emails = [e.lower() for e in emails if e]
+        if not emails:
+            return
+        for email in emails:
+            self._drop_local(email)
+        with self._lock:
+            self.stats["invalidations"] += len(emails)
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            for email in emails:
+                pipe.incr(self._generation_key(email))
+                pipe.expire(self._generation_key(email), self._generation_ttl)
+            pipe.delete(*[self._key(e) for e in emails])
+            for email in emails:
+                pipe.publish(USER_CACHE_CHANNEL, email)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"User cache invalidation broadcast failed: {e}")
+
+    def _ensure_listener(self):
+        """Start the pub/sub listener once per (post-fork) worker process."""
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            # Entries inherited across fork missed any invalidations since
+            self._local.clear()
+        threading.Thread(target=self._listen, name="usercache-listener", daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(USER_CACHE_CHANNEL)
+                for message in pubsub.listen():
+                    data = message.get("data")
+                    if isinstance(data, bytes):
+                        data = data.decode()
+                    if data:
+                        self._drop_local(data)
+            except Exception as e:
+                logger.warning(f"User cache listener reconnecting: {e}")
+                # Anything broadcast while disconnected was missed
+                with self._lock:
+                    self._local.clear()
+                time.sleep(1)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["local_entries"] = len(self._local)
+        lookups = stats["local_hits"] + stats["redis_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["local_hits"] + stats["redis_hits"]) / lookups, 4) if lookups else 0
+        return stats
+
+user_cache = UserCache(
+    redis_client,
+    max_entries=Config.USER_CACHE_SIZE,
+    ttl=Config.USER_CACHE_TTL,
+    field_ttl=USER_CACHE_FIELD_TTL,
+)
+
+# ===== User balances (narrow hot table) =====
+# talktime and the live-session fields live in user_balances (one short row per
+# user, PK email, no other indexes), so billing writes are HOT updates that
+# never rewrite the wide users row or fire its updated_at trigger.
+# Reads embed it: users?select=*,user_balances(...). See db_scripts/user_balances.sql.
+
+USER_BALANCE_FIELDS = ("talktime", "session_status", "last_active_heartbeat")
+USER_SELECT = f"*,user_balances({','.join(USER_BALANCE_FIELDS)})"
+
+def _with_balance(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten the embedded user_balances row into the user row."""
+    balance = row.pop("user_balances", None)
+    if isinstance(balance, list):
+        balance = balance[0] if balance else None
+    if balance:
+        row.update(balance)
+    return row
+
+def _split_balance_fields(data: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Split a user change into (users columns, user_balances columns)."""
+    user_fields = {k: v for k, v in data.items() if k not in USER_BALANCE_FIELDS}
+    balance_fields = {k: v for k, v in data.items() if k in USER_BALANCE_FIELDS}
+    return user_fields, balance_fields
+
+def _stamp_balance(balance_fields: Dict[str, Any]) -> Dict[str, Any]:
+    """user_balances.updated_at tracks talktime changes only (users snapshot watermark)."""
+    if "talktime" in balance_fields:
+        return {**balance_fields, "updated_at": datetime.now(timezone.utc).isoformat()}
+    return balance_fields
+
+# ===== Projection profiles =====
+# Named column sets for user reads: get_user(email, profile="balance") fetches
+# only those columns. The cache and the request context remember which columns
+# a row holds, so a wider profile later fetches just the missing ones.
+
+USER_PROFILES: Dict[str, Optional[Tuple[str, ...]]] = {
+    "exists": ("email",),
+    "auth": ("email", "name", "password_hash", "talktime"),
+    "balance": ("email", "talktime", "is_community_member", "last_community_refill"),
+    "admin_summary": (
+        "email", "name", "talktime", "is_community_member", "created_at", "updated_at",
+        "last_login", "total_sessions", "welcome_bonus_given", "welcome_bonus_date",
+        "last_community_refill", "is_flagged", "highest_risk_level", "last_risk_flag",
+        "risk_flag_count",
+    ),
+    "full": None,  # Every column
+}
+
+def _profile_columns(profile: str) -> Optional[Tuple[str, ...]]:
+    if profile not in USER_PROFILES:
+        raise ValueError(f"Unknown user profile: {profile}")
+    return USER_PROFILES[profile]
+
+def _covers(have: Optional[List[str]], need: Optional[Tuple[str, ...]]) -> bool:
+    """Whether a row holding `have` columns (None = all) serves a read of `need`."""
+    if have is None:
+        return True
+    return need is not None and set(need) <= set(have)
+
+def _select_columns(columns: Optional[Tuple[str, ...]]) -> str:
+    """PostgREST select list for `columns` on users, embedding user_balances as needed."""
+    if columns is None:
+        return USER_SELECT
+    user_fields, balance_fields = _split_balance_fields(dict.fromkeys(columns))
+    select = list(user_fields) or ["email"]
+    if balance_fields:
+        select.append(f"user_balances({','.join(balance_fields)})")
+    return ",".join(select)
+
+def _write_user_fields(email_lower: str, data: Dict[str, Any]) -> bool:
+    """
+    Partial UPDATE of an existing user, each field on the table that owns it.
+    Returns False (nothing written) when the user does not exist.
+    """
+    user_fields, balance_fields = _split_balance_fields(data)
+    with db_transaction():
+        if user_fields:
+            updated = supabase.table("users").update(user_fields).eq("email", email_lower).execute().data
+            if not updated:
+                return False
+        if balance_fields:
+            updated = supabase.table("user_balances").update(_stamp_balance(balance_fields)).eq("email", email_lower).execute().data
+            if not updated:
+                return False
+    return True
+
 def load_users() -> Dict[str, Any]:
     """Load all users from Supabase. Raises error if Supabase is not available."""
     if not supabase:
         raise RuntimeError("Supabase connection is required")
     
     try:
-        response = supabase.table("users").select("*").execute()
+        response = supabase.table("users").select(USER_SELECT).execute()
         users_dict = {}
         for user in response.data:
+            user = _with_balance(user)
             email_lower = user.get("email", "").lower()
             if email_lower:
                 users_dict[email_lower] = user
@@ -542,59 +1753,397 @@ def load_users() -> Dict[str, Any]:
         logger.exception(f"Failed to load users from Supabase: {e}")
         raise AppError("Database error: Failed to load users", status_code=500)
 
-def get_user(email: str) -> Optional[Dict[str, Any]]:
-    """Get user data by email from Supabase. Raises error if Supabase is not available."""
+# ===== Request-scoped user context =====
+def _request_users() -> Optional[Dict[str, Optional[Dict[str, Any]]]]:
+    """Rows already loaded during this request, keyed by email (None outside a request)."""
+    if not has_request_context():
+        return None
+    if "user_rows" not in g:
+        g.user_rows = {}
+    return g.user_rows
+
+def _request_user_columns() -> Dict[str, Optional[List[str]]]:
+    """Columns held by each row in _request_users() (None = the full row)."""
+    if "user_columns" not in g:
+        g.user_columns = {}
+    return g.user_columns
+
+def current_user(profile: str = "full") -> Optional[Dict[str, Any]]:
+    """The authenticated caller's row, loaded at most once per request."""
+    email = g.get("current_user_email")
+    return get_user(email, profile) if email else None
+
+def _user_written(email: str, changes: Optional[Dict[str, Any]] = None):
+    """
+    Record a write to a user row: invalidate the shared cache and refresh the
+    request context with the written fields (or drop it when they are unknown).
+    """
     email_lower = email.lower()
-    
+    user_cache.invalidate(email_lower)
+    rows = _request_users()
+    if rows is None:
+        return
+    if changes is not None and rows.get(email_lower) is not None:
+        rows[email_lower].update(copy.deepcopy(changes))
+    else:
+        rows.pop(email_lower, None)
+
+def get_user(email: str, profile: str = "full") -> Optional[Dict[str, Any]]:
+    """
+    Get user data by email, at least the columns of `profile` (see USER_PROFILES).
+    Served from the request context when this request already loaded those
+    columns, otherwise read through user_cache.
+    """
+    email_lower = email.lower()
+    columns = _profile_columns(profile)
+    rows = _request_users()
+    if rows is not None and email_lower in rows:
+        row = rows[email_lower]
+        if row is None:
+            return None
+        held = _request_user_columns().get(email_lower)
+        if _covers(held, columns):
+            return copy.deepcopy(row)
+        if columns is not None:
+            columns = tuple(dict.fromkeys(held + list(columns)))
+
+    row = _fetch_user(email_lower, columns)
+    if rows is not None:
+        _request_user_columns()[email_lower] = list(columns) if columns is not None else None
+        staged = _request_user_writes().get(email_lower)
+        if row is not None and staged:
+            row.update(copy.deepcopy(staged))
+        rows[email_lower] = copy.deepcopy(row) if row is not None else None
+    return row
+
+def _fetch_user(email_lower: str, columns: Optional[Tuple[str, ...]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Get user data by email (read-through user_cache), at least `columns`
+    (None = every column). Raises error if Supabase is not available.
+    """
     if not supabase:
         raise RuntimeError("Supabase connection is required")
     
     try:
-        response = supabase.table("users").select("*").eq("email", email_lower).execute()
+        entry = user_cache.lookup(email_lower)
+        if entry is not None and not (columns is None and entry.get("columns") is not None):
+            stale = user_cache.stale_fields(entry, time.time())
+            if stale != ["*"]:
+                # Refresh the expired short-TTL fields this read needs, plus any
+                # profile columns the cached row doesn't hold yet
+                cached = entry.get("columns")
+                missing = [] if cached is None else [c for c in columns if c not in cached]
+                stale = [f for f in stale if columns is None or f in columns] + missing
+            if not stale:
+                return copy.deepcopy(entry["row"])
+            if stale != ["*"]:
+                generation = user_cache.generation(email_lower)
+                # Narrow select of just those columns, from user_balances alone
+                # when that is where they all live
+                user_stale, balance_stale = _split_balance_fields(dict.fromkeys(stale))
+                if user_stale:
+                    columns = list(user_stale)
+                    if balance_stale:
+                        columns.append(f"user_balances({','.join(balance_stale)})")
+                    response = supabase.table("users").select(",".join(columns)).eq("email", email_lower).execute()
+                else:
+                    response = supabase.table("user_balances").select(",".join(balance_stale)).eq("email", email_lower).execute()
+                if response.data:
+                    fresh = _with_balance(response.data[0])
+                    user_cache.count("partial_refreshes")
+                    user_cache.store(email_lower, fresh, generation, entry=entry, fields=stale)
+                    return copy.deepcopy({**entry["row"], **fresh})
+                if user_stale:
+                    user_cache.invalidate(email_lower)
+                    return None
+                # No balance row (not migrated yet): fall through to a full read
+
+        generation = user_cache.generation(email_lower)
+        response = supabase.table("users").select(_select_columns(columns)).eq("email", email_lower).execute()
         if response.data:
-            return response.data[0]
+            row = _with_balance(response.data[0])
+            user_cache.store(email_lower, row, generation, columns=columns)
+            return copy.deepcopy(row)
         return None
     except Exception as e:
         logger.exception(f"Failed to get user from Supabase: {e}")
         raise AppError("Database error: Failed to get user", status_code=500)
 
-def update_user(email: str, data: Dict[str, Any]) -> bool:
-    """Update or create user data in Supabase. Raises error if Supabase is not available."""
+def create_user(email: str, data: Dict[str, Any]) -> bool:
+    """Create (or overwrite) an account with new-user defaults. Written immediately."""
     email_lower = email.lower()
     
     if not supabase:
         raise RuntimeError("Supabase connection is required")
     
     try:
-        # Check if user exists
-        existing_user = get_user(email)
-        
+        now_iso = datetime.now(timezone.utc).isoformat()
         user_data = {
             "email": email_lower,
-            "updated_at": datetime.now(timezone.utc).isoformat()
+            "talktime": 0,
+            "created_at": now_iso,
+            "updated_at": now_iso,
+            "last_login": None,
+            "total_sessions": 0,
+            "welcome_bonus_given": False,
+            "password_hash": None  # Will be set during signup
         }
-        
-        if not existing_user:
-            # New user - set defaults
-            user_data.update({
-                "talktime": 0,
-                "created_at": datetime.now(timezone.utc).isoformat(),
-                "last_login": None,
-                "sessions": [],
-                "total_sessions": 0,
-                "welcome_bonus_given": False,
-                "password_hash": None  # Will be set during signup
-            })
-        
-        # Update with provided data
         user_data.update(data)
+        user_fields, balance_fields = _split_balance_fields(user_data)
+        
+        with db_transaction():
+            supabase.table("users").upsert(user_fields, on_conflict="email").execute()
+            supabase.table("user_balances").upsert(
+                {"email": email_lower, **_stamp_balance(balance_fields)}, on_conflict="email"
+            ).execute()
+        _user_written(email_lower)
         
-        supabase.table("users").upsert(user_data, on_conflict="email").execute()
+        if "talktime" in data:
+            ledger_adjust(email_lower, data["talktime"], mode="set")
         return True
         
     except Exception as e:
-        logger.exception(f"Failed to update user in Supabase: {e}")
-        raise AppError("Database error: Failed to update user", status_code=500)
+        logger.exception(f"Failed to create user in Supabase: {e}")
+        raise AppError("Database error: Failed to create user", status_code=500)
+
+# ===== Unit of Work =====
+def _request_user_writes() -> Optional[Dict[str, Dict[str, Any]]]:
+    """Field changes staged by update_user during this request (None outside a request)."""
+    if not has_request_context():
+        return None
+    if "user_writes" not in g:
+        g.user_writes = {}
+    return g.user_writes
+
+def update_user(email: str, data: Dict[str, Any]) -> bool:
+    """
+    Update fields of an existing user. Inside a request the change is staged and
+    written with the request's other changes as one partial UPDATE when the
+    request finishes (see commit_user_writes); elsewhere it is written immediately.
+    New accounts go through create_user; a missing user raises a 404 AppError.
+    """
+    email_lower = email.lower()
+    
+    if not supabase:
+        raise RuntimeError("Supabase connection is required")
+    
+    if not data:
+        return True
+    
+    writes = _request_user_writes()
+    if writes is not None:
+        rows = _request_users()
+        if email_lower in rows and rows[email_lower] is None:
+            raise AppError("User not found", status_code=404)
+        writes.setdefault(email_lower, {}).update(copy.deepcopy(data))
+        if rows.get(email_lower) is not None:
+            rows[email_lower].update(copy.deepcopy(data))
+    else:
+        try:
+            written = _write_user_fields(email_lower, data)
+        except Exception as e:
+            logger.exception(f"Failed to update user in Supabase: {e}")
+            raise AppError("Database error: Failed to update user", status_code=500)
+        if not written:
+            raise AppError("User not found", status_code=404)
+        _user_written(email_lower, data)
+        _publish_user_changes(email_lower, data)
+    
+    # Keep a live ledger in step so the flusher doesn't overwrite this write
+    if "talktime" in data:
+        ledger_adjust(email_lower, data["talktime"], mode="set")
+    return True
+
+def commit_user_writes():
+    """
+    Write the changes staged during this request, one partial UPDATE per user.
+    Each user is committed on its own; failures are collected and raised once
+    every other user's changes are written.
+    """
+    if not has_request_context():
+        return
+    writes = g.pop("user_writes", None)
+    if not writes:
+        return
+    missing, failed = [], []
+    for email_lower, changes in writes.items():
+        try:
+            written = _write_user_fields(email_lower, changes)
+        except Exception as e:
+            logger.exception(f"Failed to update user {email_lower} in Supabase: {e}")
+            failed.append(email_lower)
+            continue
+        finally:
+            user_cache.invalidate(email_lower)
+        if not written:
+            missing.append(email_lower)
+            continue
+        _publish_user_changes(email_lower, changes)
+
+    if failed:
+        raise AppError("Database error: Failed to update user", status_code=500,
+                       details={"failed": failed, "not_found": missing})
+    if missing:
+        raise AppError("User not found", status_code=404, details={"not_found": missing})
+
+@app.after_request
+def flush_user_writes(response):
+    """Commit the request's staged user writes before the response goes out."""
+    try:
+        commit_user_writes()
+    except AppError as e:
+        response = jsonify({
+            "error": e.__class__.__name__,
+            "message": e.message,
+            "details": e.details
+        })
+        response.status_code = e.status_code
+    return response
+
+# ===== Write-behind queue =====
+# Presence/audit fields (last_login, last_active_heartbeat, session_status) don't
+# need to block the response. They are coalesced per user and field and written
+# in bulk on a timer or once WRITE_BEHIND_MAX_PENDING users are queued, through
+# apply_deferred_user_writes() (db_scripts/write_behind.sql): UPDATE only, so a
+# user deleted meanwhile is skipped instead of recreated or failing the batch.
+
+DEFERRED_USER_FIELDS = ("last_login", "session_status", "last_active_heartbeat")
+
+class WriteBehindQueue:
+    """Coalescing background writer for non-critical user fields."""
+
+    def __init__(self, interval: float, max_pending: int, batch_size: int):
+        self._interval = interval
+        self._max_pending = max_pending
+        self._batch_size = batch_size
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._lock = Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._worker_pid: Optional[int] = None
+        self.stats = {
+            "enqueued": 0,
+            "coalesced": 0,
+            "flushes": 0,
+            "rows_written": 0,
+            "failures": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    def enqueue(self, email: str, fields: Dict[str, Any]):
+        unknown = fields.keys() - set(DEFERRED_USER_FIELDS)
+        if unknown:
+            raise ValueError(f"Fields cannot be written behind: {', '.join(sorted(unknown))}")
+        email_lower = email.lower()
+        self._ensure_worker()
+        with self._lock:
+            entry = self._pending.setdefault(email_lower, {})
+            self.stats["coalesced"] += len(entry.keys() & fields.keys())
+            self.stats["enqueued"] += len(fields)
+            entry.update(fields)
+            depth = len(self._pending)
+        if depth >= self._max_pending:
+            self._wake.set()
+
+    def discard(self, email: str):
+        with self._lock:
+            self._pending.pop(email.lower(), None)
+
+    def depth(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """Write everything queued so far. Returns the number of rows written."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        started = time.perf_counter()
+        rows = [{"email": email_lower, **fields} for email_lower, fields in pending.items()]
+        written = 0
+        for i in range(0, len(rows), self._batch_size):
+            batch = rows[i:i + self._batch_size]
+            try:
+                written += int(supabase.rpc("apply_deferred_user_writes", {"p_rows": batch}).execute().data or 0)
+                user_cache.invalidate(*[row["email"] for row in batch])
+            except Exception as e:
+                logger.error(f"Write-behind flush failed for {len(batch)} users: {e}")
+                self._requeue(batch)
+                with self._lock:
+                    self.stats["failures"] += 1
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.stats["flushes"] += 1
+            self.stats["rows_written"] += written
+            self.stats["last_flush_ms"] = round(elapsed_ms, 2)
+            self.stats["max_flush_ms"] = round(max(self.stats["max_flush_ms"], elapsed_ms), 2)
+            self.stats["total_flush_ms"] += elapsed_ms
+        return written
+
+    def _requeue(self, rows: List[Dict[str, Any]]):
+        with self._lock:
+            for row in rows:
+                fields = {k: v for k, v in row.items() if k != "email"}
+                # Anything queued since the failed flush is newer and wins
+                self._pending[row["email"]] = {**fields, **self._pending.get(row["email"], {})}
+
+    def drain(self):
+        """Stop the background writer and flush what is left (gunicorn worker_exit / atexit)."""
+        self._stopped = True
+        self._wake.set()
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Write-behind drain failed: {e}")
+
+    def _ensure_worker(self):
+        """Start the flush thread once per (post-fork) worker process."""
+        if self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+        threading.Thread(target=self._run, name="write-behind", daemon=True).start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self._interval)
+            self._wake.clear()
+            if self._stopped:
+                break
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind worker error: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["queue_depth"] = len(self._pending)
+            stats["queued_fields"] = sum(len(f) for f in self._pending.values())
+        total_flush_ms = stats.pop("total_flush_ms")
+        stats["avg_flush_ms"] = round(total_flush_ms / stats["flushes"], 2) if stats["flushes"] else 0
+        return stats
+
+deferred_user_writes = WriteBehindQueue(
+    interval=Config.WRITE_BEHIND_INTERVAL,
+    max_pending=Config.WRITE_BEHIND_MAX_PENDING,
+    batch_size=Config.WRITE_BEHIND_BATCH,
+)
+atexit.register(deferred_user_writes.drain)
+
+def update_user_deferred(email: str, data: Dict[str, Any]):
+    """Queue a non-critical field update for the write-behind flusher."""
+    deferred_user_writes.enqueue(email, data)
+    rows = _request_users()
+    if rows is not None and rows.get(email.lower()) is not None:
+        rows[email.lower()].update(copy.deepcopy(data))
 
 def delete_user(email: str) -> bool:
     """Delete user by email from Supabase. Raises error if Supabase is not available."""
@@ -605,51 +2154,521 @@ def delete_user(email: str) -> bool:
     
     try:
         supabase.table("users").delete().eq("email", email_lower).execute()
+        writes = _request_user_writes()
+        if writes:
+            writes.pop(email_lower, None)
+        deferred_user_writes.discard(email_lower)
+        _user_written(email_lower)
+        ledger_drop(email_lower)
+        clear_presence(email_lower)
+        publish_user_event(email_lower, "terminate", {"reason": "account_deleted"})
         return True
     except Exception as e:
         logger.exception(f"Failed to delete user from Supabase: {e}")
         raise AppError("Database error: Failed to delete user", status_code=500)
 
-def add_talktime_to_user(email: str, amount: int) -> bool:
-    """Add talktime to user."""
-    user = get_user(email)
-    if not user:
-        user = {"email": email, "talktime": 0}
-    current_talktime = user.get("talktime", 0)
-    return update_user(email, {"talktime": max(0, current_talktime + amount)})
+# ===== Presence index (Redis) =====
+# presence:last_seen is a sorted set of email -> last activity (epoch seconds),
+# bumped by login, ping, state polls and heartbeats. presence:dau:{date} is a
+# HyperLogLog per UTC day. Online/active counts come from ZCOUNT/PFCOUNT
+# instead of parsing last_login across the whole users table.
 
-def set_user_talktime(email: str, amount: int) -> bool:
-    """Set user talktime to specific amount."""
-    return update_user(email, {"talktime": max(0, amount)})
+PRESENCE_KEY = "presence:last_seen"
+PRESENCE_DAU_PREFIX = "presence:dau:"
 
-def record_user_session(email: str, session_data: Dict[str, Any]) -> bool:
-    """Record a user session."""
-    user = get_user(email)
-    if not user:
-        update_user(email, {})
-        user = get_user(email)
-    
-    session_entry = {
-        "session_id": session_data.get("session_id", str(uuid.uuid4())[:8]),
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "duration": session_data.get("duration", 0),
-        "transcript_length": session_data.get("transcript_length", 0)
+def _daily_actives_key(day) -> str:
+    return f"{PRESENCE_DAU_PREFIX}{day.isoformat()}"
+
+def mark_active(email: str):
+    """Record activity for `email` (one pipelined round trip)."""
+    now = datetime.now(timezone.utc)
+    dau_key = _daily_actives_key(now.date())
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zadd(PRESENCE_KEY, {email.lower(): now.timestamp()})
+        pipe.pfadd(dau_key, email.lower())
+        pipe.expire(dau_key, Config.PRESENCE_RETENTION_DAYS * 86400)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed to record presence for {email}: {e}")
+
+def clear_presence(email: str):
+    """Drop `email` from the presence index (deleted users). DAU HyperLogLogs can't forget a member."""
+    try:
+        redis_client.zrem(PRESENCE_KEY, email.lower())
+    except Exception as e:
+        logger.warning(f"Failed to clear presence for {email}: {e}")
+
+def online_count() -> int:
+    """Users active within PRESENCE_ONLINE_WINDOW seconds."""
+    return redis_client.zcount(PRESENCE_KEY, time.time() - Config.PRESENCE_ONLINE_WINDOW, "+inf")
+
+def daily_active_counts(days: int = 7) -> Dict[str, int]:
+    """Approximate distinct active users per UTC day (HyperLogLog, ~0.8% error), keyed by date."""
+    today = datetime.now(timezone.utc).date()
+    dates = [today - timedelta(days=i) for i in range(days)]
+    pipe = redis_client.pipeline(transaction=False)
+    for day in dates:
+        pipe.pfcount(_daily_actives_key(day))
+    return {day.isoformat(): count for day, count in zip(dates, pipe.execute())}
+
+def last_seen_times(emails: List[str]) -> Dict[str, Optional[float]]:
+    """Last activity per email (None if not seen within the retention window)."""
+    if not emails:
+        return {}
+    scores = redis_client.zmscore(PRESENCE_KEY, [e.lower() for e in emails])
+    return {email.lower(): score for email, score in zip(emails, scores)}
+
+def trim_presence() -> int:
+    """Drop members older than PRESENCE_RETENTION_DAYS so the index tracks recent users only."""
+    cutoff = time.time() - Config.PRESENCE_RETENTION_DAYS * 86400
+    return redis_client.zremrangebyscore(PRESENCE_KEY, "-inf", cutoff)
+
+# ===== Time-series rollups =====
+# Events are counted per minute in Redis (metrics:m:{minute start}, one hash
+# field per metric). A compactor folds every closed minute into hourly and
+# daily hashes with one Lua call, then upserts those buckets into
+# metric_rollups (db_scripts/metric_rollups.sql). Range queries read Redis
+# for minutes and Postgres for hours/days; the users table is never scanned.
+
+METRICS = (
+    "talktime_seconds", "sessions_started", "sessions_ended", "care_plans",
+    "risk_flags_high", "risk_flags_medium", "risk_flags_low",
+)
+METRIC_GRANULARITY_SECONDS = {"minute": 60, "hour": 3600, "day": 86400}
+METRIC_PREFIX = {"minute": "metrics:m:", "hour": "metrics:h:", "day": "metrics:d:"}
+METRICS_FOLDED_PREFIX = "metrics:f:"  # per minute: the counts already folded into its hour/day
+METRICS_PENDING_KEY = "metrics:pending"  # zset of minute starts not yet folded
+METRICS_UNSAVED_KEY = "metrics:unsaved"    # set of "hour:{start}" / "day:{start}" not yet in Postgres
+METRICS_MAX_POINTS = 1000
+METRICS_ROLLUP_REDIS_TTL = 3 * 86400  # hourly/daily hashes stay in Redis this long
+
+_METRICS_FOLD_LUA = """
+if redis.call('ZREM', KEYS[4], ARGV[1]) == 0 then
+  return 0
+end
+local counts = redis.call('HGETALL', KEYS[1])
+for i = 1, #counts, 2 do
+  local delta = tonumber(counts[i + 1]) - tonumber(redis.call('HGET', KEYS[6], counts[i]) or '0')
+  if delta ~= 0 then
+    redis.call('HINCRBYFLOAT', KEYS[2], counts[i], delta)
+    redis.call('HINCRBYFLOAT', KEYS[3], counts[i], delta)
+    redis.call('HSET', KEYS[6], counts[i], counts[i + 1])
+  end
+end
+redis.call('EXPIRE', KEYS[6], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[3], ARGV[2])
+redis.call('SADD', KEYS[5], ARGV[3], ARGV[4])
+return 1
+"""
+
+_metrics_fold_script = redis_client.register_script(_METRICS_FOLD_LUA)
+_metrics_compactor_pid: Optional[int] = None
+_metrics_compactor_lock = Lock()
+
+def _bucket_start(ts: float, granularity: str) -> int:
+    step = METRIC_GRANULARITY_SECONDS[granularity]
+    return int(ts // step) * step
+
+def _ensure_metrics_compactor():
+    """Start the rollup compactor once per (post-fork) process."""
+    global _metrics_compactor_pid
+    if _metrics_compactor_pid == os.getpid():
+        return
+    with _metrics_compactor_lock:
+        if _metrics_compactor_pid == os.getpid():
+            return
+        _metrics_compactor_pid = os.getpid()
+        threading.Thread(target=_metrics_compact_loop, name="metrics-compactor", daemon=True).start()
+
+def record_metric(name: str, amount: float = 1):
+    """Add `amount` to this minute's counter for `name` (fire-and-forget)."""
+    if not amount:
+        return
+    _ensure_metrics_compactor()
+    minute = _bucket_start(time.time(), "minute")
+    key = f"{METRIC_PREFIX['minute']}{minute}"
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hincrbyfloat(key, name, amount)
+        pipe.expire(key, Config.METRICS_MINUTE_RETENTION_HOURS * 3600)
+        pipe.zadd(METRICS_PENDING_KEY, {minute: minute}, nx=True)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed to record metric {name}: {e}")
+
+def _read_buckets(granularity: str, starts: List[int]) -> List[Dict[str, float]]:
+    pipe = redis_client.pipeline(transaction=False)
+    for start in starts:
+        pipe.hgetall(f"{METRIC_PREFIX[granularity]}{start}")
+    return [
+        {(k.decode() if isinstance(k, bytes) else k): float(v) for k, v in raw.items()}
+        for raw in pipe.execute()
+    ]
+
+def compact_metrics() -> int:
+    """Fold closed minutes into hour/day buckets and persist those buckets. Returns minutes folded."""
+    lock = redis_client.lock("lock:metrics_compact", timeout=120, blocking_timeout=0)
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        current = _bucket_start(time.time(), "minute")
+        minutes = [int(float(m)) for m in redis_client.zrangebyscore(METRICS_PENDING_KEY, "-inf", f"({current}")]
+        for minute in minutes:
+            hour, day = _bucket_start(minute, "hour"), _bucket_start(minute, "day")
+            _metrics_fold_script(
+                keys=[f"{METRIC_PREFIX['minute']}{minute}", f"{METRIC_PREFIX['hour']}{hour}",
+                      f"{METRIC_PREFIX['day']}{day}", METRICS_PENDING_KEY, METRICS_UNSAVED_KEY,
+                      f"{METRICS_FOLDED_PREFIX}{minute}"],
+                args=[minute, METRICS_ROLLUP_REDIS_TTL, f"hour:{hour}", f"day:{day}",
+                      Config.METRICS_MINUTE_RETENTION_HOURS * 3600]
+            )
+
+        unsaved = [m.decode() if isinstance(m, bytes) else m for m in redis_client.smembers(METRICS_UNSAVED_KEY)]
+        if supabase and unsaved:
+            buckets = [(member.split(":")[0], int(member.split(":")[1])) for member in unsaved]
+            pipe = redis_client.pipeline(transaction=False)
+            for granularity, start in buckets:
+                pipe.hgetall(f"{METRIC_PREFIX[granularity]}{start}")
+            rows = []
+            for (granularity, start), raw in zip(buckets, pipe.execute()):
+                bucket = datetime.fromtimestamp(start, timezone.utc).isoformat()
+                rows.extend({"granularity": granularity, "metric": metric.decode() if isinstance(metric, bytes) else metric,
+                             "bucket": bucket, "value": float(value)} for metric, value in raw.items())
+            if rows:
+                # Absolute values, so re-running after a failure is harmless
+                supabase.rpc("upsert_metric_rollups", {"p_rows": rows}).execute()
+            redis_client.srem(METRICS_UNSAVED_KEY, *unsaved)
+        return len(minutes)
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            pass
+
+def _metrics_compact_loop():
+    while True:
+        time.sleep(Config.METRICS_COMPACT_INTERVAL)
+        try:
+            compact_metrics()
+        except Exception as e:
+            logger.error(f"Metrics compactor error: {e}")
+        try:
+            trim_presence()
+        except Exception as e:
+            logger.warning(f"Presence trim failed: {e}")
+
+def metric_series(metrics: List[str], granularity: str, start: float, end: float) -> Dict[str, Any]:
+    """Zero-filled series per metric for buckets in [start, end]."""
+    step = METRIC_GRANULARITY_SECONDS[granularity]
+    starts = list(range(_bucket_start(start, granularity), _bucket_start(end, granularity) + 1, step))
+    series = {metric: [0.0] * len(starts) for metric in metrics}
+    index = {bucket: i for i, bucket in enumerate(starts)}
+
+    if granularity != "minute" and supabase:
+        rows = (
+            supabase.table("metric_rollups")
+            .select("metric,bucket,value")
+            .eq("granularity", granularity)
+            .in_("metric", metrics)
+            .gte("bucket", datetime.fromtimestamp(starts[0], timezone.utc).isoformat())
+            .lte("bucket", datetime.fromtimestamp(starts[-1], timezone.utc).isoformat())
+            .execute().data or []
+        )
+        for row in rows:
+            i = index.get(int(datetime.fromisoformat(row["bucket"].replace("Z", "+00:00")).timestamp()))
+            if i is not None:
+                series[row["metric"]][i] = float(row["value"])
+
+    # Redis holds the freshest values (minutes, and hours/days not yet persisted)
+    retention = Config.METRICS_MINUTE_RETENTION_HOURS * 3600 if granularity == "minute" else METRICS_ROLLUP_REDIS_TTL
+    recent = [bucket for bucket in starts if bucket + step > time.time() - retention]
+    for bucket, counts in zip(recent, _read_buckets(granularity, recent)):
+        for metric in metrics:
+            if metric in counts:
+                series[metric][index[bucket]] = counts[metric]
+
+    return {
+        "granularity": granularity,
+        "buckets": [datetime.fromtimestamp(bucket, timezone.utc).isoformat() for bucket in starts],
+        "series": series,
     }
+
+# ===== Live user events (SSE) =====
+# Anything the browser would otherwise learn on its next poll (balance changes,
+# forced termination, community status, blueprint ready) is published on
+# events:{email}. Each process serving /api/events/stream holds ONE pattern
+# subscription and fans messages out to its open streams.
+
+USER_EVENTS_PREFIX = "events:"
+SSE_TICKET_PREFIX = "sseticket:"
+
+def publish_user_event(email: str, event: str, data: Optional[Dict[str, Any]] = None):
+    """Push an event to the user's open streams (fire-and-forget)."""
+    try:
+        redis_client.publish(
+            f"{USER_EVENTS_PREFIX}{email.lower()}",
+            json.dumps({"event": event, "data": data or {}}, default=str)
+        )
+    except Exception as e:
+        logger.warning(f"Failed to publish {event} event for {email}: {e}")
+
+def _publish_user_changes(email: str, changes: Dict[str, Any]):
+    """Publish the events implied by a committed users-table write."""
+    if "talktime" in changes:
+        publish_user_event(email, "talktime", {"talktime": changes["talktime"]})
+    if "is_community_member" in changes:
+        publish_user_event(email, "community", {"is_community_member": bool(changes["is_community_member"])})
+        if not changes["is_community_member"]:
+            publish_user_event(email, "terminate", {"reason": "community_removed"})
+
+class UserEventHub:
+    """Fans Redis pub/sub user events out to this process's open SSE streams."""
+
+    def __init__(self, max_queued: int = 100):
+        self._max_queued = max_queued
+        self._streams: Dict[str, set] = {}
+        self._lock = Lock()
+        self._listener_pid: Optional[int] = None
+
+    def subscribe(self, email: str) -> "queue.Queue":
+        self._ensure_listener()
+        stream = queue.Queue(maxsize=self._max_queued)
+        with self._lock:
+            self._streams.setdefault(email.lower(), set()).add(stream)
+        return stream
+
+    def unsubscribe(self, email: str, stream: "queue.Queue"):
+        with self._lock:
+            streams = self._streams.get(email.lower())
+            if streams:
+                streams.discard(stream)
+                if not streams:
+                    del self._streams[email.lower()]
+
+    def connections(self) -> int:
+        with self._lock:
+            return sum(len(s) for s in self._streams.values())
+
+    def _ensure_listener(self):
+        """Start the pub/sub listener once per (post-fork) worker process."""
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+        threading.Thread(target=self._listen, name="user-events", daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{USER_EVENTS_PREFIX}*")
+                for message in pubsub.listen():
+                    channel = message["channel"]
+                    channel = channel.decode() if isinstance(channel, bytes) else channel
+                    with self._lock:
+                        streams = list(self._streams.get(channel[len(USER_EVENTS_PREFIX):], ()))
+                    for stream in streams:
+                        try:
+                            stream.put_nowait(message["data"])
+                        except queue.Full:
+                            pass  # Slow client: drop rather than grow without bound
+            except Exception as e:
+                logger.error(f"User event listener error: {e}")
+                time.sleep(1)
+
+user_events = UserEventHub()
+
+# ===== Atomic talktime mutations (db_scripts/talktime_functions.sql) =====
+def _talktime_rpc(function: str, email: str, seconds: float, version: Optional[int] = None) -> Optional[float]:
+    """Run one atomic talktime function. Returns the new balance, or None if the user doesn't exist."""
+    email_lower = email.lower()
     
-    sessions = user.get("sessions", [])
-    if not isinstance(sessions, list):
-        sessions = []
-    sessions.append(session_entry)
-    
-    # Keep only last 100 sessions
-    if len(sessions) > 100:
-        sessions = sessions[-100:]
+    if not supabase:
+        raise RuntimeError("Supabase connection is required")
     
-    return update_user(email, {
-        "sessions": sessions,
-        "total_sessions": len(sessions),
+    params = {"p_email": email_lower, "p_seconds": seconds}
+    if version is not None:
+        params["p_version"] = version
+    try:
+        response = supabase.rpc(function, params).execute()
+    except Exception as e:
+        logger.exception(f"Talktime RPC {function} failed for {email_lower}: {e}")
+        raise AppError("Database error: Failed to update talktime", status_code=500)
+    
+    balance = response.data
+    if isinstance(balance, list):
+        balance = balance[0] if balance else None
+    if isinstance(balance, dict):
+        balance = next(iter(balance.values()), None)
+    if balance is None:
+        return None
+    balance = float(balance)
+    _talktime_written(email_lower, balance)
+    return balance
+
+def _talktime_written(email_lower: str, balance: float):
+    """Propagate a balance a talktime function has just stored."""
+    # The row already holds the new balance: a staged talktime must not overwrite it
+    writes = _request_user_writes()
+    if writes and email_lower in writes:
+        writes[email_lower].pop("talktime", None)
+
+    def _publish():
+        _user_written(email_lower, {"talktime": balance})
+        publish_user_event(email_lower, "talktime", {"talktime": balance})
+        if Config.BILLING_MODE == "lease":
+            lease_sync_balance(email_lower, balance)
+
+    # Inside db_transaction() the balance is only real once it commits
+    after_commit(_publish)
+
+def deduct_talktime(email: str, seconds: float) -> Optional[float]:
+    """Atomically deduct talktime (clamped at zero). Returns the new balance."""
+    return _talktime_rpc("deduct_talktime", email, max(0, seconds))
+
+def debit_talktime(email: str, seconds: float) -> Optional[Tuple[float, float]]:
+    """
+    Atomically debit up to `seconds`, never more than the balance.
+    Returns (seconds debited, new balance), or None if the user doesn't exist.
+    """
+    email_lower = email.lower()
+
+    if not supabase:
+        raise RuntimeError("Supabase connection is required")
+
+    try:
+        rows = supabase.rpc("debit_talktime", {"p_email": email_lower, "p_seconds": max(0, seconds)}).execute().data
+    except Exception as e:
+        logger.exception(f"Talktime RPC debit_talktime failed for {email_lower}: {e}")
+        raise AppError("Database error: Failed to update talktime", status_code=500)
+
+    if not rows:
+        return None
+    debited, balance = float(rows[0]["debited"]), float(rows[0]["talktime"])
+    _talktime_written(email_lower, balance)
+    return debited, balance
+
+def add_talktime_to_user(email: str, amount: float) -> Optional[float]:
+    """Atomically add (or, with a negative amount, subtract) talktime. Returns the new balance."""
+    live = ledger_adjust(email, amount)
+    if live is not None:
+        # Live session: the ledger is authoritative and the flusher persists it
+        return live
+    return _talktime_rpc("credit_talktime", email, amount)
+
+def set_user_talktime(email: str, amount: float, version: Optional[int] = None) -> Optional[float]:
+    """
+    Set user talktime to specific amount. Returns the new balance.
+    `version` marks a ledger write-back; it is ignored if a newer one was stored.
+    """
+    if version is not None:
+        return _talktime_rpc("set_talktime", email, max(0, amount), version=version)
+    ledger_adjust(email, max(0, amount), mode="set")
+    return _talktime_rpc("set_talktime", email, max(0, amount))
+
+def record_user_session(email: str, session_data: Dict[str, Any]) -> bool:
+    """
+    Record a user session: one append to user_sessions plus an atomic
+    total_sessions increment (db_scripts/user_sessions.sql).
+    """
+    if not supabase:
+        raise RuntimeError("Supabase connection is required")
+
+    params = {
+        "p_email": email.lower(),
+        "p_session_id": session_data.get("session_id", str(uuid.uuid4())[:8]),
+        "p_duration": int(session_data.get("duration", 0)),
+        "p_transcript_length": int(session_data.get("transcript_length", 0))
+    }
+
+    def _record() -> Optional[int]:
+        total = supabase.rpc("record_user_session", params).execute().data
+        if isinstance(total, list):
+            total = total[0] if total else None
+        if isinstance(total, dict):
+            total = next(iter(total.values()), None)
+        return total
+
+    total = _record()
+    if total is None:
+        create_user(email, {})
+        total = _record()
+    if total is None:
+        return False
+
+    _user_written(email, {
+        "total_sessions": int(total),
         "last_login": datetime.now(timezone.utc).isoformat()
     })
+    return True
+
+def clear_user_sessions(email: str):
+    """Delete a user's session history (admin reset)."""
+    try:
+        supabase.table("user_sessions").delete().eq("email", email.lower()).execute()
+    except Exception as e:
+        logger.error(f"Failed to clear sessions for {email}: {e}")
+        raise AppError("Database error: Failed to reset sessions", status_code=500)
+
+def get_user_sessions(email: str, limit: int = 20, before: Optional[Tuple[str, int]] = None) -> List[Dict[str, Any]]:
+    """Newest-first page of a user's session history; `before` is the (created_at, id) of the last row seen."""
+    query = supabase.table("user_sessions").select("id,session_id,created_at,duration,transcript_length").eq("email", email.lower())
+    if before is not None:
+        created_at, row_id = before
+        query = query.or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{row_id})')
+    return query.order("created_at", desc=True).order("id", desc=True).limit(limit).execute().data or []
+
+RISK_FLAG_COLUMNS = "id,email,created_at,risk_level,urgency,details,transcript_snippet"
+
+def record_risk_flag(email: str, flag: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Record a risk flag: one insert into risk_flags plus an incremental update
+    of the users summary columns (db_scripts/risk_flags.sql).
+    Returns {"highest_level", "flag_count"}, or None if the user does not exist.
+    """
+    if not supabase:
+        raise RuntimeError("Supabase connection is required")
+
+    rows = supabase.rpc("record_risk_flag", {
+        "p_email": email.lower(),
+        "p_risk_level": flag.get("risk_level", "medium"),
+        "p_urgency": flag.get("urgency"),
+        "p_details": flag.get("details"),
+        "p_transcript_snippet": flag.get("transcript_snippet")
+    }).execute().data or []
+    if isinstance(rows, dict):
+        rows = [rows]
+    if not rows:
+        return None
+
+    _user_written(email, {
+        "is_flagged": True,
+        "highest_risk_level": rows[0].get("highest_level"),
+        "risk_flag_count": rows[0].get("flag_count"),
+        "last_risk_flag": datetime.now(timezone.utc).isoformat()
+    })
+    return rows[0]
+
+def get_risk_flags(email: Optional[str] = None, level: Optional[str] = None, limit: int = 50,
+                   before: Optional[Tuple[str, int]] = None) -> List[Dict[str, Any]]:
+    """Newest-first page of risk flags, for one user and/or one level; `before` is the (created_at, id) of the last row seen."""
+    query = supabase.table("risk_flags").select(RISK_FLAG_COLUMNS)
+    if email:
+        query = query.eq("email", email.lower())
+    if level:
+        query = query.eq("risk_level", level)
+    if before is not None:
+        created_at, row_id = before
+        query = query.or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{row_id})')
+    rows = query.order("created_at", desc=True).order("id", desc=True).limit(limit).execute().data or []
+    # Same keys as the old users.risk_flags entries
+    for row in rows:
+        row["timestamp"] = row.get("created_at")
+    return rows
 
 # ===== Blueprint Storage (Supabase) =====
 def save_blueprint_to_disk(blueprint_id: str, data: Dict[str, Any]) -> bool:
@@ -693,7 +2712,7 @@ def load_blueprint_from_disk(blueprint_id: str) -> Optional[Dict[str, Any]]:
     
     try:
         # Query blueprint from Supabase
-        response = supabase.table("blueprints").select("*").eq("id", blueprint_id).execute()
+        response = supabase.table("blueprints").select("content,user_email,session_id,created_at").eq("id", blueprint_id).execute()
         
         if not response.data or len(response.data) == 0:
             return None
@@ -1017,7 +3036,8 @@ def healthz():
         "ok": True,
         "status": "healthy",
         "timestamp": datetime.utcnow().isoformat() + "Z",
-        "version": "1.0.0"
+        "version": "1.0.0",
+        "replica": replica_status()
     })
 
 @app.get("/")
@@ -1068,7 +3088,7 @@ def signup():
         raise AppError("Password must be at least 6 characters long", status_code=400)
     
     # Check if user already exists
-    existing_user = get_user(email)
+    existing_user = get_user(email, "auth")
     if existing_user:
         # Check if user has a password (already signed up)
         if existing_user.get("password_hash"):
@@ -1096,7 +3116,6 @@ def signup():
         "talktime": talktime,
         "created_at": now_iso,
         "last_login": None,
-        "sessions": [],
         "total_sessions": 0,
         "welcome_bonus_given": True,
         "welcome_bonus_date": now_iso,
@@ -1107,7 +3126,8 @@ def signup():
     if name:
         user_data["name"] = name
     
-    update_user(email, user_data)
+    create_user(email, user_data)
+    mark_active(email)
     
     # Remove from pending list if they were there
     if is_pending_community:
@@ -1141,7 +3161,7 @@ def login():
         raise AppError("Password is required", status_code=400)
     
     # Get user
-    user = get_user(email)
+    user = get_user(email, "auth")
     if not user:
         raise AppError("No account found with this email. Please sign up first.", status_code=404)
     
@@ -1155,10 +3175,11 @@ def login():
     if not check_password_hash(password_hash, password):
         raise AppError("Invalid email or password", status_code=401)
     
-    # Update last login
-    update_user(email, {
+    # Update last login (audit only, written behind)
+    update_user_deferred(email, {
         "last_login": datetime.now(timezone.utc).isoformat()
     })
+    mark_active(email)
     
     # Generate JWT token
     app_token = create_token(email)
@@ -1178,22 +3199,31 @@ def login():
 @token_required
 def get_user_talktime(current_user_email: str):
     """Get balance with AUTO-REFILL for Community Members."""
-    # 1. Flush pending Redis time
-    flush_pending_time(current_user_email)
+    return jsonify(_talktime_state(current_user_email))
+
+def _talktime_state(current_user_email: str) -> Dict[str, Any]:
+    """Balance and community status, shared by /api/user/talktime and /api/session/state."""
+    # 1. Flush pending Redis time (a live ledger session reports its balance instead).
+    #    With the reaper running, direct-mode sessions are settled by it instead.
+    live_balance = None
+    if Config.BILLING_MODE != "direct" or not Config.SESSION_REAPER:
+        live_balance = flush_pending_time(current_user_email)
     
     # 2. Check & Apply Monthly Community Refill
     refilled = check_and_refill_community_bonus(current_user_email)
+    if refilled and live_balance is not None:
+        live_balance = 900
     
     # 3. Return Accurate Balance
-    user = get_user(current_user_email)
+    user = current_user("balance")
     if user:
-        return jsonify({
+        return {
             "ok": True,
-            "talktime": user.get("talktime", 0),
+            "talktime": live_balance if live_balance is not None else user.get("talktime", 0),
             "email": current_user_email,
             "is_community_member": user.get("is_community_member", False),
             "is_new": False
-        })
+        }
     else:
         raise AppError("User not found. Please sign up first.", status_code=404)
 
@@ -1206,7 +3236,7 @@ def start_secure_session(current_user_email: str):
     User asks to speak. We check balance and start the server clock.
     """
     # 2. Check Balance
-    user = get_user(current_user_email)
+    user = current_user("balance")
 
     # [GATEKEEPER] Community Members Only
     if not user.get("is_community_member"):
@@ -1221,35 +3251,62 @@ def start_secure_session(current_user_email: str):
     now_iso = datetime.now(timezone.utc).isoformat()
     
     # 4. Store in Redis (Persistence!)
-    session_data = {
-        "session_id": session_id,
-        "last_heartbeat": now_iso
-    }
-    
-    redis_client.setex(f"session:{current_user_email}", SESSION_TTL, json.dumps(session_data))
+    remaining_seconds = int(user.get("talktime", 0))
+    lease = None
+    if Config.BILLING_MODE == "lease":
+        lease = lease_open(current_user_email, session_id)
+        if not lease:
+            return jsonify({"ok": False, "error": "Insufficient Funds"}), 402
+        remaining_seconds = int(lease["remaining_seconds"])
+    elif Config.BILLING_MODE == "ledger":
+        remaining_seconds = int(ledger_open(current_user_email, session_id, float(user.get("talktime", 0))))
+    else:
+        session_data = {
+            "session_id": session_id,
+            "last_heartbeat": now_iso
+        }
+        pipe = redis_client.pipeline()
+        pipe.setex(f"session:{current_user_email}", SESSION_TTL, json.dumps(session_data))
+        touch_session_deadline(current_user_email, pipe=pipe)
+        pipe.execute()
     
     logger.info(f"🚀 Session started: {current_user_email} (ID: {session_id})")
+    record_metric("sessions_started")
     
-    # Also log to DB for audit
-    update_user(current_user_email, {
+    # Also log to DB for audit (written behind)
+    update_user_deferred(current_user_email, {
         "last_active_heartbeat": now_iso,
         "session_status": "active"
     })
     
-    return jsonify({
+    response = {
         "ok": True,
         "session_id": session_id,
-        "remaining_seconds": int(user.get("talktime", 0))
-    })
+        "remaining_seconds": remaining_seconds,
+        "billing": Config.BILLING_MODE
+    }
+    if lease:
+        response.update({k: v for k, v in lease.items() if k != "remaining_seconds"})
+    return jsonify(response)
 
 @app.post("/api/session/heartbeat")
 @limiter.limit("300 per minute")
 @token_required
 def secure_heartbeat(current_user_email: str):
+    mark_active(current_user_email)
+    return _session_heartbeat(current_user_email)
+
+def _session_heartbeat(current_user_email: str):
+    """Bill one heartbeat for the active billing mode (shared by /heartbeat and /state)."""
+    if Config.BILLING_MODE == "ledger":
+        return _ledger_heartbeat_response(current_user_email)
+    if Config.BILLING_MODE == "lease":
+        return _lease_keepalive_response(current_user_email)
+
     lock = redis_client.lock(f"lock:{current_user_email}", timeout=5)
     
     if not lock.acquire(blocking=False):
-        user = get_user(current_user_email)
+        user = current_user("balance")
         return jsonify({
             "ok": True,
             "remaining_seconds": float(user.get("talktime", 0)),
@@ -1268,7 +3325,7 @@ def secure_heartbeat(current_user_email: str):
             logger.warning(f"Session missing for {current_user_email}, attempting to recreate...")
             
             # Check if user still has balance and is active
-            user = get_user(current_user_email)
+            user = current_user("balance")
             if not user or int(user.get("talktime", 0)) <= 0:
                 return jsonify({"ok": False, "action": "terminate", "reason": "Insufficient balance", "remaining_seconds": 0}), 400
             
@@ -1279,7 +3336,10 @@ def secure_heartbeat(current_user_email: str):
                 "session_id": session_id,
                 "last_heartbeat": now_iso
             }
-            redis_client.setex(f"session:{current_user_email}", SESSION_TTL, json.dumps(session_data))
+            pipe = redis_client.pipeline()
+            pipe.setex(f"session:{current_user_email}", SESSION_TTL, json.dumps(session_data))
+            touch_session_deadline(current_user_email, pipe=pipe)
+            pipe.execute()
             logger.info(f"✅ Session recreated for {current_user_email} (ID: {session_id})")
             
             # Return success with current balance
@@ -1302,20 +3362,17 @@ def secure_heartbeat(current_user_email: str):
         now = datetime.now(timezone.utc)
         delta_seconds = (now - last_heartbeat).total_seconds()
         
-        # Heartbeat runs every 2s, allow up to 30s gap for network delays/tab switches
-        MAX_HEARTBEAT_GAP = 30.0
-        
         if delta_seconds > MAX_HEARTBEAT_GAP:
             logger.warning(f"Heartbeat timeout ({delta_seconds}s) for {current_user_email}. Terminating.")
             
             # Only deduct actual time used, capped at MAX_HEARTBEAT_GAP
             deduction = min(delta_seconds, MAX_HEARTBEAT_GAP)
-            user = get_user(current_user_email)
-            current_balance = float(user.get("talktime", 0))
-            new_balance = max(0, current_balance - deduction)
-            update_user(current_user_email, {"talktime": new_balance})
+            new_balance = deduct_talktime(current_user_email, deduction) or 0
+            record_metric("talktime_seconds", deduction)
             
             redis_client.delete(f"session:{current_user_email}")
+            clear_session_deadline(current_user_email)
+            record_metric("sessions_ended")
                 
             return jsonify({
                 "ok": False, 
@@ -1327,45 +3384,217 @@ def secure_heartbeat(current_user_email: str):
         if delta_seconds < 1.0:
             return jsonify({
                 "ok": True,
-                "remaining_seconds": float(get_user(current_user_email).get("talktime", 0)),
+                "remaining_seconds": float(current_user("balance").get("talktime", 0)),
                 "deducted": 0
             })
 
         if delta_seconds < 0: delta_seconds = 0
 
-        user = get_user(current_user_email)
-        current_balance = float(user.get("talktime", 0))
-        new_balance = max(0, current_balance - delta_seconds)
+        new_balance = deduct_talktime(current_user_email, delta_seconds) or 0
+        record_metric("talktime_seconds", delta_seconds)
 
         if new_balance <= 0:
             redis_client.delete(f"session:{current_user_email}")
-
-            update_user(current_user_email, {"talktime": 0})
+            clear_session_deadline(current_user_email)
+            record_metric("sessions_ended")
             return jsonify({"ok": False, "action": "terminate", "remaining_seconds": 0})
-
-        update_user(current_user_email, {"talktime": new_balance})
         
         session_data["last_heartbeat"] = now.isoformat()
         if "last_seen" in session_data: del session_data["last_seen"]
         
-        redis_client.setex(f"session:{current_user_email}", SESSION_TTL, json.dumps(session_data))
+        pipe = redis_client.pipeline()
+        pipe.setex(f"session:{current_user_email}", SESSION_TTL, json.dumps(session_data))
+        touch_session_deadline(current_user_email, pipe=pipe)
+        pipe.execute()
+
+        return jsonify({
+            "ok": True,
+            "remaining_seconds": new_balance,
+            "deducted": delta_seconds
+        })
+    finally:
+        try:
+            lock.release()
+        except:
+            pass
+
+def _ledger_heartbeat_response(email: str):
+    """Heartbeat against the Redis ledger: one Lua round trip, no Supabase call on the hot path."""
+    status, balance, deducted = ledger_heartbeat(email)
+
+    if status == "missing":
+        # Same auto-recreate behaviour as the direct path (Redis restart / race)
+        logger.warning(f"Ledger missing for {email}, attempting to recreate...")
+        user = get_user(email, "balance")
+        if not user or float(user.get("talktime", 0)) <= 0:
+            return jsonify({"ok": False, "action": "terminate", "reason": "Insufficient balance", "remaining_seconds": 0}), 400
+
+        session_id = str(uuid.uuid4())[:8]
+        balance = ledger_open(email, session_id, float(user.get("talktime", 0)))
+        logger.info(f"✅ Ledger recreated for {email} (ID: {session_id})")
+        return jsonify({
+            "ok": True,
+            "remaining_seconds": balance,
+            "deducted": 0,
+            "note": "session_recreated"
+        })
+
+    if status == "timeout":
+        logger.warning(f"Heartbeat timeout for {email}. Terminating.")
+        return jsonify({
+            "ok": False,
+            "action": "terminate",
+            "reason": "Connection Unstable / Timeout",
+            "remaining_seconds": balance
+        })
+
+    if status == "exhausted":
+        return jsonify({"ok": False, "action": "terminate", "remaining_seconds": 0})
+
+    return jsonify({
+        "ok": True,
+        "remaining_seconds": balance,
+        "deducted": deducted
+    })
+
+def _lease_keepalive_response(email: str):
+    """Heartbeat in lease mode: a Redis-only keepalive; billing happens on renew/settle."""
+    status, expires, balance = lease_keepalive(email)
+    _, keepalive = lease_terms(balance)
+
+    if status == "missing":
+        # Same auto-recreate behaviour as the direct path (Redis restart / swept lease)
+        logger.warning(f"Lease missing for {email}, attempting to recreate...")
+        lease = lease_open(email, str(uuid.uuid4())[:8])
+        if not lease:
+            return jsonify({"ok": False, "action": "terminate", "reason": "Insufficient balance", "remaining_seconds": 0}), 400
+        return jsonify({"ok": True, "deducted": 0, "note": "session_recreated", **lease})
+
+    if status == "timeout":
+        logger.warning(f"Heartbeat timeout for {email}. Terminating.")
+        new_balance = lease_settle(email)
+        return jsonify({
+            "ok": False,
+            "action": "terminate",
+            "reason": "Connection Unstable / Timeout",
+            "remaining_seconds": new_balance if new_balance is not None else balance
+        })
+
+    if status == "expired":
+        # The client missed its renewal window; extend if there is balance left
+        lease = lease_extend(email)
+        if not lease or lease["lease_expires_in"] <= 0:
+            new_balance = lease_settle(email)
+            return jsonify({"ok": False, "action": "terminate", "remaining_seconds": new_balance or 0})
+        return jsonify({"ok": True, "deducted": 0, **lease})
+
+    return jsonify({"ok": True, "deducted": 0, **_lease_status(expires, balance, keepalive)})
+
+@app.post("/api/session/renew")
+@limiter.limit("60 per minute")
+@token_required
+def renew_session_lease(current_user_email: str):
+    """Extend the caller's talktime lease (BILLING_MODE=lease)."""
+    if Config.BILLING_MODE != "lease":
+        raise AppError("Lease billing is not enabled", status_code=400)
+
+    lease = lease_extend(current_user_email)
+    if lease is None:
+        return jsonify({"ok": False, "action": "restart", "reason": "No active lease"}), 400
+    return jsonify({"ok": True, **lease})
+
+@app.post("/api/session/state")
+@limiter.limit("300 per minute")
+@token_required
+def session_state(current_user_email: str):
+    """
+    Single poll that replaces the heartbeat, talktime refresh and online ping loops.
+    Renews presence, returns balance + community status, bills the running
+    session when the client is in a call, and tells the client when to poll next.
+    """
+    data = request.get_json(silent=True) or {}
+
+    if data.get("in_session"):
+        result = _session_heartbeat(current_user_email)
+        response, status = result if isinstance(result, tuple) else (result, 200)
+        state = response.get_json()
+        state["talktime"] = state.get("remaining_seconds", 0)
+        user = current_user("balance") or {}
+        state["is_community_member"] = user.get("is_community_member", False)
+        state["next_poll_in"] = state.get("next_heartbeat_in", Config.STATE_ACTIVE_INTERVAL)
+    else:
+        state = _talktime_state(current_user_email)
+        status = 200
+        state["next_poll_in"] = Config.STATE_IDLE_INTERVAL
+
+    # Presence (was /api/user/ping)
+    mark_active(current_user_email)
+    return jsonify(state), status
+
+@app.post("/api/events/ticket")
+@limiter.limit("60 per hour")
+@token_required
+def event_stream_ticket(current_user_email: str):
+    """
+    Short-lived ticket for /api/events/stream. EventSource can't send an
+    Authorization header, so the JWT never goes in the stream URL.
+    """
+    ticket = secrets.token_urlsafe(24)
+    redis_client.setex(f"{SSE_TICKET_PREFIX}{ticket}", Config.SSE_TICKET_TTL, current_user_email.lower())
+    return jsonify({"ok": True, "ticket": ticket, "expires_in": Config.SSE_TICKET_TTL})
+
+@app.get("/api/events/stream")
+@limiter.limit("120 per hour")
+def user_event_stream():
+    """Server-Sent Events: talktime, terminate, community and blueprint pushes for one user."""
+    ticket = request.args.get("ticket", "")
+    # Single use: a ticket leaked from a URL or log can't open a second stream
+    email = redis_client.getdel(f"{SSE_TICKET_PREFIX}{ticket}") if ticket else None
+    if not email:
+        raise AppError("Invalid or expired stream ticket", status_code=401)
+    email = email.decode() if isinstance(email, bytes) else email
+
+    user = get_user(email, "balance")
+    if not user:
+        raise AppError("User not found", status_code=404)
+    snapshot = {"talktime": user.get("talktime", 0), "is_community_member": user.get("is_community_member", False)}
+    stream = user_events.subscribe(email)
 
-        return jsonify({
-            "ok": True,
-            "remaining_seconds": new_balance,
-            "deducted": delta_seconds
-        })
-    finally:
+    def events():
         try:
-            lock.release()
-        except:
-            pass
+            yield "retry: 5000\n\n"
+            yield f"event: hello\ndata: {json.dumps(snapshot, default=str)}\n\n"
+            while True:
+                try:
+                    payload = stream.get(timeout=Config.SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                message = json.loads(payload)
+                yield f"event: {message['event']}\ndata: {json.dumps(message['data'], default=str)}\n\n"
+        finally:
+            user_events.unsubscribe(email, stream)
+
+    return Response(events(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
 
 @app.post("/api/session/end")
 @token_required
 def end_secure_session(current_user_email: str):
     """Ends session and charges for the final seconds."""
-    flush_pending_time(current_user_email) # Re-use the helper
+    # Settling counts sessions_ended, and only when a session was open
+    if Config.BILLING_MODE == "lease":
+        lease_settle(current_user_email)
+    elif Config.BILLING_MODE == "ledger":
+        ledger_settle(current_user_email)
+    else:
+        seconds = _take_pending_seconds(current_user_email)
+        if seconds is not None:
+            record_metric("sessions_ended")
+        if seconds:
+            deduct_talktime(current_user_email, seconds)
     return jsonify({"ok": True})
 
 
@@ -1375,23 +3604,22 @@ def health_check():
     return jsonify({
         "status": "healthy",
         "timestamp": datetime.now(timezone.utc).isoformat(),
-        "service": "ronit-ai-coach"
+        "service": "ronit-ai-coach",
+        "replica": replica_status()
     }), 200
 
 @app.post("/api/user/ping")
 @limiter.limit("60 per hour")  # Allow frequent pings
 @token_required
 def user_ping(current_user_email: str):
-    """Update user's last_login to keep them marked as online. Email is extracted from JWT token."""
+    """Keep the user marked as online (presence index). Email is extracted from JWT token."""
     # Check if user exists
-    user = get_user(current_user_email)
+    user = current_user("exists")
     if not user:
         raise AppError("User not found", status_code=404)
     
-    # Update last_login to current time (keeps user marked as online)
-    update_user(current_user_email, {
-        "last_login": datetime.now(timezone.utc).isoformat()
-    })
+    # Presence lives in Redis; last_login is only written on actual logins
+    mark_active(current_user_email)
     
     return jsonify({
         "ok": True,
@@ -1405,7 +3633,7 @@ def conversation_token(current_user_email: str):
     """Get conversation token from ElevenLabs (Community Members only)."""
     global _TOKEN_CACHE
 
-    user = get_user(current_user_email)
+    user = current_user("balance")
     if not user or not user.get("is_community_member"):
         raise AppError("Access restricted to Community Members only", status_code=403)
 
@@ -1470,6 +3698,7 @@ def process_care_plan_background(app_context, transcript, current_user_email, se
                 "transcript": transcript
             }
             save_blueprint_to_disk(blueprint_id, blueprint_data)
+            record_metric("care_plans")
             
             # 3. Record Session
             try:
@@ -1481,8 +3710,13 @@ def process_care_plan_background(app_context, transcript, current_user_email, se
             except Exception as e:
                 logger.warning(f"Failed to record session in bg: {e}")
             
-            # 4. Send Email
+            # 4. Push "blueprint ready" to open tabs, then email
             care_plan_link = f"{host_url.rstrip('/')}/blueprint/{blueprint_id}"
+            publish_user_event(current_user_email, "blueprint", {
+                "blueprint_id": blueprint_id,
+                "session_id": session_id,
+                "link": care_plan_link
+            })
             _delayed_email_with_link(current_user_email, care_plan_link, 0)
             
             logger.info(f"Background processing success: {blueprint_id}")
@@ -1514,39 +3748,24 @@ def upload_session(current_user_email: str):
         risk_details = risk_assessment.get("details", "")
         
         logger.warning(f"🚨 RISK FLAGGED for {current_user_email}: {risk_level} - {risk_details[:100]}")
+        record_metric(f"risk_flags_{risk_level if risk_level in ('high', 'medium') else 'low'}")
         
-        # Flag the user in database
-        user = get_user(current_user_email)
-        current_flags = user.get("risk_flags", []) if user else []
-        if not isinstance(current_flags, list):
-            current_flags = []
-        
-        # Add new flag entry
-        flag_entry = {
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "risk_level": risk_level,
-            "details": risk_details[:500],  # Limit details length
-            "transcript_snippet": transcript[:300],  # First 300 chars for context
-            "urgency": risk_assessment.get("urgency", "medium")
-        }
-        current_flags.append(flag_entry)
-        
-        # Keep only last 50 flags per user
-        if len(current_flags) > 50:
-            current_flags = current_flags[-50:]
-        
-        # Update user with flag
-        update_user(current_user_email, {
-            "is_flagged": True,
-            "risk_flags": current_flags,
-            "last_risk_flag": datetime.now(timezone.utc).isoformat(),
-            "highest_risk_level": max(
-                [risk_level] + [f.get("risk_level", "low") for f in current_flags[:-1]],
-                key=lambda x: {"low": 0, "medium": 1, "high": 2}.get(x, 0)
-            )
-        })
+        # Flag the user in database (one insert; highest level kept incrementally)
+        try:
+            flagged = record_risk_flag(current_user_email, {
+                "risk_level": risk_level,
+                "details": risk_details[:500],  # Limit details length
+                "transcript_snippet": transcript[:300],  # First 300 chars for context
+                "urgency": risk_assessment.get("urgency", "medium")
+            })
+        except Exception as e:
+            flagged = None
+            logger.error(f"Failed to record risk flag for {current_user_email}: {e}")
         
-        logger.critical(f"⚠️ User {current_user_email} has been flagged for {risk_level} risk level")
+        if flagged:
+            logger.critical(f"⚠️ User {current_user_email} has been flagged for {risk_level} risk level (highest: {flagged.get('highest_level')})")
+        else:
+            logger.critical(f"⚠️ User {current_user_email} flagged for {risk_level} risk level but the flag was not saved")
     
     # Generate session ID and timestamp
     timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
@@ -1751,19 +3970,33 @@ def verify_razorpay_payment(current_user_email: str):
         if not hmac.compare_digest(generated_signature, razorpay_signature):
             raise AppError("Invalid payment signature", status_code=400)
 
-        # 3. Add Talktime & Record Transaction (Atomic-ish)
-        # Using 100 credits as per your logic
-        if add_talktime_to_user(current_user_email, 100):
-            record_transaction(current_user_email, razorpay_order_id, 100)
-            
-            user = get_user(current_user_email)
-            return jsonify({
-                "ok": True, 
-                "message": "Payment verified", 
-                "new_talktime": user.get("talktime")
-            })
-        else:
+        # 3. Record Transaction & Add Talktime
+        # Using 100 credits as per your logic. The order row is claimed first,
+        # so a concurrent verify of the same order stops before crediting on
+        # every backend. On postgres/sqlite the claim and the credit commit
+        # together; a live ledger is in Redis, so it is only credited once the
+        # claim has committed.
+        credited = {}
+        with db_transaction():
+            if not claim_transaction(current_user_email, razorpay_order_id, 100):
+                logger.warning(f"Replay attack attempt by {current_user_email} with order {razorpay_order_id}")
+                raise AppError("Transaction already processed", status_code=400)
+            if Config.BILLING_MODE == "ledger":
+                after_commit(lambda: credited.update(talktime=add_talktime_to_user(current_user_email, 100)))
+            else:
+                credited["talktime"] = add_talktime_to_user(current_user_email, 100)
+                if credited["talktime"] is None:
+                    raise AppError("Failed to update balance", status_code=500)
+
+        new_talktime = credited.get("talktime")
+        if new_talktime is None:
             raise AppError("Failed to update balance", status_code=500)
+
+        return jsonify({
+            "ok": True, 
+            "message": "Payment verified", 
+            "new_talktime": new_talktime
+        })
             
     except Exception as e:
         logger.exception("Payment verification failed")
@@ -1843,7 +4076,7 @@ def verify_admin_token():
 def check_pending_community_member(email: str) -> bool:
     """Check if email is in pending community members list."""
     try:
-        response = supabase.table("pending_community_members").select("*").eq("email", email).execute()
+        response = supabase.table("pending_community_members").select("email").eq("email", email).execute()
         return len(response.data) > 0 if response.data else False
     except Exception as e:
         logger.error(f"Error checking pending community member: {e}")
@@ -1869,16 +4102,17 @@ def add_community_member():
         raise AppError("Invalid email", status_code=400)
     
     try:
-        response = supabase.table("users").select("*").eq("email", email).execute()
+        response = supabase.table("users").select("email").eq("email", email).execute()
         
         if response.data and len(response.data) > 0:
             # User exists - promote them directly with 15 min total (replace, don't add)
             now_iso = datetime.now(timezone.utc).isoformat()
-            supabase.table("users").update({
+            promotion = {
                 "is_community_member": True,
                 "talktime": 900,  # 15 minutes total (community members get only this)
                 "last_community_refill": now_iso
-            }).eq("email", email).execute()
+            }
+            update_user(email, promotion)
             
             # Remove from pending list if they were there
             remove_from_pending_list(email)
@@ -1964,11 +4198,12 @@ def remove_community_member():
     email = (data.get("email") or "").strip().lower()
     
     try:
-        supabase.table("users").update({
+        removal = {
             "is_community_member": False,
             "last_community_refill": None,
             "talktime": 180  # Reset to 3 minutes on removal
-        }).eq("email", email).execute()
+        }
+        update_user(email, removal)
 
         return jsonify({"ok": True, "message": f"{email} removed from Community."})
     except Exception as e:
@@ -2080,7 +4315,7 @@ def redeem_coupon(current_user_email: str):
 
     try:
         # Get coupon
-        res = supabase.table("coupon_codes").select("*").eq("code", code).execute()
+        res = supabase.table("coupon_codes").select("code,is_active,expires_at,max_uses,uses").eq("code", code).execute()
         if not res.data:
             raise AppError("Invalid coupon code", status_code=404)
 
@@ -2110,7 +4345,7 @@ def redeem_coupon(current_user_email: str):
             raise AppError("This coupon has reached its usage limit", status_code=400)
 
         # Check if user is already a community member
-        user = get_user(current_user_email)
+        user = current_user("balance")
         if not user:
             raise AppError("User not found", status_code=404)
         if user.get("is_community_member"):
@@ -2118,11 +4353,12 @@ def redeem_coupon(current_user_email: str):
 
         # Grant community member status
         now_iso = datetime.now(timezone.utc).isoformat()
-        supabase.table("users").update({
+        promotion = {
             "is_community_member": True,
             "talktime": 900,
             "last_community_refill": now_iso
-        }).eq("email", current_user_email).execute()
+        }
+        update_user(current_user_email, promotion)
 
         # Increment coupon uses (deactivate if max reached)
         new_uses = uses + 1
@@ -2141,154 +4377,510 @@ def redeem_coupon(current_user_email: str):
         raise AppError("Database error", status_code=500)
 
 
+# ===== Admin user listing (keyset pagination) =====
+# admin_list_users() (db_scripts/admin_user_listing.sql) returns one page in
+# index order. The cursor is the (sort_key, email) of the last row, so every
+# page is a single index range scan no matter how deep the admin pages.
+
+ADMIN_LIST_SORTS = {"recent", "talktime", "created", "email"}
+ADMIN_LIST_DEFAULT_LIMIT = 50
+ADMIN_LIST_MAX_LIMIT = 200
+
+def _encode_list_cursor(sort: str, row: Dict[str, Any]) -> str:
+    raw = json.dumps({"s": sort, "k": row.get("sort_key"), "e": row.get("email")}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode_list_cursor(cursor: str, sort: str) -> Tuple[Optional[str], str]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        key, email = data["k"], data["e"]
+    except Exception:
+        raise AppError("Invalid cursor", status_code=400)
+    if data.get("s") != sort or not isinstance(email, str):
+        raise AppError("Cursor does not match sort", status_code=400)
+    return key, email
+
+def _decode_created_id_cursor(cursor: str, sort: str) -> Tuple[str, int]:
+    """Decode a (created_at, id) keyset cursor into a normalized timestamp and an integer id."""
+    key, _ = _decode_list_cursor(cursor, sort)
+    try:
+        if not isinstance(key, list) or len(key) != 2:
+            raise ValueError("expected [created_at, id]")
+        parsed = datetime.fromisoformat(key[0].replace("Z", "+00:00"))
+        row_id = int(key[1])
+    except (AttributeError, TypeError, ValueError):
+        raise AppError("Invalid cursor", status_code=400)
+    # Whole milliseconds keep three digits: the SQLite backend compares the stored text
+    timespec = "milliseconds" if parsed.microsecond % 1000 == 0 else "microseconds"
+    return parsed.isoformat(timespec=timespec), row_id
+
+def _bool_arg(name: str) -> Optional[bool]:
+    value = (request.args.get(name) or "").strip().lower()
+    if value in ("1", "true", "yes"):
+        return True
+    if value in ("0", "false", "no"):
+        return False
+    return None
+
+def _online_emails() -> List[str]:
+    """Emails seen within PRESENCE_ONLINE_WINDOW (from the presence index)."""
+    members = redis_client.zrangebyscore(PRESENCE_KEY, time.time() - Config.PRESENCE_ONLINE_WINDOW, "+inf")
+    return [m.decode() if isinstance(m, bytes) else m for m in members]
+
+def _list_row(row: Dict[str, Any], seen_at: Optional[float], now: float) -> Dict[str, Any]:
+    """Compact admin list row (field names match the old full listing)."""
+    return {
+        "email": row["email"],
+        "talktime": row.get("talktime") or 0,
+        "is_community_member": row.get("is_community_member", False),
+        "created_at": row.get("created_at") or "Unknown",
+        "last_login": row.get("last_login") or "Never",
+        "last_login_iso": row.get("last_login"),
+        "last_seen": datetime.fromtimestamp(seen_at, timezone.utc).isoformat() if seen_at else None,
+        "is_online": seen_at is not None and now - seen_at < Config.PRESENCE_ONLINE_WINDOW,
+        "total_sessions": row.get("total_sessions", 0),
+        "last_community_refill": row.get("last_community_refill"),
+        "welcome_bonus_given": row.get("welcome_bonus_given", False),
+        "updated_at": row.get("updated_at") or "Unknown",
+        "is_flagged": row.get("is_flagged", False),
+        "risk_flag_count": row.get("risk_flag_count", 0),
+        "highest_risk_level": row.get("highest_risk_level") or "low",
+        "last_risk_flag": row.get("last_risk_flag"),
+    }
+
 @app.get("/api/admin/users")
-@limiter.limit("100 per hour")
+@limiter.limit("600 per hour")
 def get_all_users():
-    """Get all users (admin only)."""
+    """One page of users (admin only).
+
+    Query: limit, cursor, sort (recent|talktime|created|email),
+    flagged, community, online (true/false), q (email prefix).
+    """
     verify_admin_token()
-    users = load_users()
-    
-    # Format user data for display
-    users_list = []
-    now = datetime.now(timezone.utc)
-    
-    for email, user_data in users.items():
-        last_login_str = user_data.get("last_login")
-        last_login_dt = None
-        is_online = False
-        
-        if last_login_str:
+    if not supabase:
+        raise AppError("Supabase connection is required", status_code=503)
+
+    sort = request.args.get("sort", "recent")
+    if sort == "last_login":
+        sort = "recent"
+    if sort not in ADMIN_LIST_SORTS:
+        raise AppError(f"Unknown sort: {sort}", status_code=400)
+    try:
+        limit = int(request.args.get("limit", ADMIN_LIST_DEFAULT_LIMIT))
+    except ValueError:
+        raise AppError("limit must be an integer", status_code=400)
+    limit = max(1, min(limit, ADMIN_LIST_MAX_LIMIT))
+
+    after_key, after_email = None, None
+    cursor = request.args.get("cursor")
+    if cursor:
+        after_key, after_email = _decode_list_cursor(cursor, sort)
+
+    online = _bool_arg("online")
+    emails, exclude = None, None
+    if online is not None:
+        online_now = _online_emails()
+        if online:
+            if not online_now:
+                return jsonify({"ok": True, "users": [], "next_cursor": None, "has_more": False, "online_count": 0})
+            emails = online_now
+        else:
+            exclude = online_now or None
+
+    params = {
+        "p_sort": sort,
+        "p_limit": limit + 1,
+        "p_after_key": after_key,
+        "p_after_email": after_email,
+        "p_community": _bool_arg("community"),
+        "p_flagged": _bool_arg("flagged"),
+        "p_emails": emails,
+        "p_exclude_emails": exclude,
+        "p_email_prefix": (request.args.get("q") or "").strip().lower() or None,
+    }
+    try:
+        rows = read_db().rpc("admin_list_users", params).execute().data or []
+    except Exception as e:
+        logger.error(f"Failed to list users: {e}")
+        raise AppError("Database error", status_code=500)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    now = time.time()
+    last_seen = last_seen_times([row["email"] for row in rows])
+    users_list = [_list_row(row, last_seen.get(row["email"].lower()), now) for row in rows]
+
+    return jsonify({
+        "ok": True,
+        "users": users_list,
+        "next_cursor": _encode_list_cursor(sort, rows[-1]) if has_more else None,
+        "has_more": has_more,
+        "online_count": online_count()
+    })
+
+@app.get("/api/admin/users/<email>")
+@limiter.limit("600 per hour")
+def get_user_details(email):
+    """Full record for one user, including sessions and risk flags (admin only)."""
+    verify_admin_token()
+    user = get_user(email, "admin_summary")
+    if not user:
+        raise AppError("User not found", status_code=404)
+
+    try:
+        risk_flags = get_risk_flags(email, limit=50)
+        sessions = get_user_sessions(email, limit=10)
+        totals = supabase.rpc("user_session_totals", {"p_email": email.lower()}).execute().data or []
+    except Exception as e:
+        logger.error(f"Failed to load sessions for {email}: {e}")
+        raise AppError("Database error", status_code=500)
+
+    row = dict(user, email=email.lower())
+    seen_at = last_seen_times([email]).get(email.lower())
+    details = _list_row(row, seen_at, time.time())
+    details.update({
+        "total_duration": int((totals[0] if totals else {}).get("total_duration") or 0),
+        "sessions": sessions,
+        "welcome_bonus_date": user.get("welcome_bonus_date"),
+        "risk_flags": risk_flags,
+        "recent_risk_flags": risk_flags[:5],
+    })
+    return jsonify({"ok": True, "user": details})
+
+@app.get("/api/admin/users/<email>/sessions")
+@limiter.limit("600 per hour")
+def get_user_session_history(email):
+    """Session history for one user, newest first (admin only). Query: limit, cursor."""
+    verify_admin_token()
+    if not supabase:
+        raise AppError("Supabase connection is required", status_code=503)
+    try:
+        limit = max(1, min(int(request.args.get("limit", ADMIN_LIST_DEFAULT_LIMIT)), ADMIN_LIST_MAX_LIMIT))
+    except ValueError:
+        raise AppError("limit must be an integer", status_code=400)
+
+    before = None
+    cursor = request.args.get("cursor")
+    if cursor:
+        before = _decode_created_id_cursor(cursor, "sessions")
+
+    try:
+        rows = get_user_sessions(email, limit=limit + 1, before=before)
+    except Exception as e:
+        logger.error(f"Failed to load sessions for {email}: {e}")
+        raise AppError("Database error", status_code=500)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = None
+    if has_more:
+        next_cursor = _encode_list_cursor("sessions", {
+            "sort_key": [rows[-1]["created_at"], rows[-1]["id"]],
+            "email": email.lower()
+        })
+    return jsonify({"ok": True, "sessions": rows, "next_cursor": next_cursor, "has_more": has_more})
+
+# ===== Admin search =====
+# admin_search_users() (db_scripts/user_search.sql) matches email/name by
+# prefix, or by substring through trigram indexes for 3+ characters. Results
+# of recent queries are cached in Redis; while an admin types, a cached
+# complete result for a shorter query is narrowed locally instead of asking
+# the database again.
+
+SEARCH_CACHE_PREFIX = "search:"
+SEARCH_CACHE_DEPTH = 100  # rows cached per query (covers the first pages); admin_search_users returns up to 101
+SEARCH_SUBSTRING_MIN = 3
+
+def _search_match(row: Dict[str, Any], query: str) -> Optional[bool]:
+    """Mirror of the SQL predicate: None if no match, else whether it is a prefix match."""
+    fields = [row.get("email") or "", (row.get("name") or "").lower()]
+    if any(f.startswith(query) for f in fields):
+        return True
+    if len(query) >= SEARCH_SUBSTRING_MIN and any(query in f for f in fields):
+        return False
+    return None
+
+def _search_cached(query: str) -> Optional[Dict[str, Any]]:
+    """Rows for `query` from its own cache entry or a narrowable complete shorter one."""
+    candidates = [query] + [query[:k] for k in range(len(query) - 1, 0, -1)]
+    cached = redis_client.mget([f"{SEARCH_CACHE_PREFIX}{q}" for q in candidates])
+    for q, raw in zip(candidates, cached):
+        if not raw:
+            continue
+        entry = json.loads(raw)
+        if q == query:
+            return entry
+        # A shorter query's rows are a superset only if it was complete and its
+        # match mode (prefix vs substring) is at least as wide as ours
+        if not entry["complete"]:
+            continue
+        if len(q) < SEARCH_SUBSTRING_MIN <= len(query):
+            continue
+        rows = []
+        for row in entry["rows"]:
+            prefix = _search_match(row, query)
+            if prefix is not None:
+                rows.append(dict(row, prefix_match=prefix))
+        rows.sort(key=lambda r: (not r["prefix_match"], r["email"]))
+        return {"rows": rows, "complete": True}
+    return None
+
+def search_users(query: str, limit: int, offset: int) -> Tuple[List[Dict[str, Any]], bool]:
+    """One page of matches and whether more exist."""
+    if offset + limit <= SEARCH_CACHE_DEPTH:
+        entry = None
+        try:
+            entry = _search_cached(query)
+        except Exception as e:
+            logger.warning(f"Search cache read failed: {e}")
+        if entry is None:
+            rows = read_db().rpc("admin_search_users", {
+                "p_query": query, "p_limit": SEARCH_CACHE_DEPTH + 1, "p_offset": 0
+            }).execute().data or []
+            entry = {"rows": rows[:SEARCH_CACHE_DEPTH], "complete": len(rows) <= SEARCH_CACHE_DEPTH}
             try:
-                # Parse ISO format datetime
-                if isinstance(last_login_str, str):
-                    # Handle both with and without timezone
-                    if last_login_str.endswith('Z'):
-                        last_login_dt = datetime.fromisoformat(last_login_str.replace('Z', '+00:00'))
-                    elif '+' in last_login_str or last_login_str.count('-') >= 3:
-                        # Has timezone info
-                        last_login_dt = datetime.fromisoformat(last_login_str)
-                    else:
-                        # No timezone, assume UTC
-                        last_login_dt = datetime.fromisoformat(last_login_str.replace('Z', '') + '+00:00')
-                else:
-                    last_login_dt = last_login_str
-                
-                # Consider user online if last login was within last 15 minutes
-                if last_login_dt:
-                    # Ensure timezone aware
-                    if last_login_dt.tzinfo is None:
-                        last_login_dt = last_login_dt.replace(tzinfo=timezone.utc)
-                    time_diff = (now - last_login_dt).total_seconds()
-                    is_online = time_diff < 900  # 15 minutes
+                redis_client.setex(f"{SEARCH_CACHE_PREFIX}{query}", Config.SEARCH_CACHE_TTL, json.dumps(entry, default=str))
             except Exception as e:
-                logger.warning(f"Failed to parse last_login for {email}: {e}")
-        
-        sessions = user_data.get("sessions", [])
-        if not isinstance(sessions, list):
-            sessions = []
-        
-        # Calculate total session duration
-        total_duration = sum(s.get("duration", 0) for s in sessions)
-        
-        # Get risk flag information
-        is_flagged = user_data.get("is_flagged", False)
-        risk_flags = user_data.get("risk_flags", [])
-        if not isinstance(risk_flags, list):
-            risk_flags = []
-        highest_risk_level = user_data.get("highest_risk_level", "low")
-        last_risk_flag = user_data.get("last_risk_flag")
-        
-        users_list.append({
-            "email": user_data.get("email", email),
-            "talktime": user_data.get("talktime", 0),
-            "is_community_member": user_data.get("is_community_member", False),
-            "created_at": user_data.get("created_at", "Unknown"),
-            "last_login": last_login_str or "Never",
-            "last_login_iso": last_login_str,
-            "is_online": is_online,
-            "total_sessions": user_data.get("total_sessions", 0),
-            "total_duration": total_duration,
-            "sessions": sessions[-10:],
-            "welcome_bonus_given": user_data.get("welcome_bonus_given", False),
-            "welcome_bonus_date": user_data.get("welcome_bonus_date"),
-            "updated_at": user_data.get("updated_at", "Unknown"),
-            # Risk flag information
-            "is_flagged": is_flagged,
-            "risk_flag_count": len(risk_flags),
-            "highest_risk_level": highest_risk_level,
-            "last_risk_flag": last_risk_flag,
-            "recent_risk_flags": risk_flags[-5:] if risk_flags else []  # Last 5 flags
-        })
-    
-    # Sort by flagged status first (flagged users at top), then by last login
-    users_list.sort(key=lambda x: (
-        x["is_flagged"],  # Flagged users first
-        x["highest_risk_level"] == "high",  # High risk first among flagged
-        x["is_online"],  # Online users first
-        x["last_login"] or ""  # Then by last login
-    ), reverse=True)
-    
-    flagged_count = sum(1 for u in users_list if u["is_flagged"])
-    high_risk_count = sum(1 for u in users_list if u["highest_risk_level"] == "high")
-    
+                logger.warning(f"Search cache write failed: {e}")
+        page = entry["rows"][offset:offset + limit]
+        return page, offset + limit < len(entry["rows"]) or not entry["complete"]
+
+    rows = read_db().rpc("admin_search_users", {
+        "p_query": query, "p_limit": limit + 1, "p_offset": offset
+    }).execute().data or []
+    return rows[:limit], len(rows) > limit
+
+@app.get("/api/admin/search")
+@limiter.limit("1200 per hour")
+def admin_search():
+    """Find users by email or name (admin only). Query: q, limit (max 50), offset."""
+    verify_admin_token()
+    if not supabase:
+        raise AppError("Supabase connection is required", status_code=503)
+
+    query = (request.args.get("q") or "").strip().lower()[:100]
+    if not query:
+        raise AppError("q is required", status_code=400)
+    try:
+        limit = max(1, min(int(request.args.get("limit", 20)), 50))
+        offset = max(0, min(int(request.args.get("offset", 0)), 1000))
+    except ValueError:
+        raise AppError("limit and offset must be integers", status_code=400)
+
+    try:
+        rows, has_more = search_users(query, limit, offset)
+    except Exception as e:
+        logger.error(f"User search failed: {e}")
+        raise AppError("Database error", status_code=500)
+
+    now = time.time()
+    last_seen = last_seen_times([row["email"] for row in rows])
+    users_list = []
+    for row in rows:
+        user = _list_row(row, last_seen.get(row["email"].lower()), now)
+        user.update({"name": row.get("name"), "prefix_match": bool(row.get("prefix_match"))})
+        users_list.append(user)
+
     return jsonify({
         "ok": True,
+        "query": query,
         "users": users_list,
-        "total": len(users_list),
-        "online_count": sum(1 for u in users_list if u["is_online"]),
-        "offline_count": sum(1 for u in users_list if not u["is_online"]),
-        "flagged_count": flagged_count,
-        "high_risk_count": high_risk_count
+        "offset": offset,
+        "has_more": has_more
+    })
+
+# ===== Admin export (streaming) =====
+# Pages through users by email (keyset on the unique index) and yields each
+# batch as it arrives, so memory stays at one batch whatever the table size.
+# dataset=sessions / risk_flags stream those tables the same way, keyset on id.
+
+EXPORT_FIELDS = [
+    "email", "talktime", "is_community_member", "created_at", "updated_at",
+    "last_login", "total_sessions", "welcome_bonus_given", "welcome_bonus_date",
+    "last_community_refill", "is_flagged", "highest_risk_level", "last_risk_flag",
+    "risk_flag_count",
+]
+# dataset -> columns, for the history tables
+EXPORT_TABLES = {
+    "sessions": ("user_sessions", ["id", "email", "session_id", "created_at", "duration", "transcript_length"]),
+    "risk_flags": ("risk_flags", RISK_FLAG_COLUMNS.split(",")),
+}
+
+def _export_fields() -> List[str]:
+    requested = request.args.get("fields")
+    if not requested:
+        return EXPORT_FIELDS
+    fields = [f.strip() for f in requested.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in EXPORT_FIELDS]
+    if unknown:
+        raise AppError(f"Unknown export fields: {', '.join(unknown)}", status_code=400)
+    # email is the cursor, so it is always exported (first)
+    return ["email"] + [f for f in fields if f != "email"]
+
+def iter_user_batches(fields: List[str], community: Optional[bool] = None,
+                      flagged: Optional[bool] = None, prefix: Optional[str] = None):
+    """Yield lists of user rows (selected columns only), ordered by email, from read_db()."""
+    user_fields, balance_fields = _split_balance_fields(dict.fromkeys(fields))
+    columns = list(user_fields)
+    if balance_fields:
+        columns.append(f"user_balances({','.join(balance_fields)})")
+    db = read_db()
+    after = None
+    while True:
+        query = db.table("users").select(",".join(columns))
+        if after is not None:
+            query = query.gt("email", after)
+        if community is not None:
+            query = query.eq("is_community_member", community)
+        if flagged is not None:
+            query = query.eq("is_flagged", flagged)
+        if prefix:
+            escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            query = query.like("email", f"{escaped}%")
+        rows = query.order("email").limit(Config.EXPORT_BATCH).execute().data or []
+        if not rows:
+            return
+        rows = [_with_balance(row) for row in rows]
+        yield [{f: row.get(f) for f in fields} for row in rows]
+        if len(rows) < Config.EXPORT_BATCH:
+            return
+        after = rows[-1]["email"]
+
+def iter_table_batches(table: str, fields: List[str], prefix: Optional[str] = None):
+    """Yield lists of rows from a history table, ordered by id, from read_db()."""
+    db = read_db()
+    after = None
+    while True:
+        query = db.table(table).select(",".join(fields))
+        if after is not None:
+            query = query.gt("id", after)
+        if prefix:
+            escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            query = query.like("email", f"{escaped}%")
+        rows = query.order("id").limit(Config.EXPORT_BATCH).execute().data or []
+        if not rows:
+            return
+        yield rows
+        if len(rows) < Config.EXPORT_BATCH:
+            return
+        after = rows[-1]["id"]
+
+@app.get("/api/admin/export")
+@limiter.limit("20 per hour")
+def export_users():
+    """Stream users as NDJSON or CSV (admin only).
+
+    Query: format (ndjson|csv), dataset (users|sessions|risk_flags), fields
+    (comma list, users only), community, flagged, q (email prefix).
+    """
+    verify_admin_token()
+    if not supabase:
+        raise AppError("Supabase connection is required", status_code=503)
+
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        raise AppError("format must be ndjson or csv", status_code=400)
+    dataset = request.args.get("dataset", "users")
+    prefix = (request.args.get("q") or "").strip().lower() or None
+    if dataset == "users":
+        fields = _export_fields()
+        batches = iter_user_batches(
+            fields,
+            community=_bool_arg("community"),
+            flagged=_bool_arg("flagged"),
+            prefix=prefix
+        )
+    elif dataset in EXPORT_TABLES:
+        table, fields = EXPORT_TABLES[dataset]
+        batches = iter_table_batches(table, fields, prefix=prefix)
+    else:
+        raise AppError(f"dataset must be one of: users, {', '.join(EXPORT_TABLES)}", status_code=400)
+
+    def ndjson():
+        try:
+            for rows in batches:
+                yield "".join(json.dumps(row, default=str) + "\n" for row in rows)
+        except Exception as e:
+            logger.error(f"Export failed mid-stream: {e}")
+            yield json.dumps({"error": "export_interrupted"}) + "\n"
+
+    def csv_rows():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(fields)
+        try:
+            for rows in batches:
+                for row in rows:
+                    writer.writerow([row.get(f) for f in fields])
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        except Exception as e:
+            # Headers are already sent; a truncated file is the only signal left
+            logger.error(f"Export failed mid-stream: {e}")
+        yield buf.getvalue()
+
+    logger.info(f"📤 {dataset.capitalize()} export ({fmt}, {len(fields)} fields) started by admin from {get_remote_address()}")
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    if fmt == "csv":
+        body, mimetype = csv_rows(), "text/csv"
+    else:
+        body, mimetype = ndjson(), "application/x-ndjson"
+    return Response(body, mimetype=mimetype, headers={
+        "Content-Disposition": f'attachment; filename="{dataset}-{stamp}.{fmt}"',
+        "Cache-Control": "no-store",
+        "X-Accel-Buffering": "no"
     })
 
+# Totals come from one aggregate RPC (db_scripts/admin_stats.sql), cached in
+# Redis for ADMIN_STATS_CACHE_TTL so a dashboard auto-refreshing in several
+# tabs costs one query per TTL. Presence counts are live Redis reads.
+ADMIN_STATS_CACHE_KEY = "cache:admin_stats"
+
+def load_user_totals() -> Dict[str, Any]:
+    """users-table aggregates (count, talktime, sessions, community, flagged)."""
+    try:
+        cached = redis_client.get(ADMIN_STATS_CACHE_KEY)
+        if cached:
+            return json.loads(cached)
+    except Exception as e:
+        logger.warning(f"Admin stats cache read failed: {e}")
+
+    if not supabase:
+        raise AppError("Supabase connection is required", status_code=503)
+    try:
+        rows = read_db().rpc("admin_user_stats", {}).execute().data or []
+    except Exception as e:
+        logger.error(f"Failed to aggregate user stats: {e}")
+        raise AppError("Database error", status_code=500)
+    row = rows[0] if rows else {}
+    totals = {
+        "total_users": int(row.get("total_users") or 0),
+        "total_talktime": float(row.get("total_talktime") or 0),
+        "total_sessions": int(row.get("total_sessions") or 0),
+        "community_members": int(row.get("community_members") or 0),
+        "flagged_users": int(row.get("flagged_users") or 0),
+    }
+    try:
+        redis_client.setex(ADMIN_STATS_CACHE_KEY, Config.ADMIN_STATS_CACHE_TTL, json.dumps(totals))
+    except Exception as e:
+        logger.warning(f"Admin stats cache write failed: {e}")
+    return totals
+
 @app.get("/api/admin/stats")
 @limiter.limit("100 per hour")
 def get_admin_stats():
     """Get admin statistics."""
     verify_admin_token()
-    users = load_users()
-    
-    total_users = len(users)
-    total_talktime = sum(user.get("talktime", 0) for user in users.values())
-    total_sessions = sum(user.get("total_sessions", 0) for user in users.values())
-    
-    # Users who logged in today
-    today = datetime.now(timezone.utc).date()
-    now = datetime.now(timezone.utc)
+    totals = load_user_totals()
+    total_users = totals["total_users"]
+    total_talktime = totals["total_talktime"]
+    total_sessions = totals["total_sessions"]
     
-    active_today = 0
-    online_now = 0
-    
-    for user in users.values():
-        last_login_str = user.get("last_login")
-        if last_login_str:
-            try:
-                if isinstance(last_login_str, str):
-                    if last_login_str.endswith('Z'):
-                        last_login_dt = datetime.fromisoformat(last_login_str.replace('Z', '+00:00'))
-                    elif '+' in last_login_str or last_login_str.count('-') >= 3:
-                        last_login_dt = datetime.fromisoformat(last_login_str)
-                    else:
-                        last_login_dt = datetime.fromisoformat(last_login_str.replace('Z', '') + '+00:00')
-                else:
-                    last_login_dt = last_login_str
-                
-                if last_login_dt:
-                    # Ensure timezone aware
-                    if last_login_dt.tzinfo is None:
-                        login_date = last_login_dt.replace(tzinfo=timezone.utc)
-                    else:
-                        login_date = last_login_dt
-                    
-                    if login_date.date() == today:
-                        active_today += 1
-                    
-                    # Online if last login within 15 minutes
-                    time_diff = (now - login_date).total_seconds()
-                    if time_diff < 900:
-                        online_now += 1
-            except Exception:
-                pass
+    # Online / active counts come from the presence index, not last_login
+    online_now = online_count()
+    daily_actives = daily_active_counts(7)
+    active_today = next(iter(daily_actives.values()))
     
     return jsonify({
         "ok": True,
@@ -2298,11 +4890,119 @@ def get_admin_stats():
             "total_sessions": total_sessions,
             "active_today": active_today,
             "online_now": online_now,
+            "community_members": totals["community_members"],
+            "flagged_users": totals["flagged_users"],
             "average_talktime": round(total_talktime / total_users, 2) if total_users > 0 else 0,
-            "average_sessions": round(total_sessions / total_users, 2) if total_users > 0 else 0
+            "average_sessions": round(total_sessions / total_users, 2) if total_users > 0 else 0,
+            "daily_actives": daily_actives
         }
     })
 
+# Analytics run on a local columnar snapshot (users_snapshot.py) that is
+# topped up with rows changed since its watermark, at most every
+# SNAPSHOT_SYNC_INTERVAL seconds. numpy is only needed for this endpoint.
+_users_snapshot = None
+_users_snapshot_lock = Lock()
+
+def get_users_snapshot():
+    global _users_snapshot
+    with _users_snapshot_lock:
+        if _users_snapshot is None:
+            try:
+                from users_snapshot import UsersSnapshot
+            except ImportError:
+                raise AppError("Analytics require numpy (pip install numpy)", status_code=501)
+            _users_snapshot = UsersSnapshot(
+                DATA_DIR / "users_snapshot", supabase, redis_client,
+                batch=Config.SNAPSHOT_BATCH,
+                # Rows can appear on the replica up to REPLICA_MAX_LAG after their updated_at
+                overlap=5.0 + (Config.REPLICA_MAX_LAG if replica_db else 0),
+                rebuild_interval=Config.SNAPSHOT_REBUILD_INTERVAL
+            )
+        return _users_snapshot
+
+@app.get("/api/admin/analytics")
+@limiter.limit("100 per hour")
+def get_admin_analytics():
+    """Talktime distribution, login recency and signup cohorts (admin only)."""
+    verify_admin_token()
+    if not supabase:
+        raise AppError("Supabase connection is required", status_code=503)
+
+    snapshot = get_users_snapshot()
+    snapshot.columns()
+    refresh = request.args.get("refresh") == "full"
+    if refresh or time.time() - snapshot.meta.get("synced_at", 0) > Config.SNAPSHOT_SYNC_INTERVAL:
+        try:
+            snapshot.sync(expected_rows=load_user_totals()["total_users"], force_rebuild=refresh, source=read_db())
+        except Exception as e:
+            # Serve the last good snapshot rather than failing the dashboard
+            logger.error(f"Users snapshot sync failed: {e}")
+
+    analytics = snapshot.analytics()
+    analytics["online_now"] = online_count()
+    return jsonify({"ok": True, "analytics": analytics})
+
+METRIC_DEFAULT_RANGE = {"minute": 3600, "hour": 2 * 86400, "day": 30 * 86400}
+
+def _parse_time_arg(name: str) -> Optional[float]:
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise AppError(f"{name} must be an ISO 8601 timestamp", status_code=400)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+@app.get("/api/admin/timeseries")
+@limiter.limit("300 per hour")
+def get_admin_timeseries():
+    """Counters over time (admin only).
+
+    Query: metrics (comma list, default all), granularity (minute|hour|day),
+    from / to (ISO 8601, default a range suited to the granularity).
+    """
+    verify_admin_token()
+    granularity = request.args.get("granularity", "hour")
+    if granularity not in METRIC_GRANULARITY_SECONDS:
+        raise AppError("granularity must be minute, hour or day", status_code=400)
+    metrics = [m.strip() for m in (request.args.get("metrics") or ",".join(METRICS)).split(",") if m.strip()]
+    unknown = [m for m in metrics if m not in METRICS]
+    if unknown:
+        raise AppError(f"Unknown metrics: {', '.join(unknown)}", status_code=400)
+
+    end = _parse_time_arg("to") or time.time()
+    start = _parse_time_arg("from") or end - METRIC_DEFAULT_RANGE[granularity]
+    if start > end:
+        raise AppError("from must be before to", status_code=400)
+    if (end - start) / METRIC_GRANULARITY_SECONDS[granularity] > METRICS_MAX_POINTS:
+        raise AppError(f"Range too large (max {METRICS_MAX_POINTS} {granularity} buckets)", status_code=400)
+
+    try:
+        result = metric_series(metrics, granularity, start, end)
+    except AppError:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to load time series: {e}")
+        raise AppError("Database error", status_code=500)
+    return jsonify({"ok": True, **result})
+
+@app.get("/api/admin/metrics")
+@limiter.limit("100 per hour")
+def get_admin_metrics():
+    """Internal counters for the worker process that served this request (admin only)."""
+    verify_admin_token()
+    return jsonify({
+        "ok": True,
+        "pid": os.getpid(),
+        "user_cache": user_cache.snapshot(),
+        "write_behind": deferred_user_writes.snapshot(),
+        "sse_connections": user_events.connections()
+    })
+
 @app.post("/api/admin/users/<email>/talktime")
 @limiter.limit("100 per hour")
 def update_user_talktime(email: str):
@@ -2320,27 +5020,26 @@ def update_user_talktime(email: str):
         raise AppError("Amount cannot be negative", status_code=400)
     
     if action == "add":
-        success = add_talktime_to_user(email, amount)
+        new_talktime = add_talktime_to_user(email, amount)
         message = f"Added {amount} seconds ({amount//60} minutes) of talktime to {email}"
     elif action == "subtract":
-        success = add_talktime_to_user(email, -amount)
+        new_talktime = add_talktime_to_user(email, -amount)
         message = f"Subtracted {amount} seconds ({amount//60} minutes) of talktime from {email}"
     elif action == "set":
-        success = set_user_talktime(email, amount)
+        new_talktime = set_user_talktime(email, amount)
         message = f"Set talktime to {amount} seconds ({amount//60} minutes) for {email}"
     else:
         raise AppError("Invalid action. Use 'add', 'subtract', or 'set'", status_code=400)
     
-    if success:
-        user = get_user(email)
-        return jsonify({
-            "ok": True,
-            "message": message,
-            "new_talktime": user.get("talktime", 0) if user else 0,
-            "new_talktime_minutes": round((user.get("talktime", 0) if user else 0) / 60, 2)
-        })
-    else:
-        raise AppError("Failed to update talktime", status_code=500)
+    if new_talktime is None:
+        raise AppError("User not found", status_code=404)
+    
+    return jsonify({
+        "ok": True,
+        "message": message,
+        "new_talktime": new_talktime,
+        "new_talktime_minutes": round(new_talktime / 60, 2)
+    })
 
 @app.delete("/api/admin/users/<email>")
 @limiter.limit("50 per hour")
@@ -2371,7 +5070,7 @@ def reset_user_data(email: str):
     data = request.get_json(silent=True) or {}
     reset_type = data.get("type", "all")  # "talktime", "sessions", or "all"
     
-    user = get_user(email)
+    user = get_user(email, "exists")
     if not user:
         raise AppError("User not found", status_code=404)
     
@@ -2379,10 +5078,12 @@ def reset_user_data(email: str):
         update_user(email, {"talktime": 0})
         message = f"Reset talktime for {email}"
     elif reset_type == "sessions":
-        update_user(email, {"sessions": [], "total_sessions": 0})
+        clear_user_sessions(email)
+        update_user(email, {"total_sessions": 0})
         message = f"Reset sessions for {email}"
     elif reset_type == "all":
-        update_user(email, {"talktime": 0, "sessions": [], "total_sessions": 0})
+        clear_user_sessions(email)
+        update_user(email, {"talktime": 0, "total_sessions": 0})
         message = f"Reset all data for {email}"
     else:
         raise AppError("Invalid reset type. Use 'talktime', 'sessions', or 'all'", status_code=400)
@@ -2409,7 +5110,7 @@ def toggle_vip_endpoint(email: str):
     verify_admin_token()
     if not validate_email(email): raise AppError("Invalid email", status_code=400)
     
-    user = get_user(email)
+    user = get_user(email, "balance")
     if not user: raise AppError("User not found", status_code=404)
     
     current_status = user.get("is_community_member", False)
@@ -2430,81 +5131,138 @@ def toggle_vip_endpoint(email: str):
     status_msg = "Promoted to Community Member" if new_status else "Removed from Community Member"
     return jsonify({"ok": True, "message": f"{email} {status_msg}", "is_community_member": new_status})
 
+RISK_LEVELS = {3: "high", 2: "medium", 1: "low"}
+
 @app.get("/api/admin/flagged-users")
-@limiter.limit("100 per hour")
+@limiter.limit("300 per hour")
 def get_flagged_users():
-    """Get all flagged users (admin only)."""
+    """One page of flagged users, highest risk and most recent flag first (admin only).
+
+    Query: limit, cursor. Reads the partial index from db_scripts/flagged_users.sql.
+    """
     verify_admin_token()
-    users = load_users()
-    
-    flagged_users = []
+    if not supabase:
+        raise AppError("Supabase connection is required", status_code=503)
+
+    try:
+        limit = int(request.args.get("limit", ADMIN_LIST_DEFAULT_LIMIT))
+    except ValueError:
+        raise AppError("limit must be an integer", status_code=400)
+    limit = max(1, min(limit, ADMIN_LIST_MAX_LIMIT))
+
+    params = {"p_limit": limit + 1}
+    cursor = request.args.get("cursor")
+    if cursor:
+        key, after_email = _decode_list_cursor(cursor, "flagged")
+        if not isinstance(key, list) or len(key) != 2:
+            raise AppError("Invalid cursor", status_code=400)
+        params.update({"p_after_rank": key[0], "p_after_flag": key[1], "p_after_email": after_email})
+
+    try:
+        db = read_db()
+        rows = db.rpc("admin_flagged_users", params).execute().data or []
+        count_rows = db.rpc("admin_flagged_counts", {}).execute().data or []
+    except Exception as e:
+        logger.error(f"Failed to load flagged users: {e}")
+        raise AppError("Database error", status_code=500)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    counts = {level: 0 for level in RISK_LEVELS.values()}
+    for row in count_rows:
+        counts[RISK_LEVELS.get(row.get("risk_rank"), "low")] += int(row.get("total") or 0)
+
     now = datetime.now(timezone.utc)
-    
-    for email, user_data in users.items():
-        is_flagged = user_data.get("is_flagged", False)
-        if not is_flagged:
-            continue
-        
-        risk_flags = user_data.get("risk_flags", [])
-        if not isinstance(risk_flags, list):
-            risk_flags = []
-        
-        highest_risk_level = user_data.get("highest_risk_level", "low")
-        last_risk_flag = user_data.get("last_risk_flag")
-        
+    flagged_users = []
+    for row in rows:
         # Calculate time since last flag
         time_since_flag = None
+        last_risk_flag = row.get("last_risk_flag")
         if last_risk_flag:
             try:
-                if isinstance(last_risk_flag, str):
-                    if last_risk_flag.endswith('Z'):
-                        flag_time = datetime.fromisoformat(last_risk_flag.replace('Z', '+00:00'))
-                    else:
-                        flag_time = datetime.fromisoformat(last_risk_flag)
-                    if flag_time.tzinfo is None:
-                        flag_time = flag_time.replace(tzinfo=timezone.utc)
-                    time_since_flag = (now - flag_time).total_seconds() / 3600  # Hours
+                flag_time = datetime.fromisoformat(last_risk_flag.replace('Z', '+00:00'))
+                if flag_time.tzinfo is None:
+                    flag_time = flag_time.replace(tzinfo=timezone.utc)
+                time_since_flag = (now - flag_time).total_seconds() / 3600  # Hours
             except Exception:
                 pass
-        
+
         flagged_users.append({
-            "email": user_data.get("email", email),
-            "talktime": user_data.get("talktime", 0),
-            "is_community_member": user_data.get("is_community_member", False),
-            "created_at": user_data.get("created_at", "Unknown"),
-            "last_login": user_data.get("last_login", "Never"),
-            "total_sessions": user_data.get("total_sessions", 0),
+            "email": row["email"],
+            "talktime": row.get("talktime") or 0,
+            "is_community_member": row.get("is_community_member", False),
+            "created_at": row.get("created_at") or "Unknown",
+            "last_login": row.get("last_login") or "Never",
+            "total_sessions": row.get("total_sessions", 0),
             # Risk information
             "is_flagged": True,
-            "risk_flag_count": len(risk_flags),
-            "highest_risk_level": highest_risk_level,
+            "risk_flag_count": row.get("risk_flag_count", 0),
+            "highest_risk_level": row.get("highest_risk_level") or "low",
             "last_risk_flag": last_risk_flag,
             "time_since_flag_hours": round(time_since_flag, 1) if time_since_flag else None,
-            "all_risk_flags": risk_flags  # All flags for detailed view
+            "latest_risk_flag": row.get("latest_risk_flag")  # Full history: /api/admin/users/<email>
         })
-    
-    # Sort by risk level (high first), then by most recent flag
-    flagged_users.sort(key=lambda x: (
-        {"high": 3, "medium": 2, "low": 1}.get(x["highest_risk_level"], 0),
-        x["last_risk_flag"] or ""
-    ), reverse=True)
-    
-    high_risk = [u for u in flagged_users if u["highest_risk_level"] == "high"]
-    medium_risk = [u for u in flagged_users if u["highest_risk_level"] == "medium"]
-    low_risk = [u for u in flagged_users if u["highest_risk_level"] == "low"]
-    
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        next_cursor = _encode_list_cursor("flagged", {
+            "sort_key": [last.get("risk_rank"), last.get("flagged_at")],
+            "email": last["email"]
+        })
+
     return jsonify({
         "ok": True,
         "flagged_users": flagged_users,
-        "total_flagged": len(flagged_users),
-        "high_risk_count": len(high_risk),
-        "medium_risk_count": len(medium_risk),
-        "low_risk_count": len(low_risk),
-        "high_risk_users": high_risk,
-        "medium_risk_users": medium_risk,
-        "low_risk_users": low_risk
+        "next_cursor": next_cursor,
+        "has_more": has_more,
+        "total_flagged": sum(counts.values()),
+        "high_risk_count": counts["high"],
+        "medium_risk_count": counts["medium"],
+        "low_risk_count": counts["low"]
     })
 
+@app.get("/api/admin/risk-flags")
+@limiter.limit("300 per hour")
+def get_risk_flag_feed():
+    """Risk flags newest first, read straight from the risk_flags table (admin only).
+
+    Query: level, email, limit, cursor.
+    """
+    verify_admin_token()
+    if not supabase:
+        raise AppError("Supabase connection is required", status_code=503)
+
+    level = request.args.get("level") or None
+    if level is not None and level not in RISK_LEVELS.values():
+        raise AppError("level must be high, medium or low", status_code=400)
+    email = (request.args.get("email") or "").strip().lower() or None
+    try:
+        limit = max(1, min(int(request.args.get("limit", ADMIN_LIST_DEFAULT_LIMIT)), ADMIN_LIST_MAX_LIMIT))
+    except ValueError:
+        raise AppError("limit must be an integer", status_code=400)
+
+    before = None
+    cursor = request.args.get("cursor")
+    if cursor:
+        before = _decode_created_id_cursor(cursor, "risk_flags")
+
+    try:
+        rows = get_risk_flags(email=email, level=level, limit=limit + 1, before=before)
+    except Exception as e:
+        logger.error(f"Failed to load risk flags: {e}")
+        raise AppError("Database error", status_code=500)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = None
+    if has_more:
+        next_cursor = _encode_list_cursor("risk_flags", {
+            "sort_key": [rows[-1]["created_at"], rows[-1]["id"]],
+            "email": rows[-1]["email"]
+        })
+    return jsonify({"ok": True, "risk_flags": rows, "next_cursor": next_cursor, "has_more": has_more})
+
 @app.post("/api/admin/users/<email>/clear-flag")
 @limiter.limit("50 per hour")
 def clear_user_flag(email: str):
@@ -2512,13 +5270,14 @@ def clear_user_flag(email: str):
     verify_admin_token()
     if not validate_email(email): raise AppError("Invalid email", status_code=400)
     
-    user = get_user(email)
+    user = get_user(email, "exists")
     if not user: raise AppError("User not found", status_code=404)
     
     update_user(email, {
         "is_flagged": False,
-        "highest_risk_level": "low"
-        # Keep risk_flags for audit trail, just clear the active flag
+        "highest_risk_level": "low",
+        "risk_flag_count": 0
+        # Keep the risk_flags rows for audit trail, just clear the active flag
     })
     
     logger.info(f"Admin cleared risk flag for {email}")
@@ -2554,14 +5313,16 @@ def google_auth():
             raise AppError("Email not found in Google credential", status_code=400)
         
         # Check if user exists in Supabase
-        user = get_user(email)
+        user = get_user(email, "auth")
         
         if user:
             # Existing user: Update login time and name
-            update_user(email, {
-                "last_login": datetime.now(timezone.utc).isoformat(),
-                "name": name or user.get("name")
+            update_user_deferred(email, {
+                "last_login": datetime.now(timezone.utc).isoformat()
             })
+            mark_active(email)
+            if name and name != user.get("name"):
+                update_user(email, {"name": name})
             logger.info(f"Google user logged in: {email}")
             
             # Generate app JWT token
@@ -2596,7 +5357,6 @@ def google_auth():
                 "talktime": talktime,
                 "created_at": now_iso,
                 "last_login": now_iso,
-                "sessions": [],
                 "total_sessions": 0,
                 "welcome_bonus_given": True,
                 "welcome_bonus_date": now_iso,
@@ -2604,7 +5364,8 @@ def google_auth():
                 "last_community_refill": last_refill  # Set for community members so they don't get extra refill
             }
             
-            update_user(email, user_data)
+            create_user(email, user_data)
+            mark_active(email)
             
             # Remove from pending list if they were there
             if is_pending_community:
@@ -0,0 +1,93 @@
+import re
+from typing import Any, Callable, List, Tuple, Union
+
+# PostgREST query syntax shared by the direct database backends
+# (postgres_backend.py, sqlite_backend.py): select lists with embeds and the
+# or_() logic strings the keyset cursors build. Each backend turns the parsed
+# filters into its own SQL dialect.
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_EMBED = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)\((.*)\)$", re.S)
+_LOGIC = re.compile(r"^(and|or)\((.*)\)$", re.S)
+
+IS_VALUES = {"null": "NULL", "true": "TRUE", "false": "FALSE", "unknown": "UNKNOWN"}
+
+class TransactionAborted(RuntimeError):
+    """A statement failed inside transaction() and the error was handled; nothing was committed."""
+
+# (sql, params) for one filter: condition(column, op, value)
+Condition = Callable[[str, str, Any], Tuple[str, List[Any]]]
+
+def ident(name: str) -> str:
+    """Quote a validated column/table name."""
+    if not _IDENTIFIER.match(name or ""):
+        raise ValueError(f"Invalid identifier: {name!r}")
+    return f'"{name}"'
+
+def split_top(text: str) -> List[str]:
+    """Split on commas outside parentheses and double quotes."""
+    parts, depth, quoted, start, i = [], 0, False, 0, 0
+    while i < len(text):
+        ch = text[i]
+        if quoted:
+            if ch == "\\":
+                i += 1
+            elif ch == '"':
+                quoted = False
+        elif ch == '"':
+            quoted = True
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(text[start:])
+    return [p.strip() for p in parts if p.strip()]
+
+def unquote(value: str) -> str:
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return re.sub(r'\\(.)', r'\1', value[1:-1])
+    return value
+
+def is_literal(value: Any) -> str:
+    """SQL literal for an is_() filter value."""
+    key = "null" if value is None else str(value).lower()
+    if key not in IS_VALUES:
+        raise ValueError(f"Unsupported is value: {value!r}")
+    return IS_VALUES[key]
+
+def parse_logic(text: str, condition: Condition, joiner: str = "OR") -> Tuple[str, List[Any]]:
+    """Parse a PostgREST logic string, e.g. 'a.lt."x",and(a.eq."x",id.lt.5)'."""
+    clauses, params = [], []
+    for term in split_top(text):
+        nested = _LOGIC.match(term)
+        if nested:
+            clause, values = parse_logic(nested.group(2), condition, nested.group(1).upper())
+        else:
+            column, op, value = term.split(".", 2)
+            if op == "in":
+                value = [unquote(v) for v in split_top(value.strip("()"))]
+            else:
+                value = unquote(value)
+            clause, values = condition(column, op, value)
+        clauses.append(clause)
+        params.extend(values)
+    return "(" + f" {joiner} ".join(clauses) + ")", params
+
+def parse_select(columns: str) -> List[Union[str, Tuple[str, str]]]:
+    """Select list items: "*", a column name, or (embedded table, its select list)."""
+    items: List[Union[str, Tuple[str, str]]] = []
+    for item in split_top(columns or "*"):
+        embed = _EMBED.match(item)
+        if embed:
+            ident(embed.group(1))
+            items.append((embed.group(1), embed.group(2)))
+        elif item == "*":
+            items.append(item)
+        else:
+            ident(item)
+            items.append(item)
+    return items
@@ -0,0 +1,42 @@
+-- ==========================================
+-- Admin Stats Aggregate
+-- ==========================================
+-- Run this in your Supabase SQL Editor
+--
+-- /api/admin/stats calls admin_user_stats() instead of downloading the whole
+-- users table and summing it in Python. One row comes back whatever the table
+-- size; the app caches it in Redis for ADMIN_STATS_CACHE_TTL seconds.
+-- Online / daily-active counts come from the Redis presence index, not here.
+-- Needs the is_flagged column from admin_user_listing.sql and the
+-- user_balances table from user_balances.sql.
+-- ==========================================
+
+-- Superseded by this function; it summed users.talktime, which is no longer written
+DROP VIEW IF EXISTS public.user_stats;
+
+CREATE OR REPLACE FUNCTION public.admin_user_stats()
+RETURNS TABLE (
+    total_users BIGINT,
+    total_talktime NUMERIC,
+    total_sessions BIGINT,
+    community_members BIGINT,
+    flagged_users BIGINT
+)
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT
+    COUNT(*),
+    (SELECT COALESCE(SUM(b.talktime), 0) FROM public.user_balances b)::NUMERIC,
+    COALESCE(SUM(total_sessions), 0)::BIGINT,
+    COUNT(*) FILTER (WHERE is_community_member),
+    COUNT(*) FILTER (WHERE is_flagged)
+  FROM public.users;
+$$;
+
+-- ==========================================
+-- VERIFICATION QUERIES
+-- ==========================================
+
+-- SELECT * FROM public.admin_user_stats();
+-- EXPLAIN ANALYZE SELECT * FROM public.admin_user_stats();
@@ -0,0 +1,133 @@
+-- ==========================================
+-- Admin User Listing (keyset pagination)
+-- ==========================================
+-- Run this in your Supabase SQL Editor (after user_balances.sql)
+--
+-- /api/admin/users pages through users with admin_list_users(). The cursor
+-- is (sort key, email), so every page is one range scan on the matching index
+-- and page 500 costs the same as page 1. Filters run in the database too.
+-- Rows carry a compact summary; session and flag history are only read by
+-- /api/admin/users/<email>.
+-- ==========================================
+
+-- 1. Risk columns written by the app (no-op if they already exist)
+ALTER TABLE public.users
+ADD COLUMN IF NOT EXISTS is_flagged BOOLEAN DEFAULT FALSE,
+ADD COLUMN IF NOT EXISTS risk_flags JSONB DEFAULT '[]'::jsonb,
+ADD COLUMN IF NOT EXISTS highest_risk_level TEXT,
+ADD COLUMN IF NOT EXISTS last_risk_flag TIMESTAMPTZ,
+ADD COLUMN IF NOT EXISTS risk_flag_count INTEGER DEFAULT 0;
+
+-- 2. One index per sort, matching its ORDER BY (email breaks ties). The
+--    talktime sort has none: talktime lives in user_balances, where an index
+--    on it would turn every billing write into a non-HOT update.
+CREATE INDEX IF NOT EXISTS idx_users_recent_keyset
+ON public.users ((COALESCE(last_login, '-infinity'::timestamptz)) DESC, email DESC);
+
+CREATE INDEX IF NOT EXISTS idx_users_created_keyset
+ON public.users (created_at DESC, email DESC);
+
+-- 3. Email prefix filter (email LIKE 'abc%'); the 'email' sort uses the unique index
+CREATE INDEX IF NOT EXISTS idx_users_email_prefix
+ON public.users (email text_pattern_ops);
+
+-- 4. One page of users
+--    p_sort:        'recent' (last_login), 'talktime', 'created' or 'email'
+--    p_after_key /
+--    p_after_email: cursor from the last row of the previous page (sort_key, email)
+--    p_emails /
+--    p_exclude_emails: include / exclude these emails (online filter, from the Redis presence index)
+--    p_email_prefix: case-insensitive email prefix
+CREATE OR REPLACE FUNCTION public.admin_list_users(
+    p_sort TEXT DEFAULT 'recent',
+    p_limit INTEGER DEFAULT 50,
+    p_after_key TEXT DEFAULT NULL,
+    p_after_email TEXT DEFAULT NULL,
+    p_community BOOLEAN DEFAULT NULL,
+    p_flagged BOOLEAN DEFAULT NULL,
+    p_emails TEXT[] DEFAULT NULL,
+    p_exclude_emails TEXT[] DEFAULT NULL,
+    p_email_prefix TEXT DEFAULT NULL
+)
+RETURNS TABLE (
+    email TEXT,
+    talktime NUMERIC,
+    is_community_member BOOLEAN,
+    created_at TIMESTAMPTZ,
+    last_login TIMESTAMPTZ,
+    total_sessions INTEGER,
+    is_flagged BOOLEAN,
+    highest_risk_level TEXT,
+    last_risk_flag TIMESTAMPTZ,
+    risk_flag_count INTEGER,
+    last_community_refill TIMESTAMPTZ,
+    welcome_bonus_given BOOLEAN,
+    updated_at TIMESTAMPTZ,
+    sort_key TEXT
+)
+LANGUAGE plpgsql
+STABLE
+AS $$
+DECLARE
+    v_key TEXT;
+    v_type TEXT;
+    v_dir TEXT := 'DESC';
+    v_cmp TEXT := '<';
+    v_pattern TEXT;
+BEGIN
+    CASE p_sort
+        WHEN 'recent' THEN
+            v_key := 'COALESCE(u.last_login, ''-infinity''::timestamptz)'; v_type := 'timestamptz';
+        WHEN 'talktime' THEN
+            v_key := 'COALESCE(b.talktime, 0)'; v_type := 'numeric';
+        WHEN 'created' THEN
+            v_key := 'u.created_at'; v_type := 'timestamptz';
+        WHEN 'email' THEN
+            v_key := 'u.email'; v_type := 'text'; v_dir := 'ASC'; v_cmp := '>';
+        ELSE
+            RAISE EXCEPTION 'Unknown sort: %', p_sort;
+    END CASE;
+
+    IF p_email_prefix IS NOT NULL AND p_email_prefix <> '' THEN
+        v_pattern := replace(replace(replace(lower(p_email_prefix), '\', '\\'), '%', '\%'), '_', '\_') || '%';
+    END IF;
+
+    RETURN QUERY EXECUTE format($q$
+        SELECT
+            u.email::TEXT,
+            COALESCE(b.talktime, 0)::NUMERIC,
+            COALESCE(u.is_community_member, FALSE),
+            u.created_at,
+            u.last_login,
+            COALESCE(u.total_sessions, 0)::INTEGER,
+            COALESCE(u.is_flagged, FALSE),
+            u.highest_risk_level::TEXT,
+            u.last_risk_flag,
+            COALESCE(u.risk_flag_count, 0)::INTEGER,
+            u.last_community_refill,
+            COALESCE(u.welcome_bonus_given, FALSE),
+            u.updated_at,
+            (%1$s)::TEXT
+        FROM public.users u
+        LEFT JOIN public.user_balances b ON b.email = u.email
+        WHERE ($1 IS NULL OR (%1$s, u.email) %3$s ($1::%4$s, $2))
+          AND ($3 IS NULL OR COALESCE(u.is_community_member, FALSE) = $3)
+          AND ($4 IS NULL OR COALESCE(u.is_flagged, FALSE) = $4)
+          AND ($5 IS NULL OR u.email = ANY($5))
+          AND ($6 IS NULL OR u.email <> ALL($6))
+          AND ($7 IS NULL OR u.email LIKE $7)
+        ORDER BY %1$s %2$s, u.email %2$s
+        LIMIT $8
+    $q$, v_key, v_dir, v_cmp, v_type)
+    USING p_after_key, p_after_email, p_community, p_flagged, p_emails, p_exclude_emails, v_pattern,
+          LEAST(GREATEST(p_limit, 1), 500);
+END;
+$$;
+
+-- ==========================================
+-- VERIFICATION QUERIES
+-- ==========================================
+
+-- SELECT * FROM public.admin_list_users('recent', 20);
+-- SELECT * FROM public.admin_list_users('talktime', 20, '900', 'someone@example.com');
+-- EXPLAIN ANALYZE SELECT * FROM public.admin_list_users('recent', 50, NULL, NULL, TRUE);
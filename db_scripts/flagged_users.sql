@@ -0,0 +1,54 @@
+-- ==========================================
+-- Flagged Users (partial index + paginated triage)
+-- ==========================================
+-- Run this in your Supabase SQL Editor (after admin_user_listing.sql)
+--
+-- /api/admin/flagged-users reads only flagged rows through a partial index
+-- ordered the way admins triage: highest risk first, most recent flag first.
+-- Cost follows the number of flagged users, not the size of users.
+--
+-- admin_flagged_users() itself lives in risk_flags.sql (run after this one).
+-- ==========================================
+
+-- 1. Risk level -> sortable rank (IMMUTABLE so it can be indexed)
+CREATE OR REPLACE FUNCTION public.risk_rank(p_level TEXT)
+RETURNS SMALLINT
+LANGUAGE sql
+IMMUTABLE
+AS $$
+  SELECT CASE p_level WHEN 'high' THEN 3 WHEN 'medium' THEN 2 ELSE 1 END::SMALLINT;
+$$;
+
+-- 2. Partial index: flagged rows only, in triage order
+CREATE INDEX IF NOT EXISTS idx_users_flagged_triage
+ON public.users (
+    public.risk_rank(highest_risk_level) DESC,
+    (COALESCE(last_risk_flag, '-infinity'::timestamptz)) DESC,
+    email DESC
+)
+WHERE is_flagged;
+
+-- 3. One page of flagged users: admin_flagged_users() is defined in
+--    risk_flags.sql. It reads talktime from user_balances and the latest flag
+--    from risk_flags. The version that used to be here read users.talktime
+--    and users.risk_flags, which are no longer written.
+
+-- 4. Flagged counts per risk level (index-only scan over the partial index)
+CREATE OR REPLACE FUNCTION public.admin_flagged_counts()
+RETURNS TABLE (risk_rank SMALLINT, total BIGINT)
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT public.risk_rank(u.highest_risk_level), COUNT(*)
+  FROM public.users u
+  WHERE u.is_flagged
+  GROUP BY 1;
+$$;
+
+-- ==========================================
+-- VERIFICATION QUERIES
+-- ==========================================
+
+-- SELECT * FROM public.admin_flagged_counts();
+-- SELECT email, highest_risk_level, last_risk_flag FROM public.admin_flagged_users(20);
+-- EXPLAIN ANALYZE SELECT * FROM public.admin_flagged_users(50);
@@ -0,0 +1,53 @@
+-- ==========================================
+-- Metric Rollups (admin time series)
+-- ==========================================
+-- Run this in your Supabase SQL Editor
+--
+-- The app counts events per minute in Redis (metrics:m:{minute}) and folds
+-- closed minutes into hourly and daily buckets. Those buckets are upserted
+-- here with their absolute values, so history survives Redis and
+-- /api/admin/timeseries range queries never touch the users table.
+-- ==========================================
+
+CREATE TABLE IF NOT EXISTS public.metric_rollups (
+    granularity TEXT NOT NULL CHECK (granularity IN ('hour', 'day')),
+    metric TEXT NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    value DOUBLE PRECISION NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW() NOT NULL,
+    PRIMARY KEY (granularity, metric, bucket)
+);
+
+ALTER TABLE public.metric_rollups ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Service role can manage metric rollups" ON public.metric_rollups
+    FOR ALL
+    USING (true)
+    WITH CHECK (true);
+
+-- Upsert bucket values. Counters only grow, so GREATEST keeps a bucket
+-- intact if Redis was restarted mid-bucket and reports a smaller total.
+--    p_rows: [{"granularity": "hour", "metric": "...", "bucket": "...", "value": 12}, ...]
+CREATE OR REPLACE FUNCTION public.upsert_metric_rollups(p_rows JSONB)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+  WITH upserted AS (
+    INSERT INTO public.metric_rollups AS m (granularity, metric, bucket, value)
+    SELECT r.granularity, r.metric, r.bucket, r.value
+    FROM jsonb_to_recordset(p_rows) AS r(granularity TEXT, metric TEXT, bucket TIMESTAMPTZ, value DOUBLE PRECISION)
+    ON CONFLICT (granularity, metric, bucket)
+    DO UPDATE SET value = GREATEST(m.value, EXCLUDED.value), updated_at = NOW()
+    RETURNING 1
+  )
+  SELECT COUNT(*)::INTEGER FROM upserted;
+$$;
+
+-- ==========================================
+-- VERIFICATION QUERIES
+-- ==========================================
+
+-- SELECT bucket, value FROM public.metric_rollups
+-- WHERE granularity = 'hour' AND metric = 'talktime_seconds'
+--   AND bucket >= NOW() - INTERVAL '2 days'
+-- ORDER BY bucket;
@@ -0,0 +1,42 @@
+-- ==========================================
+-- Read Replica Lag
+-- ==========================================
+-- Run this in your Supabase SQL Editor (on the primary; replicas get it
+-- through replication)
+--
+-- wal_position() returns a WAL position in bytes: on the primary the current
+-- write position, on a replica the position it has replayed up to. Every
+-- REPLICA_LAG_CHECK_INTERVAL seconds the app reads it from the primary and
+-- from READ_REPLICA_URL. The lag is how long ago the primary was at the
+-- replica's position, so a replica whose WAL receiver has disconnected falls
+-- behind as soon as the primary writes, while an idle primary does not make
+-- a caught-up replica look stale. Admin list, search, stats, flagged, export
+-- and analytics reads go to the replica only while the lag is at most
+-- REPLICA_MAX_LAG.
+--
+-- After an admin change the app stores the primary's position in Redis
+-- (replica:pin_lsn), and reads stay on the primary until the replica has
+-- replayed past it. NULL means a replica has not replayed anything since it
+-- started, and the app reads from the primary.
+-- ==========================================
+
+-- Replaced by wal_position()
+DROP FUNCTION IF EXISTS public.replica_lag_seconds();
+
+CREATE OR REPLACE FUNCTION public.wal_position()
+RETURNS NUMERIC
+LANGUAGE sql
+VOLATILE
+AS $$
+  SELECT pg_wal_lsn_diff(
+    CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END,
+    '0/0'
+  );
+$$;
+
+-- ==========================================
+-- VERIFICATION QUERIES
+-- ==========================================
+
+-- SELECT public.wal_position();                          -- on the primary: grows with every write
+-- SELECT pg_is_in_recovery(), public.wal_position();     -- on the replica: trails the primary's value
@@ -0,0 +1,185 @@
+-- ==========================================
+-- Risk Flags (one row per flag)
+-- ==========================================
+-- Run this in your Supabase SQL Editor (after flagged_users.sql and user_balances.sql)
+--
+-- Flags used to live in users.risk_flags, a JSONB array that upload_session
+-- read, appended to, trimmed to 50 and wrote back, recomputing
+-- highest_risk_level over the whole list in Python. Now a flag is one INSERT
+-- into risk_flags, and the users summary columns (is_flagged,
+-- highest_risk_level, last_risk_flag, risk_flag_count) are bumped
+-- incrementally in the same call.
+-- ==========================================
+
+-- 1. Flag table (rows go away with the user)
+CREATE TABLE IF NOT EXISTS public.risk_flags (
+    id BIGSERIAL PRIMARY KEY,
+    email TEXT NOT NULL REFERENCES public.users(email) ON DELETE CASCADE ON UPDATE CASCADE,
+    created_at TIMESTAMPTZ DEFAULT NOW() NOT NULL,
+    risk_level TEXT NOT NULL,
+    urgency TEXT,
+    details TEXT,
+    transcript_snippet TEXT
+);
+
+-- Per-user history, newest first
+CREATE INDEX IF NOT EXISTS idx_risk_flags_email_created
+ON public.risk_flags (email, created_at DESC, id DESC);
+
+-- Admin flag feed, all levels or one level
+CREATE INDEX IF NOT EXISTS idx_risk_flags_created
+ON public.risk_flags (created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_risk_flags_level_created
+ON public.risk_flags (risk_level, created_at DESC, id DESC);
+
+ALTER TABLE public.risk_flags ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Service role can manage risk flags" ON public.risk_flags
+    FOR ALL
+    USING (true)
+    WITH CHECK (true);
+
+-- 2. Flag count on the users row (no-op if admin_user_listing.sql added it)
+ALTER TABLE public.users
+ADD COLUMN IF NOT EXISTS risk_flag_count INTEGER DEFAULT 0;
+
+-- 3. Record a flag: insert + incremental summary update in one round trip
+--    highest_risk_level only ever moves up (clear-flag resets it to 'low'
+--    and risk_flag_count to 0).
+--    Returns no row if the user does not exist.
+CREATE OR REPLACE FUNCTION public.record_risk_flag(
+    p_email TEXT,
+    p_risk_level TEXT,
+    p_urgency TEXT DEFAULT NULL,
+    p_details TEXT DEFAULT NULL,
+    p_transcript_snippet TEXT DEFAULT NULL
+)
+RETURNS TABLE (highest_level TEXT, flag_count INTEGER)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_level TEXT;
+    v_count INTEGER;
+BEGIN
+    UPDATE public.users u
+    SET is_flagged = TRUE,
+        last_risk_flag = NOW(),
+        highest_risk_level = CASE
+            WHEN public.risk_rank(p_risk_level) > public.risk_rank(u.highest_risk_level) THEN p_risk_level
+            ELSE COALESCE(u.highest_risk_level, p_risk_level)
+        END,
+        risk_flag_count = COALESCE(u.risk_flag_count, 0) + 1
+    WHERE u.email = lower(p_email)
+    RETURNING u.highest_risk_level, u.risk_flag_count INTO v_level, v_count;
+
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO public.risk_flags (email, risk_level, urgency, details, transcript_snippet)
+    VALUES (lower(p_email), p_risk_level, p_urgency, p_details, p_transcript_snippet);
+
+    RETURN QUERY SELECT v_level, v_count;
+END;
+$$;
+
+-- 4. Flagged triage page, latest flag read from risk_flags (replaces the JSONB version)
+CREATE OR REPLACE FUNCTION public.admin_flagged_users(
+    p_limit INTEGER DEFAULT 50,
+    p_after_rank SMALLINT DEFAULT NULL,
+    p_after_flag TIMESTAMPTZ DEFAULT NULL,
+    p_after_email TEXT DEFAULT NULL
+)
+RETURNS TABLE (
+    email TEXT,
+    talktime NUMERIC,
+    is_community_member BOOLEAN,
+    created_at TIMESTAMPTZ,
+    last_login TIMESTAMPTZ,
+    total_sessions INTEGER,
+    highest_risk_level TEXT,
+    last_risk_flag TIMESTAMPTZ,
+    risk_flag_count INTEGER,
+    latest_risk_flag JSONB,
+    risk_rank SMALLINT,
+    flagged_at TIMESTAMPTZ
+)
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT
+    u.email::TEXT,
+    COALESCE(b.talktime, 0)::NUMERIC,
+    COALESCE(u.is_community_member, FALSE),
+    u.created_at,
+    u.last_login,
+    COALESCE(u.total_sessions, 0)::INTEGER,
+    COALESCE(u.highest_risk_level, 'low')::TEXT,
+    u.last_risk_flag,
+    COALESCE(u.risk_flag_count, 0)::INTEGER,
+    (
+      SELECT jsonb_build_object(
+        'timestamp', f.created_at,
+        'risk_level', f.risk_level,
+        'urgency', f.urgency,
+        'details', f.details,
+        'transcript_snippet', f.transcript_snippet
+      )
+      FROM public.risk_flags f
+      WHERE f.email = u.email
+      ORDER BY f.created_at DESC, f.id DESC
+      LIMIT 1
+    ),
+    public.risk_rank(u.highest_risk_level),
+    COALESCE(u.last_risk_flag, '-infinity'::timestamptz)
+  FROM public.users u
+  LEFT JOIN public.user_balances b ON b.email = u.email
+  WHERE u.is_flagged
+    AND (p_after_email IS NULL OR
+         (public.risk_rank(u.highest_risk_level), COALESCE(u.last_risk_flag, '-infinity'::timestamptz), u.email)
+           < (p_after_rank, p_after_flag, p_after_email))
+  ORDER BY public.risk_rank(u.highest_risk_level) DESC,
+           COALESCE(u.last_risk_flag, '-infinity'::timestamptz) DESC,
+           u.email DESC
+  LIMIT LEAST(GREATEST(p_limit, 1), 500);
+$$;
+
+-- 5. One-time backfill from the old JSONB array (safe to re-run)
+INSERT INTO public.risk_flags (email, created_at, risk_level, urgency, details, transcript_snippet)
+SELECT
+    u.email,
+    COALESCE((f->>'timestamp')::timestamptz, u.last_risk_flag, u.updated_at),
+    COALESCE(f->>'risk_level', 'low'),
+    f->>'urgency',
+    f->>'details',
+    f->>'transcript_snippet'
+FROM public.users u
+CROSS JOIN LATERAL jsonb_array_elements(COALESCE(u.risk_flags, '[]'::jsonb)) AS f
+WHERE jsonb_typeof(u.risk_flags) = 'array'
+  AND NOT EXISTS (
+    SELECT 1 FROM public.risk_flags rf
+    WHERE rf.email = u.email
+      AND rf.created_at = COALESCE((f->>'timestamp')::timestamptz, u.last_risk_flag, u.updated_at)
+  );
+
+-- Only flagged users still at 0: a re-run must not restore a count that
+-- clear-flag reset
+UPDATE public.users u
+SET risk_flag_count = c.total
+FROM (SELECT email, COUNT(*)::INTEGER AS total FROM public.risk_flags GROUP BY email) c
+WHERE u.email = c.email
+  AND u.is_flagged
+  AND COALESCE(u.risk_flag_count, 0) = 0;
+
+-- After verifying the backfill, the old column can be emptied:
+-- UPDATE public.users SET risk_flags = '[]'::jsonb WHERE risk_flags <> '[]'::jsonb;
+
+-- ==========================================
+-- VERIFICATION QUERIES
+-- ==========================================
+
+-- SELECT * FROM public.record_risk_flag('test@example.com', 'medium', 'medium', 'test flag', 'snippet');
+-- SELECT * FROM public.risk_flags WHERE email = 'test@example.com' ORDER BY created_at DESC LIMIT 10;
+-- SELECT email, highest_risk_level, risk_flag_count FROM public.users WHERE is_flagged;
+-- EXPLAIN ANALYZE SELECT * FROM public.risk_flags WHERE risk_level = 'high' ORDER BY created_at DESC, id DESC LIMIT 50;
@@ -0,0 +1,152 @@
+-- ==========================================
+-- SQLite schema (DB_BACKEND=sqlite)
+-- ==========================================
+-- Applied automatically by sqlite_backend.py when it opens the database
+-- file; every statement is idempotent. This is the single-node/test
+-- counterpart of the Supabase scripts in this folder: same tables and
+-- columns the app reads and writes, with the RPC functions implemented in
+-- Python by the backend.
+--
+-- Type names matter: the backend decodes BOOLEAN columns to bool and JSON
+-- columns to Python objects. Timestamps are ISO-8601 UTC text, so they sort
+-- and compare as strings; '-infinity' sorts before all of them.
+-- ==========================================
+
+-- 1. Users (talktime and live-session fields live in user_balances)
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY DEFAULT (lower(hex(randomblob(4)) || '-' || hex(randomblob(2)) || '-4' || substr(hex(randomblob(2)), 2) || '-' || substr('89ab', 1 + abs(random()) % 4, 1) || substr(hex(randomblob(2)), 2) || '-' || hex(randomblob(6)))),
+    email TEXT NOT NULL UNIQUE,
+    name TEXT,
+    password_hash TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+    last_login TIMESTAMPTZ,
+    total_sessions INTEGER NOT NULL DEFAULT 0,
+    welcome_bonus_given BOOLEAN NOT NULL DEFAULT 0,
+    welcome_bonus_date TIMESTAMPTZ,
+    is_community_member BOOLEAN DEFAULT 0,
+    last_community_refill TIMESTAMPTZ,
+    is_flagged BOOLEAN DEFAULT 0,
+    highest_risk_level TEXT,
+    last_risk_flag TIMESTAMPTZ,
+    risk_flag_count INTEGER DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_users_recent_keyset ON users (COALESCE(last_login, '-infinity') DESC, email DESC);
+CREATE INDEX IF NOT EXISTS idx_users_created_keyset ON users (created_at DESC, email DESC);
+CREATE INDEX IF NOT EXISTS idx_users_updated ON users (updated_at, email);
+
+-- Same as update_users_updated_at in Postgres: bump unless the write set it
+CREATE TRIGGER IF NOT EXISTS users_updated_at
+AFTER UPDATE ON users
+FOR EACH ROW WHEN NEW.updated_at IS OLD.updated_at
+BEGIN
+    UPDATE users SET updated_at = strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now') WHERE rowid = NEW.rowid;
+END;
+
+-- 2. Balances (user_balances.sql)
+CREATE TABLE IF NOT EXISTS user_balances (
+    email TEXT PRIMARY KEY REFERENCES users(email) ON DELETE CASCADE ON UPDATE CASCADE,
+    talktime NUMERIC NOT NULL DEFAULT 0,
+    session_status TEXT,
+    last_active_heartbeat TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+    ledger_version INTEGER  -- newest ledger write-back stored (talktime_functions.sql)
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_balances_updated ON user_balances (updated_at, email);
+
+-- 3. Session history (user_sessions.sql)
+CREATE TABLE IF NOT EXISTS user_sessions (
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL REFERENCES users(email) ON DELETE CASCADE ON UPDATE CASCADE,
+    session_id TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+    duration INTEGER NOT NULL DEFAULT 0,
+    transcript_length INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_sessions_email_created ON user_sessions (email, created_at DESC, id DESC);
+
+-- 4. Risk flags (risk_flags.sql)
+CREATE TABLE IF NOT EXISTS risk_flags (
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL REFERENCES users(email) ON DELETE CASCADE ON UPDATE CASCADE,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+    risk_level TEXT NOT NULL,
+    urgency TEXT,
+    details TEXT,
+    transcript_snippet TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_risk_flags_email_created ON risk_flags (email, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_risk_flags_created ON risk_flags (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_risk_flags_level_created ON risk_flags (risk_level, created_at DESC, id DESC);
+
+-- 5. Blueprints
+CREATE TABLE IF NOT EXISTS blueprints (
+    id TEXT PRIMARY KEY,
+    user_email TEXT,
+    session_id TEXT,
+    content TEXT,
+    transcript TEXT,
+    created_at TIMESTAMPTZ DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+
+-- 6. Task queue and payments (claim_task_function.sql)
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY DEFAULT (lower(hex(randomblob(4)) || '-' || hex(randomblob(2)) || '-4' || substr(hex(randomblob(2)), 2) || '-' || substr('89ab', 1 + abs(random()) % 4, 1) || substr(hex(randomblob(2)), 2) || '-' || hex(randomblob(6)))),
+    type TEXT NOT NULL,
+    payload JSON NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    created_at TIMESTAMPTZ DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+    started_at TIMESTAMPTZ,
+    completed_at TIMESTAMPTZ,
+    error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_tasks_status_created ON tasks (status, created_at) WHERE status = 'pending';
+
+CREATE TABLE IF NOT EXISTS transactions (
+    id TEXT PRIMARY KEY DEFAULT (lower(hex(randomblob(4)) || '-' || hex(randomblob(2)) || '-4' || substr(hex(randomblob(2)), 2) || '-' || substr('89ab', 1 + abs(random()) % 4, 1) || substr(hex(randomblob(2)), 2) || '-' || hex(randomblob(6)))),
+    order_id TEXT UNIQUE NOT NULL,
+    email TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    status TEXT DEFAULT 'success',
+    created_at TIMESTAMPTZ DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+
+-- 7. Coupons and pre-approved members (coupon_codes.sql, pending_community_members.sql)
+CREATE TABLE IF NOT EXISTS coupon_codes (
+    code TEXT PRIMARY KEY,
+    max_uses INTEGER,
+    uses INTEGER DEFAULT 0,
+    is_active BOOLEAN DEFAULT 1,
+    expires_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+
+CREATE TABLE IF NOT EXISTS pending_community_members (
+    email TEXT PRIMARY KEY,
+    created_at TIMESTAMPTZ DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+    created_by TEXT,
+    notes TEXT
+);
+
+-- 8. Metric rollups (metric_rollups.sql)
+CREATE TABLE IF NOT EXISTS metric_rollups (
+    granularity TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    value REAL NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+    PRIMARY KEY (granularity, metric, bucket)
+);
+
+-- ==========================================
+-- VERIFICATION QUERIES (sqlite3 data/app.db)
+-- ==========================================
+
+-- PRAGMA journal_mode;   -- wal
+-- SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name;
+-- SELECT u.email, b.talktime FROM users u LEFT JOIN user_balances b USING (email) LIMIT 10;
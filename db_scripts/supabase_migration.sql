@@ -50,11 +50,6 @@ CREATE TRIGGER update_users_updated_at
     FOR EACH ROW
     EXECUTE FUNCTION update_updated_at_column();
 
--- Optional: Create a view for user statistics
-CREATE OR REPLACE VIEW user_stats AS
-SELECT 
-    COUNT(*) as total_users,
-    SUM(talktime) as total_talktime,
-    SUM(total_sessions) as total_sessions,
-    COUNT(CASE WHEN last_login >= CURRENT_DATE THEN 1 END) as active_today
-FROM users;
+-- The optional user_stats view that used to be here read users.talktime,
+-- which is no longer written (see user_balances.sql). Admin stats come from
+-- admin_user_stats() in admin_stats.sql, which drops the old view.
@@ -0,0 +1,132 @@
+-- ==========================================
+-- Atomic Talktime Functions
+-- ==========================================
+-- Run this in your Supabase SQL Editor (after user_balances.sql)
+--
+-- Every talktime mutation is a single UPDATE ... RETURNING, so concurrent
+-- writers (heartbeats, payments, admin changes) can no longer overwrite each
+-- other, and each mutation is one PostgREST round trip.
+-- Balances live in user_balances (narrow, HOT-updated; see user_balances.sql)
+-- and are clamped at zero. Functions return the new balance, or NULL if the
+-- user does not exist.
+--
+-- Redis ledger write-backs (BILLING_MODE=ledger) carry a version taken when
+-- the balance was read; user_balances.ledger_version keeps the newest one
+-- stored, and an older write-back is skipped. This stops a slow flush from
+-- overwriting the balance a settle has just written.
+-- ==========================================
+
+ALTER TABLE public.user_balances ADD COLUMN IF NOT EXISTS ledger_version BIGINT;
+
+-- 1. Deduct seconds (heartbeats, pending-time flush)
+CREATE OR REPLACE FUNCTION public.deduct_talktime(p_email TEXT, p_seconds NUMERIC)
+RETURNS NUMERIC
+LANGUAGE sql
+AS $$
+  UPDATE public.user_balances
+  SET talktime = GREATEST(0, talktime - GREATEST(0, p_seconds)), updated_at = NOW()
+  WHERE email = lower(p_email)
+  RETURNING talktime;
+$$;
+
+-- 2. Credit seconds (payments, admin add/subtract; negative values subtract)
+CREATE OR REPLACE FUNCTION public.credit_talktime(p_email TEXT, p_seconds NUMERIC)
+RETURNS NUMERIC
+LANGUAGE sql
+AS $$
+  UPDATE public.user_balances
+  SET talktime = GREATEST(0, talktime + p_seconds), updated_at = NOW()
+  WHERE email = lower(p_email)
+  RETURNING talktime;
+$$;
+
+-- 3. Set an absolute balance (admin set/reset, ledger settle with p_version).
+--    Returns NULL for a write-back older than the stored one.
+DROP FUNCTION IF EXISTS public.set_talktime(TEXT, NUMERIC);
+CREATE OR REPLACE FUNCTION public.set_talktime(p_email TEXT, p_seconds NUMERIC, p_version BIGINT DEFAULT NULL)
+RETURNS NUMERIC
+LANGUAGE sql
+AS $$
+  UPDATE public.user_balances
+  SET talktime = GREATEST(0, p_seconds),
+      ledger_version = COALESCE(p_version, ledger_version),
+      updated_at = NOW()
+  WHERE email = lower(p_email)
+    AND (p_version IS NULL OR ledger_version IS NULL OR ledger_version < p_version)
+  RETURNING talktime;
+$$;
+
+-- 4. Set many balances at once (Redis ledger write-back)
+--    p_balances: [{"email": "...", "talktime": 123.4, "version": 1760000000000000}, ...]
+--    Only updates existing users, unlike a bulk upsert; "version" is optional.
+CREATE OR REPLACE FUNCTION public.set_talktime_batch(p_balances JSONB)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+  WITH updated AS (
+    UPDATE public.user_balances u
+    SET talktime = GREATEST(0, b.talktime),
+        ledger_version = COALESCE(b.version, u.ledger_version),
+        updated_at = NOW()
+    FROM jsonb_to_recordset(p_balances) AS b(email TEXT, talktime NUMERIC, version BIGINT)
+    WHERE u.email = lower(b.email)
+      AND (b.version IS NULL OR u.ledger_version IS NULL OR u.ledger_version < b.version)
+    RETURNING 1
+  )
+  SELECT COUNT(*)::INTEGER FROM updated;
+$$;
+
+-- 5. Deduct from many users at once (session reaper)
+--    p_charges: [{"email": "...", "seconds": 12.5}, ...]
+--    Returns the new balance of every user that was charged.
+CREATE OR REPLACE FUNCTION public.deduct_talktime_batch(p_charges JSONB)
+RETURNS TABLE (email TEXT, talktime NUMERIC)
+LANGUAGE sql
+AS $$
+  UPDATE public.user_balances u
+  SET talktime = GREATEST(0, u.talktime - GREATEST(0, c.seconds)), updated_at = NOW()
+  FROM jsonb_to_recordset(p_charges) AS c(email TEXT, seconds NUMERIC)
+  WHERE u.email = lower(c.email)
+  RETURNING u.email, u.talktime;
+$$;
+
+-- 6. Debit up to p_seconds, never more than the balance (talktime leases)
+--    Returns how much was debited and the new balance, so the caller grants
+--    exactly what was paid for; no row if the user does not exist.
+CREATE OR REPLACE FUNCTION public.debit_talktime(p_email TEXT, p_seconds NUMERIC)
+RETURNS TABLE (debited NUMERIC, talktime NUMERIC)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_balance NUMERIC;
+    v_debit NUMERIC;
+BEGIN
+    SELECT b.talktime INTO v_balance
+    FROM public.user_balances b
+    WHERE b.email = lower(p_email)
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    v_debit := LEAST(GREATEST(0, v_balance), GREATEST(0, p_seconds));
+    UPDATE public.user_balances b
+    SET talktime = GREATEST(0, v_balance - v_debit), updated_at = NOW()
+    WHERE b.email = lower(p_email);
+
+    RETURN QUERY SELECT v_debit, GREATEST(0, v_balance - v_debit);
+END;
+$$;
+
+-- ==========================================
+-- VERIFICATION QUERIES
+-- ==========================================
+
+-- SELECT public.credit_talktime('test@example.com', 60);
+-- SELECT public.deduct_talktime('test@example.com', 2.5);
+-- SELECT public.set_talktime('test@example.com', 0);
+-- SELECT public.set_talktime('test@example.com', 30, 1);  -- NULL once a newer write-back was stored
+-- SELECT public.set_talktime_batch('[{"email": "test@example.com", "talktime": 30}]'::jsonb);
+-- SELECT * FROM public.deduct_talktime_batch('[{"email": "test@example.com", "seconds": 5}]'::jsonb);
+-- SELECT * FROM public.debit_talktime('test@example.com', 120);  -- debited <= the balance it had
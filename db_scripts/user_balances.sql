@@ -0,0 +1,61 @@
+-- ==========================================
+-- User Balances (narrow hot table)
+-- ==========================================
+-- Run this in your Supabase SQL Editor, BEFORE deploying the app that uses it
+--
+-- Every billing write (heartbeat, ledger write-back, lease settle) used to
+-- update the wide users row: a new version of the whole tuple, including
+-- password hash and profile columns, plus the update_users_updated_at trigger
+-- and a new entry in every users index. talktime and the live-session fields
+-- now live here instead: one short row per user, keyed by email, with no
+-- other index and spare room on each page (fillfactor), so these updates are
+-- HOT and vacuum has little to do.
+--
+-- Then re-run, in this order: talktime_functions.sql, admin_user_listing.sql,
+-- user_search.sql, risk_flags.sql, admin_stats.sql (they read talktime here).
+-- ==========================================
+
+-- 1. Balance table (rows go away with the user)
+CREATE TABLE IF NOT EXISTS public.user_balances (
+    email TEXT PRIMARY KEY REFERENCES public.users(email) ON DELETE CASCADE ON UPDATE CASCADE,
+    talktime NUMERIC DEFAULT 0 NOT NULL,
+    session_status TEXT,
+    last_active_heartbeat TIMESTAMPTZ,
+    -- Last talktime change (users snapshot watermark). Set by the writers, not a trigger.
+    updated_at TIMESTAMPTZ DEFAULT NOW() NOT NULL
+) WITH (fillfactor = 70);
+
+-- Small, very hot table: vacuum it often instead of waiting for 20% dead rows
+ALTER TABLE public.user_balances SET (
+    autovacuum_vacuum_scale_factor = 0.02,
+    autovacuum_analyze_scale_factor = 0.05
+);
+
+ALTER TABLE public.user_balances ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Service role can manage user balances" ON public.user_balances
+    FOR ALL
+    USING (true)
+    WITH CHECK (true);
+
+-- 2. Backfill from users (safe to re-run; existing balances win)
+INSERT INTO public.user_balances (email, talktime, updated_at)
+SELECT u.email, COALESCE(u.talktime, 0), COALESCE(u.updated_at, NOW())
+FROM public.users u
+ON CONFLICT (email) DO NOTHING;
+
+-- 3. users.talktime is no longer written; its sort index only costs writes now
+DROP INDEX IF EXISTS public.idx_users_talktime_keyset;
+
+-- Once nothing reads users.talktime any more (app and the scripts above):
+-- ALTER TABLE public.users DROP COLUMN talktime;
+
+-- ==========================================
+-- VERIFICATION QUERIES
+-- ==========================================
+
+-- SELECT COUNT(*) FROM public.users u LEFT JOIN public.user_balances b USING (email) WHERE b.email IS NULL;
+-- SELECT * FROM public.user_balances WHERE email = 'test@example.com';
+-- HOT ratio (should approach 100% once billing runs here):
+-- SELECT n_tup_upd, n_tup_hot_upd, round(100.0 * n_tup_hot_upd / NULLIF(n_tup_upd, 0), 1) AS hot_pct
+-- FROM pg_stat_user_tables WHERE relname IN ('users', 'user_balances');
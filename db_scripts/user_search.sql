@@ -0,0 +1,118 @@
+-- ==========================================
+-- Admin User Search (trigram + prefix)
+-- ==========================================
+-- Run this in your Supabase SQL Editor (after admin_user_listing.sql)
+--
+-- /api/admin/search finds users by email or name. Queries of 3+ characters
+-- match anywhere in the string through pg_trgm GIN indexes; shorter ones are
+-- prefix-only through the text_pattern_ops indexes. Prefix hits rank first.
+--
+-- Up to 101 rows per call: the app caches the first 100 matches of a query
+-- and asks for one more to know whether that result is complete
+-- (SEARCH_CACHE_DEPTH + 1 in app.py). Prefix and substring candidates are
+-- each cut to offset + limit in email order before the final sort, so a
+-- common substring never sorts the whole table.
+-- ==========================================
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- 1. Display name written by signup / Google login (no-op if it exists)
+ALTER TABLE public.users
+ADD COLUMN IF NOT EXISTS name TEXT;
+
+-- 2. Substring search
+CREATE INDEX IF NOT EXISTS idx_users_email_trgm
+ON public.users USING gin (email gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS idx_users_name_trgm
+ON public.users USING gin (lower(name) gin_trgm_ops);
+
+-- 3. Short (1-2 character) prefix search; email prefix uses idx_users_email_prefix
+CREATE INDEX IF NOT EXISTS idx_users_name_prefix
+ON public.users (lower(name) text_pattern_ops);
+
+-- 4. One page of matches, prefix matches first, then by email
+CREATE OR REPLACE FUNCTION public.admin_search_users(
+    p_query TEXT,
+    p_limit INTEGER DEFAULT 20,
+    p_offset INTEGER DEFAULT 0
+)
+RETURNS TABLE (
+    email TEXT,
+    name TEXT,
+    talktime NUMERIC,
+    is_community_member BOOLEAN,
+    created_at TIMESTAMPTZ,
+    last_login TIMESTAMPTZ,
+    total_sessions INTEGER,
+    is_flagged BOOLEAN,
+    highest_risk_level TEXT,
+    last_risk_flag TIMESTAMPTZ,
+    risk_flag_count INTEGER,
+    last_community_refill TIMESTAMPTZ,
+    welcome_bonus_given BOOLEAN,
+    updated_at TIMESTAMPTZ,
+    prefix_match BOOLEAN
+)
+LANGUAGE plpgsql
+STABLE
+AS $$
+DECLARE
+    v_term TEXT := replace(replace(replace(lower(trim(p_query)), '\', '\\'), '%', '\%'), '_', '\_');
+    v_prefix TEXT := v_term || '%';
+    v_pattern TEXT;
+    v_limit INTEGER := LEAST(GREATEST(p_limit, 1), 101);
+    v_offset INTEGER := LEAST(GREATEST(p_offset, 0), 1000);
+BEGIN
+    IF v_term = '' THEN
+        RETURN;
+    END IF;
+    v_pattern := CASE WHEN length(trim(p_query)) >= 3 THEN '%' || v_term || '%' ELSE v_prefix END;
+
+    RETURN QUERY
+    WITH candidates AS (
+        (SELECT u.email, TRUE AS is_prefix
+         FROM public.users u
+         WHERE u.email LIKE v_prefix OR lower(u.name) LIKE v_prefix
+         ORDER BY u.email
+         LIMIT v_offset + v_limit)
+        UNION ALL
+        (SELECT u.email, FALSE
+         FROM public.users u
+         WHERE v_pattern <> v_prefix
+           AND (u.email LIKE v_pattern OR lower(u.name) LIKE v_pattern)
+           AND (u.email LIKE v_prefix OR lower(u.name) LIKE v_prefix) IS NOT TRUE
+         ORDER BY u.email
+         LIMIT v_offset + v_limit)
+    )
+    SELECT
+        u.email::TEXT,
+        u.name::TEXT,
+        COALESCE(b.talktime, 0)::NUMERIC,
+        COALESCE(u.is_community_member, FALSE),
+        u.created_at,
+        u.last_login,
+        COALESCE(u.total_sessions, 0)::INTEGER,
+        COALESCE(u.is_flagged, FALSE),
+        u.highest_risk_level::TEXT,
+        u.last_risk_flag,
+        COALESCE(u.risk_flag_count, 0)::INTEGER,
+        u.last_community_refill,
+        COALESCE(u.welcome_bonus_given, FALSE),
+        u.updated_at,
+        c.is_prefix
+    FROM candidates c
+    JOIN public.users u ON u.email = c.email
+    LEFT JOIN public.user_balances b ON b.email = u.email
+    ORDER BY 15 DESC, u.email
+    LIMIT v_limit
+    OFFSET v_offset;
+END;
+$$;
+
+-- ==========================================
+-- VERIFICATION QUERIES
+-- ==========================================
+
+-- SELECT email, name, prefix_match FROM public.admin_search_users('ali');
+-- EXPLAIN ANALYZE SELECT * FROM public.admin_search_users('gmail');
@@ -0,0 +1,100 @@
+-- ==========================================
+-- User Sessions (append-only history)
+-- ==========================================
+-- Run this in your Supabase SQL Editor
+--
+-- Session history used to live in users.sessions, a JSONB array that was
+-- read, appended to, trimmed to 100 and written back on every care plan.
+-- Now each session is one INSERT into user_sessions, and
+-- users.total_sessions is bumped in the same call, so the users row no longer
+-- carries (or rewrites) the history.
+-- ==========================================
+
+-- 1. History table (rows go away with the user)
+CREATE TABLE IF NOT EXISTS public.user_sessions (
+    id BIGSERIAL PRIMARY KEY,
+    email TEXT NOT NULL REFERENCES public.users(email) ON DELETE CASCADE ON UPDATE CASCADE,
+    session_id TEXT,
+    created_at TIMESTAMPTZ DEFAULT NOW() NOT NULL,
+    duration INTEGER DEFAULT 0 NOT NULL,
+    transcript_length INTEGER DEFAULT 0 NOT NULL
+);
+
+-- Per-user history, newest first (id breaks ties for keyset paging)
+CREATE INDEX IF NOT EXISTS idx_user_sessions_email_created
+ON public.user_sessions (email, created_at DESC, id DESC);
+
+ALTER TABLE public.user_sessions ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Service role can manage user sessions" ON public.user_sessions
+    FOR ALL
+    USING (true)
+    WITH CHECK (true);
+
+-- 2. Record a session: append + atomic counter in one round trip
+--    Returns the new total_sessions, or NULL if the user does not exist.
+CREATE OR REPLACE FUNCTION public.record_user_session(
+    p_email TEXT,
+    p_session_id TEXT,
+    p_duration INTEGER DEFAULT 0,
+    p_transcript_length INTEGER DEFAULT 0
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_total INTEGER;
+BEGIN
+    UPDATE public.users
+    SET total_sessions = total_sessions + 1,
+        last_login = NOW()
+    WHERE email = lower(p_email)
+    RETURNING total_sessions INTO v_total;
+
+    IF v_total IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO public.user_sessions (email, session_id, duration, transcript_length)
+    VALUES (lower(p_email), p_session_id, COALESCE(p_duration, 0), COALESCE(p_transcript_length, 0));
+    RETURN v_total;
+END;
+$$;
+
+-- 3. Totals for the admin detail view
+CREATE OR REPLACE FUNCTION public.user_session_totals(p_email TEXT)
+RETURNS TABLE (sessions BIGINT, total_duration BIGINT)
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT COUNT(*), COALESCE(SUM(duration), 0)::BIGINT
+  FROM public.user_sessions
+  WHERE email = lower(p_email);
+$$;
+
+-- 4. One-time backfill from the old JSONB array (safe to re-run)
+INSERT INTO public.user_sessions (email, session_id, created_at, duration, transcript_length)
+SELECT
+    u.email,
+    s->>'session_id',
+    COALESCE((s->>'timestamp')::timestamptz, u.updated_at),
+    COALESCE((s->>'duration')::numeric, 0)::INTEGER,
+    COALESCE((s->>'transcript_length')::numeric, 0)::INTEGER
+FROM public.users u
+CROSS JOIN LATERAL jsonb_array_elements(COALESCE(u.sessions, '[]'::jsonb)) AS s
+WHERE jsonb_typeof(u.sessions) = 'array'
+  AND NOT EXISTS (
+    SELECT 1 FROM public.user_sessions us
+    WHERE us.email = u.email AND us.session_id IS NOT DISTINCT FROM s->>'session_id'
+  );
+
+-- After verifying the backfill, the old column can be emptied:
+-- UPDATE public.users SET sessions = '[]'::jsonb WHERE sessions <> '[]'::jsonb;
+
+-- ==========================================
+-- VERIFICATION QUERIES
+-- ==========================================
+
+-- SELECT public.record_user_session('test@example.com', 'abc12345', 42, 4200);
+-- SELECT * FROM public.user_sessions WHERE email = 'test@example.com' ORDER BY created_at DESC LIMIT 10;
+-- SELECT * FROM public.user_session_totals('test@example.com');
@@ -0,0 +1,52 @@
+-- ==========================================
+-- Write-Behind Flush (presence/audit fields)
+-- ==========================================
+-- Run this in your Supabase SQL Editor (after user_balances.sql)
+--
+-- The app's write-behind queue coalesces last_login, session_status and
+-- last_active_heartbeat per user and writes them with one call per batch.
+-- This is UPDATE only: a user deleted while their fields were queued is
+-- skipped, rather than recreated as a partial users row (as a bulk upsert
+-- did) or failing the whole batch on the user_balances foreign key.
+-- Only the keys present in each row are written, so an explicit null clears
+-- a field and a missing key leaves it alone.
+-- ==========================================
+
+-- p_rows: [{"email": "...", "last_login": "...", "session_status": "active"}, ...]
+-- Returns the number of users that were updated.
+CREATE OR REPLACE FUNCTION public.apply_deferred_user_writes(p_rows JSONB)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+  WITH changes AS (
+    SELECT lower(r->>'email') AS email, r
+    FROM jsonb_array_elements(p_rows) AS r
+  ),
+  users_updated AS (
+    UPDATE public.users u
+    SET last_login = (c.r->>'last_login')::TIMESTAMPTZ
+    FROM changes c
+    WHERE u.email = c.email AND c.r ? 'last_login'
+    RETURNING u.email
+  ),
+  balances_updated AS (
+    UPDATE public.user_balances b
+    SET session_status = CASE WHEN c.r ? 'session_status'
+                              THEN c.r->>'session_status' ELSE b.session_status END,
+        last_active_heartbeat = CASE WHEN c.r ? 'last_active_heartbeat'
+                                     THEN (c.r->>'last_active_heartbeat')::TIMESTAMPTZ
+                                     ELSE b.last_active_heartbeat END
+    FROM changes c
+    WHERE b.email = c.email AND (c.r ? 'session_status' OR c.r ? 'last_active_heartbeat')
+    RETURNING b.email
+  )
+  SELECT COUNT(DISTINCT email)::INTEGER
+  FROM (SELECT email FROM users_updated UNION ALL SELECT email FROM balances_updated) written;
+$$;
+
+-- ==========================================
+-- VERIFICATION QUERIES
+-- ==========================================
+
+-- SELECT public.apply_deferred_user_writes('[{"email": "test@example.com", "session_status": "ended"}]'::jsonb);
+-- SELECT public.apply_deferred_user_writes('[{"email": "nobody@example.com", "last_login": "2026-01-01T00:00:00Z"}]'::jsonb);  -- 0
@@ -39,3 +39,12 @@ raw_env = [
     "PYTHONUNBUFFERED=1",
     "JWT_SECRET_KEY=5f57340b7fab5f1f172c336ac35264defcaddc3a204800030fee17b445895ab9"
 ]
+
+
+def worker_exit(server, worker):
+    """Drain queued write-behind user updates before the worker exits."""
+    try:
+        from app import deferred_user_writes
+        deferred_user_writes.drain()
+    except Exception as e:
+        server.log.error(f"Write-behind drain failed: {e}")
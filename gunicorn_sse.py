@@ -0,0 +1,37 @@
+# Gunicorn Configuration for the live event stream (/api/events/stream)
+#
+# SSE connections sit idle for minutes at a time. On the main gthread server each
+# one would pin a thread, so the stream runs on its own gevent server where an
+# idle connection costs a greenlet and a socket.
+#
+#   gunicorn -c gunicorn_sse.py app:app
+#
+# Caddy routes /api/events/stream here (see Caddyfile); everything else, including
+# /api/events/ticket, stays on :5000.
+
+# Bind to localhost on port 5001 (Caddy will proxy to this)
+bind = "127.0.0.1:5001"
+
+# --- SCALING CONFIGURATION ---
+# A couple of processes are enough: each holds worker_connections streams
+workers = 2
+worker_class = "gevent"
+worker_connections = 5000
+
+# Streams are long-lived; the gevent worker keeps its heartbeat between requests
+timeout = 60
+keepalive = 75
+graceful_timeout = 10
+
+# Logging
+accesslog = "-"
+errorlog = "-"
+loglevel = "info"
+
+proc_name = "ronit-ai-events"
+reload = False
+
+raw_env = [
+    "FLASK_ENV=production",
+    "PYTHONUNBUFFERED=1",
+]
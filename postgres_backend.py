@@ -0,0 +1,474 @@
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Tuple, Callable
+
+from psycopg.pq import TransactionStatus
+from psycopg.rows import dict_row
+from psycopg.types.json import Json, Jsonb
+from psycopg_pool import ConnectionPool
+
+from db_query import TransactionAborted, ident, is_literal, parse_logic, parse_select
+
+# Direct Postgres backend (DB_BACKEND=postgres)
+# The subset of the supabase-py client the app uses -- table() with
+# select/insert/upsert/update/delete, the filters, order/limit, and rpc() --
+# run as SQL over a per-process psycopg connection pool instead of one
+# PostgREST HTTPS request per query. Results are built with json_agg in the
+# database, so .data has the same shape PostgREST returns (ISO timestamps,
+# embedded rows, scalar RPC results). Statements executed PG_PREPARE_THRESHOLD
+# times on a connection are server-side prepared; set it to "none" behind a
+# transaction-mode pooler (pgbouncer, Supabase port 6543).
+
+logger = logging.getLogger("app")
+
+_OPERATORS = {
+    "eq": "=", "neq": "<>", "gt": ">", "gte": ">=", "lt": "<", "lte": "<=",
+    "like": "LIKE", "ilike": "ILIKE",
+}
+
+def _condition(alias: str, column: str, op: str, value: Any) -> Tuple[str, List[Any]]:
+    """One PostgREST filter as SQL. Values are bound as parameters."""
+    col = f"{alias}.{ident(column)}"
+    if op == "is":
+        return f"{col} IS {is_literal(value)}", []
+    if op == "in":
+        values = list(value)
+        if not values:
+            return "FALSE", []
+        return f"{col} IN ({', '.join(['%s'] * len(values))})", values
+    if op not in _OPERATORS:
+        raise ValueError(f"Unsupported filter operator: {op}")
+    if op in ("like", "ilike"):
+        value = value.replace("*", "%")
+    return f"{col} {_OPERATORS[op]} %s", [value]
+
+def _adapt(value: Any, column_type: Optional[str]) -> Any:
+    if column_type == "jsonb" or (column_type is None and isinstance(value, dict)):
+        return Jsonb(value)
+    if column_type == "json":
+        return Json(value)
+    return value
+
+class Result:
+    """The fields of supabase-py's APIResponse the app reads."""
+    __slots__ = ("data", "count")
+
+    def __init__(self, data: Any, count: Optional[int] = None):
+        self.data = data
+        self.count = count
+
+class QueryBuilder:
+    """table(name) builder: one statement, run by execute()."""
+
+    def __init__(self, client: "PostgresClient", table: str):
+        self._client = client
+        self._table = table
+        self._action = "select"
+        self._columns = "*"
+        self._payload: Any = None
+        self._on_conflict: List[str] = []
+        self._ignore_duplicates = False
+        self._where: List[Tuple[str, List[Any]]] = []
+        self._order: List[str] = []
+        self._limit: Optional[int] = None
+        self._offset: Optional[int] = None
+
+    # ----- actions -----
+
+    def select(self, columns: str = "*", count: Optional[str] = None) -> "QueryBuilder":
+        if count is not None:
+            raise ValueError("count is not supported by the postgres backend")
+        self._columns = columns or "*"
+        return self
+
+    def insert(self, rows: Any) -> "QueryBuilder":
+        self._action, self._payload = "insert", rows
+        return self
+
+    def upsert(self, rows: Any, on_conflict: str = "", ignore_duplicates: bool = False) -> "QueryBuilder":
+        if not on_conflict:
+            raise ValueError("upsert needs on_conflict with the postgres backend")
+        self._action, self._payload = "upsert", rows
+        self._on_conflict = [c.strip() for c in on_conflict.split(",") if c.strip()]
+        self._ignore_duplicates = ignore_duplicates
+        return self
+
+    def update(self, values: Dict[str, Any]) -> "QueryBuilder":
+        self._action, self._payload = "update", values
+        return self
+
+    def delete(self) -> "QueryBuilder":
+        self._action = "delete"
+        return self
+
+    # ----- filters and modifiers -----
+
+    def _filter(self, column: str, op: str, value: Any) -> "QueryBuilder":
+        self._where.append(_condition("t", column, op, value))
+        return self
+
+    def eq(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "eq", value)
+
+    def neq(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "neq", value)
+
+    def gt(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "gt", value)
+
+    def gte(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "gte", value)
+
+    def lt(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "lt", value)
+
+    def lte(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "lte", value)
+
+    def like(self, column: str, pattern: str) -> "QueryBuilder":
+        return self._filter(column, "like", pattern)
+
+    def ilike(self, column: str, pattern: str) -> "QueryBuilder":
+        return self._filter(column, "ilike", pattern)
+
+    def in_(self, column: str, values) -> "QueryBuilder":
+        return self._filter(column, "in", values)
+
+    def is_(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "is", value)
+
+    def or_(self, filters: str) -> "QueryBuilder":
+        self._where.append(parse_logic(filters, lambda c, o, v: _condition("t", c, o, v)))
+        return self
+
+    def order(self, column: str, desc: bool = False, nullsfirst: Optional[bool] = None) -> "QueryBuilder":
+        clause = f"t.{ident(column)} {'DESC' if desc else 'ASC'}"
+        if nullsfirst is not None:
+            clause += " NULLS FIRST" if nullsfirst else " NULLS LAST"
+        self._order.append(clause)
+        return self
+
+    def limit(self, size: int) -> "QueryBuilder":
+        self._limit = int(size)
+        return self
+
+    def range(self, start: int, end: int) -> "QueryBuilder":
+        self._offset, self._limit = int(start), int(end) - int(start) + 1
+        return self
+
+    # ----- SQL -----
+
+    def _target(self) -> str:
+        return f"{ident(self._client.schema)}.{ident(self._table)} AS t"
+
+    def _where_sql(self) -> Tuple[str, List[Any]]:
+        if not self._where:
+            return "", []
+        params: List[Any] = []
+        for _, values in self._where:
+            params.extend(values)
+        return " WHERE " + " AND ".join(clause for clause, _ in self._where), params
+
+    def _select_list(self, table: str, alias: str, columns: str) -> str:
+        items = []
+        for item in parse_select(columns):
+            if isinstance(item, tuple):
+                items.append(f"{self._embed(table, alias, *item)} AS {ident(item[0])}")
+            elif item == "*":
+                items.append(f"{alias}.*")
+            else:
+                items.append(f"{alias}.{ident(item)}")
+        return ", ".join(items)
+
+    def _embed(self, parent: str, parent_alias: str, child: str, columns: str) -> str:
+        """Correlated subquery for an embedded resource: an object for to-one, an array for to-many."""
+        parent_columns, child_columns, single = self._client._relationship(parent, child)
+        alias = f"{parent_alias}e"
+        join = " AND ".join(
+            f"{alias}.{ident(c)} = {parent_alias}.{ident(p)}" for p, c in zip(parent_columns, child_columns)
+        )
+        inner = (
+            f"SELECT {self._select_list(child, alias, columns)} "
+            f"FROM {ident(self._client.schema)}.{ident(child)} {alias} WHERE {join}"
+        )
+        if single:
+            return f"(SELECT row_to_json(r) FROM ({inner} LIMIT 1) r)"
+        return f"(SELECT COALESCE(json_agg(r), '[]') FROM ({inner}) r)"
+
+    def _values(self, rows: List[Dict[str, Any]], columns: List[str]) -> Tuple[str, List[Any]]:
+        types = self._client._column_types(self._table)
+        tuples, params = [], []
+        for row in rows:
+            cells = []
+            for column in columns:
+                if column in row:
+                    cells.append("%s")
+                    params.append(_adapt(row[column], types.get(column)))
+                else:
+                    cells.append("DEFAULT")
+            tuples.append(f"({', '.join(cells)})")
+        return ", ".join(tuples), params
+
+    def _statement(self) -> Tuple[str, List[Any]]:
+        where, where_params = self._where_sql()
+        if self._action == "select":
+            sql = f"SELECT {self._select_list(self._table, 't', self._columns)} FROM {self._target()}{where}"
+            if self._order:
+                sql += " ORDER BY " + ", ".join(self._order)
+            if self._limit is not None:
+                sql += f" LIMIT {self._limit}"
+            if self._offset is not None:
+                sql += f" OFFSET {self._offset}"
+            return f"SELECT COALESCE(json_agg(r), '[]') FROM ({sql}) r", where_params
+
+        if self._action in ("insert", "upsert"):
+            rows = self._payload if isinstance(self._payload, list) else [self._payload]
+            if not rows:
+                return "SELECT '[]'::json", []
+            columns = list(dict.fromkeys(key for row in rows for key in row))
+            values, params = self._values(rows, columns)
+            sql = (
+                f"INSERT INTO {self._target()} ({', '.join(ident(c) for c in columns)}) VALUES {values}"
+            )
+            if self._action == "upsert":
+                updates = [c for c in columns if c not in self._on_conflict]
+                sql += f" ON CONFLICT ({', '.join(ident(c) for c in self._on_conflict)})"
+                if self._ignore_duplicates or not updates:
+                    sql += " DO NOTHING"
+                else:
+                    sql += " DO UPDATE SET " + ", ".join(f"{ident(c)} = EXCLUDED.{ident(c)}" for c in updates)
+        elif self._action == "update":
+            if not where:
+                raise ValueError("update without a filter")
+            types = self._client._column_types(self._table)
+            sets = ", ".join(f"{ident(c)} = %s" for c in self._payload)
+            params = [_adapt(v, types.get(c)) for c, v in self._payload.items()] + where_params
+            sql = f"UPDATE {self._target()} SET {sets}{where}"
+        else:
+            if not where:
+                raise ValueError("delete without a filter")
+            params = where_params
+            sql = f"DELETE FROM {self._target()}{where}"
+        return f"WITH m AS ({sql} RETURNING t.*) SELECT COALESCE(json_agg(m), '[]') FROM m", params
+
+    def execute(self) -> Result:
+        sql, params = self._statement()
+        return Result(self._client._fetch_value(sql, params))
+
+class RpcCall:
+    """rpc(name, params): a function call with named arguments, run by execute()."""
+
+    def __init__(self, client: "PostgresClient", name: str, params: Dict[str, Any]):
+        self._client = client
+        self._name = name
+        self._params = params
+
+    def execute(self) -> Result:
+        function = self._client._function(self._name, tuple(sorted(self._params)))
+        args = ", ".join(f"{ident(k)} => %s::{function['arg_types'][k]}" for k in self._params)
+        params = [_adapt(v, function["arg_types"][k]) for k, v in self._params.items()]
+        call = f"{ident(self._client.schema)}.{ident(self._name)}({args})"
+        if function["returns_set"]:
+            sql = f"SELECT COALESCE(json_agg(r), '[]') FROM {call} r"
+        elif function["returns"] == "void":
+            self._client._fetch_value(f"SELECT {call}", params)
+            return Result(None)
+        else:
+            sql = f"SELECT to_json({call})"
+        return Result(self._client._fetch_value(sql, params))
+
+class PostgresClient:
+    """
+    Drop-in for the supabase Client over a connection pool, plus
+    transaction() and on_commit() for multi-statement flows.
+    """
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 8,
+                 prepare_threshold: Optional[int] = 5, schema: str = "public"):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.prepare_threshold = prepare_threshold
+        self.schema = schema
+        self._pool: Optional[ConnectionPool] = None
+        self._pool_pid: Optional[int] = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._relationships: Dict[Tuple[str, str], Tuple[List[str], List[str], bool]] = {}
+        self._table_types: Dict[str, Dict[str, str]] = {}
+        self._functions: Dict[Tuple[str, Tuple[str, ...]], Dict[str, Any]] = {}
+
+    def table(self, name: str) -> QueryBuilder:
+        return QueryBuilder(self, name)
+
+    def rpc(self, name: str, params: Optional[Dict[str, Any]] = None) -> RpcCall:
+        return RpcCall(self, name, dict(params or {}))
+
+    # ----- connections -----
+
+    def _get_pool(self) -> ConnectionPool:
+        # One pool per process: connections inherited across a gunicorn fork
+        # belong to the parent and are left alone
+        if self._pool_pid != os.getpid():
+            with self._lock:
+                if self._pool_pid != os.getpid():
+                    self._pool = ConnectionPool(
+                        self.dsn,
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                        kwargs={"autocommit": True, "prepare_threshold": self.prepare_threshold},
+                        name="postgres-backend",
+                        open=True,
+                    )
+                    self._pool_pid = os.getpid()
+                    logger.info(f"✅ Postgres pool opened (pid {self._pool_pid}, max {self.max_size})")
+        return self._pool
+
+    @contextmanager
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        with self._get_pool().connection() as conn:
+            yield conn
+
+    def _fetch_value(self, sql: str, params: List[Any]) -> Any:
+        with self._connection() as conn:
+            row = conn.execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    def _fetch_rows(self, sql: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        with self._connection() as conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                return cur.execute(sql, params).fetchall()
+
+    def close(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.close()
+        self._pool = self._pool_pid = None
+
+    # ----- transactions -----
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run every call made by this thread inside the block on one connection,
+        in one transaction (a savepoint when nested). Commits on normal exit.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            with conn.transaction():
+                yield self
+            return
+
+        callbacks: List[Callable[[], None]] = []
+        with self._get_pool().connection() as conn:
+            self._local.conn, self._local.callbacks = conn, callbacks
+            try:
+                with conn.transaction():
+                    yield self
+                    # A failed statement whose exception was caught would otherwise turn COMMIT into a silent ROLLBACK
+                    if conn.info.transaction_status == TransactionStatus.INERROR:
+                        raise TransactionAborted("A statement failed inside the transaction; rolled back")
+            finally:
+                self._local.conn = self._local.callbacks = None
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"on_commit callback failed: {e}")
+
+    def on_commit(self, callback: Callable[[], None]):
+        """Run callback after the current transaction commits (right away outside one)."""
+        callbacks = getattr(self._local, "callbacks", None)
+        if callbacks is None:
+            callback()
+        else:
+            callbacks.append(callback)
+
+    # ----- catalog (cached per client) -----
+
+    def _column_types(self, table: str) -> Dict[str, str]:
+        types = self._table_types.get(table)
+        if types is None:
+            rows = self._fetch_rows(
+                "SELECT attname::text AS name, format_type(atttypid, atttypmod) AS type "
+                "FROM pg_attribute WHERE attrelid = %(table)s::regclass AND attnum > 0 AND NOT attisdropped",
+                {"table": f"{self.schema}.{table}"},
+            )
+            types = self._table_types[table] = {row["name"]: row["type"] for row in rows}
+        return types
+
+    def _relationship(self, parent: str, child: str) -> Tuple[List[str], List[str], bool]:
+        """(parent columns, child columns, to-one) from the foreign key between two tables."""
+        key = (parent, child)
+        if key not in self._relationships:
+            rows = self._fetch_rows(
+                """
+                SELECT c.conrelid = %(child)s::regclass AS on_child,
+                       ARRAY(SELECT a.attname::text FROM unnest(c.conkey) WITH ORDINALITY k(attnum, n)
+                             JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum
+                             ORDER BY k.n) AS fk_columns,
+                       ARRAY(SELECT a.attname::text FROM unnest(c.confkey) WITH ORDINALITY k(attnum, n)
+                             JOIN pg_attribute a ON a.attrelid = c.confrelid AND a.attnum = k.attnum
+                             ORDER BY k.n) AS ref_columns,
+                       EXISTS (SELECT 1 FROM pg_constraint u
+                               WHERE u.conrelid = c.conrelid AND u.contype IN ('p', 'u')
+                                 AND u.conkey @> c.conkey AND u.conkey <@ c.conkey) AS fk_unique
+                FROM pg_constraint c
+                WHERE c.contype = 'f'
+                  AND ((c.conrelid = %(child)s::regclass AND c.confrelid = %(parent)s::regclass)
+                    OR (c.conrelid = %(parent)s::regclass AND c.confrelid = %(child)s::regclass))
+                """,
+                {"parent": f"{self.schema}.{parent}", "child": f"{self.schema}.{child}"},
+            )
+            if len(rows) != 1:
+                raise ValueError(f"Cannot embed {child} in {parent}: expected one foreign key, found {len(rows)}")
+            row = rows[0]
+            if row["on_child"]:
+                self._relationships[key] = (row["ref_columns"], row["fk_columns"], row["fk_unique"])
+            else:
+                self._relationships[key] = (row["fk_columns"], row["ref_columns"], True)
+        return self._relationships[key]
+
+    def _function(self, name: str, arg_names: Tuple[str, ...]) -> Dict[str, Any]:
+        """Return shape and input argument types of the overload that takes these named arguments."""
+        key = (name, arg_names)
+        if key not in self._functions:
+            rows = self._fetch_rows(
+                """
+                SELECT p.proretset AS returns_set,
+                       p.prorettype::regtype::text AS returns,
+                       pronargs_names.names AS names,
+                       ARRAY(SELECT format_type(t, NULL) FROM unnest(p.proargtypes) WITH ORDINALITY a(t, n)
+                             ORDER BY a.n) AS types
+                FROM pg_proc p
+                CROSS JOIN LATERAL (
+                    SELECT ARRAY(
+                        SELECT n.name FROM unnest(COALESCE(p.proargnames, '{}'), COALESCE(p.proargmodes::text[],
+                                   array_fill('i'::text, ARRAY[cardinality(COALESCE(p.proargnames, '{}'))])))
+                                   WITH ORDINALITY n(name, mode, i)
+                        WHERE n.mode IN ('i', 'b', 'v') ORDER BY n.i
+                    ) AS names
+                ) pronargs_names
+                WHERE p.pronamespace = %(schema)s::regnamespace AND p.proname = %(name)s
+                ORDER BY p.pronargs
+                """,
+                {"schema": self.schema, "name": name},
+            )
+            for row in rows:
+                arg_types = dict(zip(row["names"] or [], row["types"]))
+                if set(arg_names) <= set(arg_types):
+                    self._functions[key] = {
+                        "returns_set": row["returns_set"],
+                        "returns": row["returns"],
+                        "arg_types": arg_types,
+                    }
+                    break
+            else:
+                raise ValueError(f"No function {self.schema}.{name} takes arguments {list(arg_names)}")
+        return self._functions[key]
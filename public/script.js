@@ -54,8 +54,9 @@ let timerInterval;
 let totalTalkTime = 0; // Total talk time in seconds
 let talkTimeInterval;
 let heartbeatInterval; // Server sync heartbeat interval
-let talktimeRefreshInterval; // Periodic talktime refresh interval
-let onlinePingInterval; // Periodic online status ping interval
+let heartbeatDelay; // ms until next heartbeat (server can stretch it under lease billing)
+let statePollTimer; // Idle /api/session/state poll (balance, community status, presence)
+let eventSource = null; // Live push from /api/events/stream (SSE)
 let talkTimeStartTime = null; // When the conversation started
 let helloPromptTimeout = null; // Timeout for auto-removing "Say Hello" prompt
 let paymentModalContext = 'start'; // 'start' or 'during'
@@ -258,23 +259,12 @@ document.addEventListener('DOMContentLoaded', () => {
   // Initialize and display talktime
   initializeTalktime();
 
-  // Start periodic talktime refresh (every 30 seconds) to sync with admin updates
-  startTalktimeRefresh();
-
-  // Force immediate refresh on page load to sync with server
-  setTimeout(() => {
-    authenticatedFetch('/api/user/talktime')
-      .then(res => res.json())
-      .then(data => {
-        if (data.ok && data.talktime !== undefined) {
-          const serverTalktime = data.talktime || 0;
-          sessionStorage.setItem('userTalktime', serverTalktime.toString());
-          updateTalktimeDisplay(serverTalktime);
-          console.log(`🔄 Initial talktime sync: ${serverTalktime}s`);
-        }
-      })
-      .catch(err => console.warn('⚠️ Initial sync failed:', err));
-  }, 1000); // Wait 1 second after page load
+  // Poll /api/session/state to sync talktime (admin updates) and keep the user
+  // marked as online; the first poll runs 1 second after page load
+  startStatePolling(1000);
+
+  // Live push: admin talktime/community changes, forced termination, blueprint ready
+  startEventStream();
 
   // Pre-warm config and ElevenLabs token in the background so call starts instantly
   setTimeout(() => prefetchCallAssets(), 2000);
@@ -285,9 +275,6 @@ document.addEventListener('DOMContentLoaded', () => {
   if (redeemBtn) redeemBtn.addEventListener('click', redeemCoupon);
   if (couponInputEl) couponInputEl.addEventListener('keydown', e => { if (e.key === 'Enter') redeemCoupon(); });
 
-  // Start periodic online status ping (every 60 seconds) to keep user marked as online
-  startOnlinePing();
-
   // Initialize side panel talktime display (will be updated by initializeTalktime)
   // Note: sidePanelTalktimeValue is updated in updateTalktimeDisplay function
   const sidePanelTalktimeValueEl = document.getElementById('sidePanelTalktimeValue');
@@ -1305,39 +1292,6 @@ async function startVoiceSession() {
           }
         }, 2000);
 
-        // [FIX] Send an initial heartbeat after a delay to ensure session is fully established
-        setTimeout(async () => {
-          if (sessionActive) {
-            try {
-              const token = sessionStorage.getItem('authToken');
-              const userEmail = sessionStorage.getItem('userEmail');
-              if (token && userEmail) {
-                const response = await fetch('/api/session/heartbeat', {
-                  method: 'POST',
-                  headers: {
-                    'Content-Type': 'application/json',
-                    'Authorization': `Bearer ${token}`
-                  },
-                  body: JSON.stringify({ email: userEmail, timestamp: Date.now() })
-                });
-                
-                if (response.ok) {
-                  const data = await response.json();
-                  if (data.ok) {
-                    console.log('✅ Initial heartbeat sent and session verified');
-                    sessionStorage.setItem('userTalktime', data.remaining_seconds);
-                    updateTalktimeDisplay(data.remaining_seconds);
-                  }
-                } else {
-                  console.warn('⚠️ Initial heartbeat failed:', response.status);
-                }
-              }
-            } catch (e) {
-              console.warn('⚠️ Initial heartbeat error:', e);
-            }
-          }
-        }, 2500); // Send first heartbeat after 2.5 seconds
-
         console.log('✅ Session connected successfully');
         console.log('🎤 Microphone should now be active - try speaking to the bot!');
       },
@@ -1499,7 +1453,7 @@ function formatTime(seconds) {
 // GOD LEVEL FRONTEND LOGIC
 
 function startTalkTimeTracking() {
-  if (heartbeatInterval) clearInterval(heartbeatInterval);
+  if (heartbeatInterval) clearTimeout(heartbeatInterval);
   if (talkTimeInterval) clearInterval(talkTimeInterval);
 
   // 1. VISUAL TIMER (Local) - Runs every 1s
@@ -1527,8 +1481,9 @@ function startTalkTimeTracking() {
     }
   }, 1000);
 
-  // 2. SERVER SYNC (The Authority) - Optimized to 5 seconds
-  heartbeatInterval = setInterval(async () => {
+  // 2. SERVER SYNC (The Authority) - every 2s, or whatever the server asks for
+  heartbeatDelay = HEARTBEAT_RATE;
+  const heartbeatTick = async () => {
     if (!sessionActive) return;
 
     // Secure Heartbeat
@@ -1540,14 +1495,14 @@ function startTalkTimeTracking() {
     }
 
     try {
-      const userEmail = sessionStorage.getItem('userEmail');
-      const response = await fetch('/api/session/heartbeat', {
+      // One state poll bills the session, renews presence and syncs the balance
+      const response = await fetch('/api/session/state', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
           'Authorization': `Bearer ${token}`
         },
-        body: JSON.stringify({ email: userEmail, timestamp: Date.now() })
+        body: JSON.stringify({ in_session: true, timestamp: Date.now() })
       });
 
       if (response.status === 401) {
@@ -1629,6 +1584,14 @@ function startTalkTimeTracking() {
         const serverValue = data.remaining_seconds;
         const previousValue = parseFloat(sessionStorage.getItem('userTalktime') || 0);
 
+        // The server sets the pace (lease billing: sparse keepalives, renew just before expiry)
+        if (data.next_poll_in) {
+          heartbeatDelay = data.next_poll_in * 1000;
+        }
+        if (data.renew_in !== undefined && data.renew_in !== null && data.renew_in * 1000 <= heartbeatDelay) {
+          renewSessionLease();
+        }
+
         // Silently correct sessionStorage — the 1s local timer reads from here
         // and updates the display smoothly. Don't call updateTalktimeDisplay()
         // here or the display will jump every 5 seconds.
@@ -1650,7 +1613,34 @@ function startTalkTimeTracking() {
       // Don't immediately end on network errors - allow retries
       // The server will handle timeout if heartbeats stop completely
     }
-  }, 2000);
+  };
+
+  const scheduleHeartbeat = () => {
+    heartbeatInterval = setTimeout(async () => {
+      await heartbeatTick();
+      if (sessionActive && heartbeatInterval) scheduleHeartbeat();
+    }, heartbeatDelay);
+  };
+  scheduleHeartbeat();
+}
+
+// Extend the prepaid talktime lease (BILLING_MODE=lease)
+async function renewSessionLease() {
+  try {
+    const response = await authenticatedFetch('/api/session/renew', { method: 'POST' });
+    const data = await response.json();
+    if (data.ok) {
+      sessionStorage.setItem('userTalktime', data.remaining_seconds.toString());
+      if (data.next_heartbeat_in) {
+        heartbeatDelay = data.next_heartbeat_in * 1000;
+      }
+    } else {
+      console.warn("Lease renewal failed:", data.reason || response.status);
+    }
+  } catch (e) {
+    // Next keepalive retries (the server extends an expired lease itself)
+    console.error("Lease renewal error:", e);
+  }
 }
 
 // Stop tracking talk time
@@ -1659,9 +1649,9 @@ function stopTalkTimeTracking() {
     clearInterval(talkTimeInterval);
     talkTimeInterval = null;
   }
-  // NEW: Clear the heartbeat interval
+  // NEW: Clear the heartbeat timer
   if (heartbeatInterval) {
-    clearInterval(heartbeatInterval);
+    clearTimeout(heartbeatInterval);
     heartbeatInterval = null;
   }
   talkTimeStartTime = null;
@@ -1846,80 +1836,108 @@ async function prefetchCallAssets() {
   }
 }
 
-// Periodic talktime refresh to sync with admin updates
-function startTalktimeRefresh() {
-  // Clear any existing interval
-  if (talktimeRefreshInterval) clearInterval(talktimeRefreshInterval);
+// Idle state poll: keeps talktime in sync with admin updates and the user marked
+// as online. During a call the heartbeat loop polls the same endpoint instead.
+function startStatePolling(delay) {
+  stopStatePolling();
 
-  // Refresh talktime every 30 seconds
-  talktimeRefreshInterval = setInterval(async () => {
+  statePollTimer = setTimeout(async () => {
+    let nextDelay = 60000;
     try {
-      // Fetch current talktime from server
-      const response = await authenticatedFetch('/api/user/talktime');
-      if (!response.ok) {
-        console.warn('⚠️ Failed to refresh talktime:', response.status);
-        return;
-      }
-
-      const data = await response.json();
-      if (data.ok && data.talktime !== undefined) {
-        const serverTalktime = data.talktime || 0;
-        const currentLocalTalktime = parseInt(sessionStorage.getItem('userTalktime') || '0', 10);
-
-        // Always sync with server value (server is source of truth)
-        // This ensures admin updates are reflected immediately
-        if (serverTalktime !== currentLocalTalktime) {
-          console.log(`🔄 Talktime refreshed: ${currentLocalTalktime}s → ${serverTalktime}s`);
-          sessionStorage.setItem('userTalktime', serverTalktime.toString());
-
-          // Always update display to match server value
-          // During session: heartbeat handles deductions, but admin changes override
-          updateTalktimeDisplay(serverTalktime);
-
-          // If server says 0 and we're in a session, pause it
-          if (sessionActive && serverTalktime <= 0) {
-            console.log('⛔ Server reports 0 talktime. Pausing session.');
-            pauseSessionForPayment();
+      if (!sessionActive) {
+        const response = await authenticatedFetch('/api/session/state', {
+          method: 'POST',
+          body: JSON.stringify({ in_session: false })
+        });
+        if (!response.ok) {
+          console.warn('⚠️ Failed to refresh state:', response.status);
+        } else {
+          const data = await response.json();
+          if (data.next_poll_in) nextDelay = data.next_poll_in * 1000;
+
+          if (data.ok && data.talktime !== undefined) {
+            const serverTalktime = data.talktime || 0;
+            const currentLocalTalktime = parseInt(sessionStorage.getItem('userTalktime') || '0', 10);
+
+            // Always sync with server value (server is source of truth)
+            // This ensures admin updates are reflected immediately
+            if (serverTalktime !== currentLocalTalktime) {
+              console.log(`🔄 Talktime refreshed: ${currentLocalTalktime}s → ${serverTalktime}s`);
+              sessionStorage.setItem('userTalktime', serverTalktime.toString());
+              updateTalktimeDisplay(serverTalktime);
+            }
           }
         }
       }
     } catch (error) {
-      console.warn('⚠️ Error refreshing talktime:', error);
+      console.warn('⚠️ Error refreshing state:', error);
     }
-  }, 30000); // Refresh every 30 seconds
+    startStatePolling(nextDelay);
+  }, delay);
 }
 
-function stopTalktimeRefresh() {
-  if (talktimeRefreshInterval) {
-    clearInterval(talktimeRefreshInterval);
-    talktimeRefreshInterval = null;
-  }
-}
+// Server-Sent Events: the server pushes changes instead of waiting for the next poll.
+// EventSource can't send an Authorization header, so we trade the JWT for a short-lived ticket.
+async function startEventStream() {
+  if (!window.EventSource || eventSource) return;
+  try {
+    const res = await authenticatedFetch('/api/events/ticket', { method: 'POST' });
+    if (!res.ok) throw new Error(`ticket ${res.status}`);
+    const { ticket } = await res.json();
+
+    eventSource = new EventSource(`/api/events/stream?ticket=${encodeURIComponent(ticket)}`);
+
+    const syncTalktime = (e) => {
+      const data = JSON.parse(e.data);
+      if (data.talktime === undefined) return;
+      const serverTalktime = Math.max(0, data.talktime || 0);
+      sessionStorage.setItem('userTalktime', serverTalktime.toString());
+      // During a call the 1s local timer reads sessionStorage; update the display directly otherwise
+      if (!sessionActive) updateTalktimeDisplay(serverTalktime);
+    };
+    eventSource.addEventListener('hello', syncTalktime);
+    eventSource.addEventListener('talktime', syncTalktime);
 
-// Periodic online status ping to keep user marked as online
-function startOnlinePing() {
-  // Clear any existing interval
-  if (onlinePingInterval) clearInterval(onlinePingInterval);
+    eventSource.addEventListener('terminate', (e) => {
+      const data = JSON.parse(e.data);
+      console.warn('⛔ Server ended the session:', data.reason);
+      if (data.reason === 'community_removed') {
+        showVIPRestriction();
+      } else if (sessionActive) {
+        endSession();
+      }
+    });
 
-  // Ping server every 60 seconds to update last_login
-  onlinePingInterval = setInterval(async () => {
-    try {
-      // Ping server to update last_login (keeps user marked as online)
-      const response = await authenticatedFetch('/api/user/ping', {
-        method: 'POST'
-      });
+    eventSource.addEventListener('community', (e) => {
+      const data = JSON.parse(e.data);
+      console.log(`🔄 Community status changed: ${data.is_community_member}`);
+    });
 
-      if (!response.ok) {
-        console.warn('⚠️ Failed to ping server:', response.status);
-        return;
+    eventSource.addEventListener('blueprint', (e) => {
+      const data = JSON.parse(e.data);
+      console.log('📘 Blueprint ready:', data.link);
+    });
+
+    eventSource.onerror = () => {
+      // Tickets are single use, so the browser's own retry is refused and the stream
+      // closes; fetch a new ticket and reconnect
+      if (eventSource && eventSource.readyState === EventSource.CLOSED) {
+        eventSource = null;
+        setTimeout(startEventStream, 10000);
       }
+    };
+  } catch (e) {
+    console.warn('⚠️ Live updates unavailable, relying on polling:', e);
+    eventSource = null;
+    setTimeout(startEventStream, 60000);
+  }
+}
 
-      // Ping successful - user is now marked as online
-      console.log('💚 Online status ping sent');
-    } catch (error) {
-      console.warn('⚠️ Error pinging server:', error);
-    }
-  }, 60000); // Ping every 60 seconds (within 15 minute window)
+function stopStatePolling() {
+  if (statePollTimer) {
+    clearTimeout(statePollTimer);
+    statePollTimer = null;
+  }
 }
 
 async function redeemCoupon() {
@@ -1968,13 +1986,6 @@ function showCouponMsg(text, success) {
   msg.style.color = success ? '#059669' : '#ef4444';
 }
 
-function stopOnlinePing() {
-  if (onlinePingInterval) {
-    clearInterval(onlinePingInterval);
-    onlinePingInterval = null;
-  }
-}
-
 // Update talktime display across all screens
 function updateTalktimeDisplay(talktime) {
   const formatted = formatTime(talktime);
@@ -0,0 +1,81 @@
+import time
+import logging
+from app import (
+    app, Config, logger, redis_client, reap_sessions, deferred_user_writes,
+    SESSION_DEADLINE_PREFIX, LIVE_SESSIONS_KEY,
+)
+
+# Session Reaper
+# Settles abandoned talk sessions as soon as their heartbeat deadline key
+# (deadline:{email}) expires, instead of waiting for the 1-hour SESSION_TTL.
+# Run one alongside the web workers and set SESSION_REAPER=true for them:
+#     python reaper.py
+
+logger.setLevel(logging.INFO)
+
+def enable_expiry_events():
+    """Keyspace notifications are off by default; managed Redis may need this set in its console."""
+    try:
+        flags = redis_client.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+        if "E" not in flags or ("x" not in flags and "A" not in flags):
+            redis_client.config_set("notify-keyspace-events", "".join(sorted(set(flags + "Ex"))))
+    except Exception as e:
+        logger.warning(f"Could not enable keyspace notifications ({e}); set notify-keyspace-events=Ex on the server")
+
+def reconcile():
+    """Reap live sessions whose deadline is already gone (events missed while the reaper was down)."""
+    members = [m.decode() if isinstance(m, bytes) else m for m in redis_client.smembers(LIVE_SESSIONS_KEY)]
+    if not members:
+        return 0
+    pipe = redis_client.pipeline(transaction=False)
+    for email in members:
+        pipe.exists(f"{SESSION_DEADLINE_PREFIX}{email}")
+    expired = [email for email, alive in zip(members, pipe.execute()) if not alive]
+    reaped = 0
+    for i in range(0, len(expired), Config.REAPER_BATCH):
+        reaped += reap_sessions(expired[i:i + Config.REAPER_BATCH])
+    return reaped
+
+def flush_batch(batch):
+    if batch:
+        reap_sessions(batch)
+        deferred_user_writes.flush()
+
+def reaper_loop():
+    enable_expiry_events()
+    db = redis_client.connection_pool.connection_kwargs.get("db", 0)
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(f"__keyevent@{db}__:expired")
+    logger.info("🧹 Session reaper listening for expired deadlines...")
+
+    reconcile()
+    deferred_user_writes.flush()
+    last_reconcile = time.monotonic()
+    batch, batch_started = [], None
+
+    while True:
+        try:
+            message = pubsub.get_message(timeout=1.0)
+            if message:
+                key = message["data"]
+                key = key.decode() if isinstance(key, bytes) else key
+                if key.startswith(SESSION_DEADLINE_PREFIX):
+                    batch.append(key[len(SESSION_DEADLINE_PREFIX):])
+                    batch_started = batch_started or time.monotonic()
+
+            # Batch events that land close together, but never hold one for more than a second
+            if batch and (len(batch) >= Config.REAPER_BATCH or time.monotonic() - batch_started >= 1.0):
+                flush_batch(batch)
+                batch, batch_started = [], None
+
+            if time.monotonic() - last_reconcile >= Config.REAPER_RECONCILE_INTERVAL:
+                reconcile()
+                deferred_user_writes.flush()
+                last_reconcile = time.monotonic()
+        except Exception as e:
+            logger.error(f"Reaper loop error: {e}")
+            time.sleep(5)
+
+if __name__ == "__main__":
+    with app.app_context():
+        reaper_loop()
@@ -0,0 +1,776 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Tuple, Callable
+
+from db_query import TransactionAborted, ident, is_literal, parse_logic, parse_select
+
+# Embedded SQLite backend (DB_BACKEND=sqlite)
+# Same table()/rpc() surface as the supabase client and PostgresClient, on a
+# local SQLite file in WAL mode: readers never block the writer, and a
+# single-node deployment or a test run needs no database server. The schema
+# is db_scripts/sqlite_schema.sql; the Postgres functions the app calls
+# (talktime, sessions, risk flags, admin pages, claim_next_task) are ported
+# below as _rpc_<name> methods with the same arguments and result shape.
+
+logger = logging.getLogger("app")
+
+SCHEMA_PATH = Path(__file__).parent / "db_scripts" / "sqlite_schema.sql"
+
+_NOW = "strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')"
+
+_OPERATORS = {"eq": "=", "neq": "<>", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+
+_schema_lock = threading.Lock()
+
+def _risk_rank(level: Optional[str]) -> int:
+    """Same as public.risk_rank(): high 3, medium 2, anything else 1."""
+    return {"high": 3, "medium": 2}.get(level, 1)
+
+def _like_prefix(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _condition(alias: str, column: str, op: str, value: Any) -> Tuple[str, List[Any]]:
+    """One PostgREST filter as SQLite SQL. LIKE is case-sensitive here, as in Postgres."""
+    col = f"{alias}.{ident(column)}"
+    if op == "is":
+        literal = is_literal(value)
+        return f"{col} IS {'NULL' if literal == 'UNKNOWN' else literal}", []
+    if op == "in":
+        values = [_adapt(v) for v in value]
+        if not values:
+            return "0", []
+        return f"{col} IN ({', '.join(['?'] * len(values))})", values
+    if op == "like":
+        return f"{col} LIKE ? ESCAPE '\\'", [value.replace("*", "%")]
+    if op == "ilike":
+        return f"lower({col}) LIKE lower(?) ESCAPE '\\'", [value.replace("*", "%")]
+    if op not in _OPERATORS:
+        raise ValueError(f"Unsupported filter operator: {op}")
+    return f"{col} {_OPERATORS[op]} ?", [_adapt(value)]
+
+def _adapt(value: Any, column_type: Optional[str] = None) -> Any:
+    if column_type == "JSON" or isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+class Result:
+    """The fields of supabase-py's APIResponse the app reads."""
+    __slots__ = ("data", "count")
+
+    def __init__(self, data: Any, count: Optional[int] = None):
+        self.data = data
+        self.count = count
+
+class QueryBuilder:
+    """table(name) builder: one statement (plus one per embed), run by execute()."""
+
+    def __init__(self, client: "SQLiteClient", table: str):
+        self._client = client
+        self._table = table
+        self._action = "select"
+        self._columns = "*"
+        self._payload: Any = None
+        self._on_conflict: List[str] = []
+        self._ignore_duplicates = False
+        self._where: List[Tuple[str, List[Any]]] = []
+        self._order: List[str] = []
+        self._limit: Optional[int] = None
+        self._offset: Optional[int] = None
+
+    # ----- actions -----
+
+    def select(self, columns: str = "*", count: Optional[str] = None) -> "QueryBuilder":
+        if count is not None:
+            raise ValueError("count is not supported by the sqlite backend")
+        self._columns = columns or "*"
+        return self
+
+    def insert(self, rows: Any) -> "QueryBuilder":
+        self._action, self._payload = "insert", rows
+        return self
+
+    def upsert(self, rows: Any, on_conflict: str = "", ignore_duplicates: bool = False) -> "QueryBuilder":
+        if not on_conflict:
+            raise ValueError("upsert needs on_conflict with the sqlite backend")
+        self._action, self._payload = "upsert", rows
+        self._on_conflict = [c.strip() for c in on_conflict.split(",") if c.strip()]
+        self._ignore_duplicates = ignore_duplicates
+        return self
+
+    def update(self, values: Dict[str, Any]) -> "QueryBuilder":
+        self._action, self._payload = "update", values
+        return self
+
+    def delete(self) -> "QueryBuilder":
+        self._action = "delete"
+        return self
+
+    # ----- filters and modifiers -----
+
+    def _filter(self, column: str, op: str, value: Any) -> "QueryBuilder":
+        self._where.append(_condition("t", column, op, value))
+        return self
+
+    def eq(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "eq", value)
+
+    def neq(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "neq", value)
+
+    def gt(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "gt", value)
+
+    def gte(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "gte", value)
+
+    def lt(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "lt", value)
+
+    def lte(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "lte", value)
+
+    def like(self, column: str, pattern: str) -> "QueryBuilder":
+        return self._filter(column, "like", pattern)
+
+    def ilike(self, column: str, pattern: str) -> "QueryBuilder":
+        return self._filter(column, "ilike", pattern)
+
+    def in_(self, column: str, values) -> "QueryBuilder":
+        return self._filter(column, "in", values)
+
+    def is_(self, column: str, value: Any) -> "QueryBuilder":
+        return self._filter(column, "is", value)
+
+    def or_(self, filters: str) -> "QueryBuilder":
+        self._where.append(parse_logic(filters, lambda c, o, v: _condition("t", c, o, v)))
+        return self
+
+    def order(self, column: str, desc: bool = False, nullsfirst: Optional[bool] = None) -> "QueryBuilder":
+        # Postgres defaults: NULLs sort as the largest value
+        if nullsfirst is None:
+            nullsfirst = desc
+        self._order.append(
+            f"t.{ident(column)} {'DESC' if desc else 'ASC'} NULLS {'FIRST' if nullsfirst else 'LAST'}"
+        )
+        return self
+
+    def limit(self, size: int) -> "QueryBuilder":
+        self._limit = int(size)
+        return self
+
+    def range(self, start: int, end: int) -> "QueryBuilder":
+        self._offset, self._limit = int(start), int(end) - int(start) + 1
+        return self
+
+    # ----- SQL -----
+
+    def _where_sql(self) -> Tuple[str, List[Any]]:
+        if not self._where:
+            return "", []
+        params: List[Any] = []
+        for _, values in self._where:
+            params.extend(values)
+        return " WHERE " + " AND ".join(clause for clause, _ in self._where), params
+
+    def _select(self) -> List[Dict[str, Any]]:
+        items = parse_select(self._columns)
+        embeds = [item for item in items if isinstance(item, tuple)]
+        columns = [item for item in items if not isinstance(item, tuple)]
+        relationships = {child: self._client._relationship(self._table, child) for child, _ in embeds}
+
+        # Join columns the caller did not ask for are fetched and dropped again
+        hidden = [
+            parent_column for parent_column, _, _ in relationships.values()
+            if "*" not in columns and parent_column not in columns
+        ]
+        hidden = list(dict.fromkeys(hidden))
+        select = ", ".join(
+            "t.*" if column == "*" else f"t.{ident(column)}" for column in columns + hidden
+        ) or "t.rowid"
+
+        where, params = self._where_sql()
+        sql = f"SELECT {select} FROM {ident(self._table)} AS t{where}"
+        if self._order:
+            sql += " ORDER BY " + ", ".join(self._order)
+        if self._limit is not None or self._offset is not None:
+            sql += f" LIMIT {self._limit if self._limit is not None else -1}"
+        if self._offset is not None:
+            sql += f" OFFSET {self._offset}"
+        rows = [self._client._decode(self._table, row) for row in self._client._execute(sql, params)]
+
+        for child, child_columns in embeds:
+            parent_column, child_column, single = relationships[child]
+            keys = list(dict.fromkeys(row[parent_column] for row in rows if row.get(parent_column) is not None))
+            child_items = parse_select(child_columns)
+            extra = "*" not in child_items and child_column not in child_items
+            groups: Dict[Any, List[Dict[str, Any]]] = {}
+            if keys:
+                query = QueryBuilder(self._client, child).select(
+                    f"{child_columns},{child_column}" if extra else child_columns
+                ).in_(child_column, keys)
+                for match in query.execute().data:
+                    key = match.pop(child_column) if extra else match[child_column]
+                    groups.setdefault(key, []).append(match)
+            for row in rows:
+                matches = groups.get(row.get(parent_column), [])
+                row[child] = (matches[0] if matches else None) if single else matches
+
+        for row in rows:
+            for column in hidden:
+                row.pop(column, None)
+            row.pop("rowid", None)
+        return rows
+
+    def _write(self) -> List[Dict[str, Any]]:
+        types = self._client._column_types(self._table)
+        target = ident(self._table)
+
+        if self._action in ("insert", "upsert"):
+            rows = self._payload if isinstance(self._payload, list) else [self._payload]
+            # SQLite has no DEFAULT in VALUES: one statement per set of columns
+            groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+            for row in rows:
+                groups.setdefault(tuple(row), []).append(row)
+            returned: List[Dict[str, Any]] = []
+            with self._client._atomic():
+                for columns, group in groups.items():
+                    placeholders = "(" + ", ".join(["?"] * len(columns)) + ")"
+                    sql = (
+                        f"INSERT INTO {target} ({', '.join(ident(c) for c in columns)}) "
+                        f"VALUES {', '.join([placeholders] * len(group))}"
+                    )
+                    params = [_adapt(row[c], types.get(c)) for row in group for c in columns]
+                    if self._action == "upsert":
+                        updates = [c for c in columns if c not in self._on_conflict]
+                        sql += f" ON CONFLICT ({', '.join(ident(c) for c in self._on_conflict)})"
+                        if self._ignore_duplicates or not updates:
+                            sql += " DO NOTHING"
+                        else:
+                            sql += " DO UPDATE SET " + ", ".join(f"{ident(c)} = excluded.{ident(c)}" for c in updates)
+                    returned.extend(self._client._execute(sql + " RETURNING *", params))
+            return [self._client._decode(self._table, row) for row in returned]
+
+        where, where_params = self._where_sql()
+        if not where:
+            raise ValueError(f"{self._action} without a filter")
+        if self._action == "update":
+            sets = ", ".join(f"{ident(c)} = ?" for c in self._payload)
+            params = [_adapt(v, types.get(c)) for c, v in self._payload.items()] + where_params
+            sql = f"UPDATE {target} AS t SET {sets}{where} RETURNING *"
+        else:
+            params = where_params
+            sql = f"DELETE FROM {target} AS t{where} RETURNING *"
+        return [self._client._decode(self._table, row) for row in self._client._execute(sql, params)]
+
+    def execute(self) -> Result:
+        if self._action == "select":
+            return Result(self._select())
+        return Result(self._write())
+
+class RpcCall:
+    """rpc(name, params): one of the ported SQL functions, run by execute()."""
+
+    def __init__(self, client: "SQLiteClient", name: str, params: Dict[str, Any]):
+        self._client = client
+        self._name = name
+        self._params = params
+
+    def execute(self) -> Result:
+        handler = getattr(self._client, f"_rpc_{self._name}", None)
+        if handler is None:
+            raise ValueError(f"Function {self._name} is not available on the sqlite backend")
+        return Result(handler(**self._params))
+
+class SQLiteClient:
+    """
+    Drop-in for the supabase Client on a local SQLite file, plus
+    transaction() and on_commit() like PostgresClient.
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 30.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._table_types: Dict[str, Dict[str, str]] = {}
+        self._relationships: Dict[Tuple[str, str], Tuple[str, str, bool]] = {}
+        with _schema_lock:
+            self._conn().executescript(SCHEMA_PATH.read_text())
+        logger.info(f"✅ SQLite database ready at {path}")
+
+    def table(self, name: str) -> QueryBuilder:
+        return QueryBuilder(self, name)
+
+    def rpc(self, name: str, params: Optional[Dict[str, Any]] = None) -> RpcCall:
+        return RpcCall(self, name, dict(params or {}))
+
+    # ----- connections -----
+
+    def _conn(self) -> sqlite3.Connection:
+        """This thread's connection (a new one after fork)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA foreign_keys = ON")
+            conn.execute("PRAGMA case_sensitive_like = ON")
+            conn.create_function("risk_rank", 1, _risk_rank, deterministic=True)
+            self._local.conn, self._local.pid = conn, os.getpid()
+            self._local.depth, self._local.failed, self._local.callbacks = 0, False, None
+        return conn
+
+    def _execute(self, sql: str, params: Any = ()) -> List[sqlite3.Row]:
+        conn = self._conn()
+        try:
+            return conn.execute(sql, params).fetchall()
+        except sqlite3.Error:
+            # SQLite only undoes the failed statement; like Postgres, the transaction must not commit
+            if self._local.depth:
+                self._local.failed = True
+            raise
+
+    def _decode(self, table: str, row: sqlite3.Row) -> Dict[str, Any]:
+        types = self._column_types(table)
+        out = {}
+        for key in row.keys():
+            value = row[key]
+            if value is not None:
+                if types.get(key) == "BOOLEAN":
+                    value = bool(value)
+                elif types.get(key) == "JSON":
+                    value = json.loads(value)
+            out[key] = value
+        return out
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # ----- transactions -----
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run every call made by this thread inside the block in one transaction
+        (a savepoint when nested). BEGIN IMMEDIATE takes the write lock up
+        front, so concurrent flows queue instead of failing to upgrade.
+        """
+        conn = self._conn()
+        depth = self._local.depth
+        if depth:
+            savepoint, failed = f"sp{depth}", self._local.failed
+            conn.execute(f"SAVEPOINT {savepoint}")
+            self._local.depth = depth + 1
+            try:
+                yield self
+            except BaseException:
+                conn.execute(f"ROLLBACK TO {savepoint}")
+                conn.execute(f"RELEASE {savepoint}")
+                self._local.failed = failed
+                raise
+            else:
+                conn.execute(f"RELEASE {savepoint}")
+            finally:
+                self._local.depth = depth
+            return
+
+        callbacks: List[Callable[[], None]] = []
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth, self._local.failed, self._local.callbacks = 1, False, callbacks
+        try:
+            yield self
+            if self._local.failed:
+                raise TransactionAborted("A statement failed inside the transaction; rolled back")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth, self._local.failed, self._local.callbacks = 0, False, None
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"on_commit callback failed: {e}")
+
+    def _atomic(self):
+        """
+        Group statements of one call (a multi-row insert, a ported function).
+        Inside a transaction they simply join it, so a failure aborts it as
+        the single statement would in Postgres.
+        """
+        self._conn()
+        return nullcontext() if self._local.depth else self.transaction()
+
+    def on_commit(self, callback: Callable[[], None]):
+        """Run callback after the current transaction commits (right away outside one)."""
+        self._conn()
+        if self._local.callbacks is None:
+            callback()
+        else:
+            self._local.callbacks.append(callback)
+
+    # ----- catalog (cached per client) -----
+
+    def _column_types(self, table: str) -> Dict[str, str]:
+        types = self._table_types.get(table)
+        if types is None:
+            rows = self._execute(f"PRAGMA table_info({ident(table)})")
+            if not rows:
+                raise ValueError(f"Unknown table: {table}")
+            types = self._table_types[table] = {row["name"]: (row["type"] or "").upper() for row in rows}
+        return types
+
+    def _relationship(self, parent: str, child: str) -> Tuple[str, str, bool]:
+        """(parent column, child column, to-one) from the foreign key between two tables."""
+        key = (parent, child)
+        if key not in self._relationships:
+            # Foreign key on the embedded table: to-one only if it is also that table's primary key
+            on_child = [fk for fk in self._execute(f"PRAGMA foreign_key_list({ident(child)})") if fk["table"] == parent]
+            on_parent = [fk for fk in self._execute(f"PRAGMA foreign_key_list({ident(parent)})") if fk["table"] == child]
+            if len(on_child) + len(on_parent) != 1:
+                raise ValueError(f"Cannot embed {child} in {parent}: expected one single-column foreign key")
+            if on_child:
+                fk = on_child[0]
+                primary_key = [row["name"] for row in self._execute(f"PRAGMA table_info({ident(child)})") if row["pk"]]
+                self._relationships[key] = (fk["to"], fk["from"], primary_key == [fk["from"]])
+            else:
+                fk = on_parent[0]
+                self._relationships[key] = (fk["from"], fk["to"], True)
+        return self._relationships[key]
+
+    # ----- ported functions (db_scripts/*.sql) -----
+
+    def _balance_update(self, expression: str, p_email: str, p_seconds: float) -> Optional[float]:
+        rows = self._execute(
+            f"UPDATE user_balances SET talktime = {expression}, updated_at = {_NOW} "
+            "WHERE email = lower(?) RETURNING talktime",
+            (p_seconds, p_email),
+        )
+        return rows[0]["talktime"] if rows else None
+
+    def _rpc_deduct_talktime(self, p_email: str, p_seconds: float) -> Optional[float]:
+        return self._balance_update("MAX(0, talktime - MAX(0, ?))", p_email, p_seconds)
+
+    def _rpc_credit_talktime(self, p_email: str, p_seconds: float) -> Optional[float]:
+        return self._balance_update("MAX(0, talktime + ?)", p_email, p_seconds)
+
+    def _rpc_debit_talktime(self, p_email: str, p_seconds: float) -> List[Dict[str, Any]]:
+        with self._atomic():
+            rows = self._execute("SELECT talktime FROM user_balances WHERE email = lower(?)", (p_email,))
+            if not rows:
+                return []
+            balance = max(0, rows[0]["talktime"] or 0)
+            debit = min(balance, max(0, p_seconds or 0))
+            self._execute(
+                f"UPDATE user_balances SET talktime = ?, updated_at = {_NOW} WHERE email = lower(?)",
+                (balance - debit, p_email),
+            )
+        return [{"debited": debit, "talktime": balance - debit}]
+
+    def _set_balance(self, email: str, seconds: float, version: Optional[int]) -> Optional[float]:
+        # A ledger write-back older than the stored one is skipped
+        rows = self._execute(
+            f"UPDATE user_balances SET talktime = MAX(0, ?), "
+            f"ledger_version = COALESCE(?, ledger_version), updated_at = {_NOW} "
+            "WHERE email = lower(?) AND (? IS NULL OR ledger_version IS NULL OR ledger_version < ?) "
+            "RETURNING talktime",
+            (seconds, version, email, version, version),
+        )
+        return rows[0]["talktime"] if rows else None
+
+    def _rpc_set_talktime(self, p_email: str, p_seconds: float, p_version: Optional[int] = None) -> Optional[float]:
+        return self._set_balance(p_email, p_seconds, p_version)
+
+    def _rpc_set_talktime_batch(self, p_balances: List[Dict[str, Any]]) -> int:
+        updated = 0
+        with self._atomic():
+            for balance in p_balances or []:
+                if self._set_balance(balance.get("email"), balance.get("talktime"), balance.get("version")) is not None:
+                    updated += 1
+        return updated
+
+    def _rpc_apply_deferred_user_writes(self, p_rows: List[Dict[str, Any]]) -> int:
+        written = set()
+        with self._atomic():
+            for row in p_rows or []:
+                email = (row.get("email") or "").lower()
+                if "last_login" in row:
+                    if self._execute("UPDATE users SET last_login = ? WHERE email = ? RETURNING 1",
+                                     (row["last_login"], email)):
+                        written.add(email)
+                balance = {k: row[k] for k in ("session_status", "last_active_heartbeat") if k in row}
+                if balance:
+                    sets = ", ".join(f"{ident(k)} = ?" for k in balance)
+                    if self._execute(f"UPDATE user_balances SET {sets} WHERE email = ? RETURNING 1",
+                                     (*balance.values(), email)):
+                        written.add(email)
+        return len(written)
+
+    def _rpc_deduct_talktime_batch(self, p_charges: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        results = []
+        with self._atomic():
+            for charge in p_charges or []:
+                rows = self._execute(
+                    f"UPDATE user_balances SET talktime = MAX(0, talktime - MAX(0, ?)), updated_at = {_NOW} "
+                    "WHERE email = lower(?) RETURNING email, talktime",
+                    (charge.get("seconds"), charge.get("email")),
+                )
+                results.extend(dict(row) for row in rows)
+        return results
+
+    def _rpc_record_user_session(self, p_email: str, p_session_id: Optional[str],
+                                 p_duration: Optional[int] = 0, p_transcript_length: Optional[int] = 0) -> Optional[int]:
+        with self._atomic():
+            rows = self._execute(
+                f"UPDATE users SET total_sessions = total_sessions + 1, last_login = {_NOW} "
+                "WHERE email = lower(?) RETURNING total_sessions",
+                (p_email,),
+            )
+            if not rows:
+                return None
+            self._execute(
+                "INSERT INTO user_sessions (email, session_id, duration, transcript_length) VALUES (lower(?), ?, ?, ?)",
+                (p_email, p_session_id, p_duration or 0, p_transcript_length or 0),
+            )
+        return rows[0]["total_sessions"]
+
+    def _rpc_user_session_totals(self, p_email: str) -> List[Dict[str, Any]]:
+        rows = self._execute(
+            "SELECT COUNT(*) AS sessions, COALESCE(SUM(duration), 0) AS total_duration "
+            "FROM user_sessions WHERE email = lower(?)",
+            (p_email,),
+        )
+        return [dict(row) for row in rows]
+
+    def _rpc_record_risk_flag(self, p_email: str, p_risk_level: str, p_urgency: Optional[str] = None,
+                              p_details: Optional[str] = None,
+                              p_transcript_snippet: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._atomic():
+            rows = self._execute(
+                f"""
+                UPDATE users
+                SET is_flagged = 1,
+                    last_risk_flag = {_NOW},
+                    highest_risk_level = CASE
+                        WHEN risk_rank(?) > risk_rank(highest_risk_level) THEN ?
+                        ELSE COALESCE(highest_risk_level, ?)
+                    END,
+                    risk_flag_count = COALESCE(risk_flag_count, 0) + 1
+                WHERE email = lower(?)
+                RETURNING highest_risk_level AS highest_level, risk_flag_count AS flag_count
+                """,
+                (p_risk_level, p_risk_level, p_risk_level, p_email),
+            )
+            if not rows:
+                return []
+            self._execute(
+                "INSERT INTO risk_flags (email, risk_level, urgency, details, transcript_snippet) "
+                "VALUES (lower(?), ?, ?, ?, ?)",
+                (p_email, p_risk_level, p_urgency, p_details, p_transcript_snippet),
+            )
+        return [dict(row) for row in rows]
+
+    # Admin listing columns shared by admin_list_users and admin_search_users
+    _ADMIN_COLUMNS = """
+        u.email,
+        COALESCE(b.talktime, 0) AS talktime,
+        COALESCE(u.is_community_member, 0) AS is_community_member,
+        u.created_at,
+        u.last_login,
+        COALESCE(u.total_sessions, 0) AS total_sessions,
+        COALESCE(u.is_flagged, 0) AS is_flagged,
+        u.highest_risk_level,
+        u.last_risk_flag,
+        COALESCE(u.risk_flag_count, 0) AS risk_flag_count,
+        u.last_community_refill,
+        COALESCE(u.welcome_bonus_given, 0) AS welcome_bonus_given,
+        u.updated_at
+    """
+    _ADMIN_BOOLEANS = ("is_community_member", "is_flagged", "welcome_bonus_given", "prefix_match")
+
+    def _admin_rows(self, rows: List[sqlite3.Row]) -> List[Dict[str, Any]]:
+        out = []
+        for row in rows:
+            row = dict(row)
+            for key in self._ADMIN_BOOLEANS:
+                if key in row:
+                    row[key] = bool(row[key])
+            out.append(row)
+        return out
+
+    def _rpc_admin_list_users(self, p_sort: str = "recent", p_limit: int = 50, p_after_key: Optional[str] = None,
+                              p_after_email: Optional[str] = None, p_community: Optional[bool] = None,
+                              p_flagged: Optional[bool] = None, p_emails: Optional[List[str]] = None,
+                              p_exclude_emails: Optional[List[str]] = None,
+                              p_email_prefix: Optional[str] = None) -> List[Dict[str, Any]]:
+        sorts = {
+            "recent": ("COALESCE(u.last_login, '-infinity')", "?", "DESC", "<"),
+            "talktime": ("COALESCE(b.talktime, 0)", "CAST(? AS REAL)", "DESC", "<"),
+            "created": ("u.created_at", "?", "DESC", "<"),
+            "email": ("u.email", "?", "ASC", ">"),
+        }
+        if p_sort not in sorts:
+            raise ValueError(f"Unknown sort: {p_sort}")
+        key, placeholder, direction, comparison = sorts[p_sort]
+
+        where, params = [], []
+        if p_after_key is not None:
+            where.append(f"({key}, u.email) {comparison} ({placeholder}, ?)")
+            params += [p_after_key, p_after_email]
+        if p_community is not None:
+            where.append("COALESCE(u.is_community_member, 0) = ?")
+            params.append(bool(p_community))
+        if p_flagged is not None:
+            where.append("COALESCE(u.is_flagged, 0) = ?")
+            params.append(bool(p_flagged))
+        if p_emails is not None:
+            where.append(f"u.email IN ({', '.join(['?'] * len(p_emails))})" if p_emails else "0")
+            params += list(p_emails)
+        if p_exclude_emails:
+            where.append(f"u.email NOT IN ({', '.join(['?'] * len(p_exclude_emails))})")
+            params += list(p_exclude_emails)
+        if p_email_prefix:
+            where.append("u.email LIKE ? ESCAPE '\\'")
+            params.append(_like_prefix(p_email_prefix.lower()) + "%")
+
+        sql = (
+            f"SELECT {self._ADMIN_COLUMNS}, CAST({key} AS TEXT) AS sort_key "
+            "FROM users u LEFT JOIN user_balances b ON b.email = u.email"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + f" ORDER BY {key} {direction}, u.email {direction} LIMIT ?"
+        )
+        params.append(min(max(int(p_limit), 1), 500))
+        return self._admin_rows(self._execute(sql, params))
+
+    def _rpc_admin_search_users(self, p_query: str, p_limit: int = 20, p_offset: int = 0) -> List[Dict[str, Any]]:
+        term = _like_prefix((p_query or "").strip().lower())
+        if not term:
+            return []
+        prefix = term + "%"
+        pattern = f"%{term}%" if len(p_query.strip()) >= 3 else prefix
+        limit, offset = min(max(int(p_limit), 1), 101), min(max(int(p_offset), 0), 1000)
+        # Each kind of match is cut to offset + limit before the final sort
+        rows = self._execute(
+            f"""
+            WITH prefix AS (
+                SELECT email, 1 AS prefix_match FROM users
+                WHERE email LIKE ? ESCAPE '\\' OR lower(name) LIKE ? ESCAPE '\\'
+                ORDER BY email LIMIT ?
+            ), substring AS (
+                SELECT email, 0 AS prefix_match FROM users
+                WHERE ? <> ?
+                  AND (email LIKE ? ESCAPE '\\' OR lower(name) LIKE ? ESCAPE '\\')
+                  AND NOT COALESCE(email LIKE ? ESCAPE '\\' OR lower(name) LIKE ? ESCAPE '\\', 0)
+                ORDER BY email LIMIT ?
+            ), candidates AS (
+                SELECT * FROM prefix UNION ALL SELECT * FROM substring
+            )
+            SELECT {self._ADMIN_COLUMNS}, u.name, c.prefix_match
+            FROM candidates c
+            JOIN users u ON u.email = c.email
+            LEFT JOIN user_balances b ON b.email = u.email
+            ORDER BY c.prefix_match DESC, u.email
+            LIMIT ? OFFSET ?
+            """,
+            (prefix, prefix, offset + limit,
+             pattern, prefix, pattern, pattern, prefix, prefix, offset + limit,
+             limit, offset),
+        )
+        return self._admin_rows(rows)
+
+    def _rpc_admin_user_stats(self) -> List[Dict[str, Any]]:
+        rows = self._execute(
+            """
+            SELECT COUNT(*) AS total_users,
+                   (SELECT COALESCE(SUM(b.talktime), 0) FROM user_balances b) AS total_talktime,
+                   COALESCE(SUM(total_sessions), 0) AS total_sessions,
+                   COUNT(*) FILTER (WHERE is_community_member) AS community_members,
+                   COUNT(*) FILTER (WHERE is_flagged) AS flagged_users
+            FROM users
+            """
+        )
+        return [dict(row) for row in rows]
+
+    def _rpc_admin_flagged_counts(self) -> List[Dict[str, Any]]:
+        rows = self._execute(
+            "SELECT risk_rank(highest_risk_level) AS risk_rank, COUNT(*) AS total "
+            "FROM users WHERE is_flagged GROUP BY 1"
+        )
+        return [dict(row) for row in rows]
+
+    def _rpc_admin_flagged_users(self, p_limit: int = 50, p_after_rank: Optional[int] = None,
+                                 p_after_flag: Optional[str] = None,
+                                 p_after_email: Optional[str] = None) -> List[Dict[str, Any]]:
+        where, params = "u.is_flagged", []
+        if p_after_email is not None:
+            where += (
+                " AND (risk_rank(u.highest_risk_level), COALESCE(u.last_risk_flag, '-infinity'), u.email) < (?, ?, ?)"
+            )
+            params += [p_after_rank, p_after_flag, p_after_email]
+        params.append(min(max(int(p_limit), 1), 500))
+        rows = self._execute(
+            f"""
+            SELECT u.email,
+                   COALESCE(b.talktime, 0) AS talktime,
+                   COALESCE(u.is_community_member, 0) AS is_community_member,
+                   u.created_at,
+                   u.last_login,
+                   COALESCE(u.total_sessions, 0) AS total_sessions,
+                   COALESCE(u.highest_risk_level, 'low') AS highest_risk_level,
+                   u.last_risk_flag,
+                   COALESCE(u.risk_flag_count, 0) AS risk_flag_count,
+                   (SELECT json_object('timestamp', f.created_at, 'risk_level', f.risk_level, 'urgency', f.urgency,
+                                       'details', f.details, 'transcript_snippet', f.transcript_snippet)
+                    FROM risk_flags f WHERE f.email = u.email
+                    ORDER BY f.created_at DESC, f.id DESC LIMIT 1) AS latest_risk_flag,
+                   risk_rank(u.highest_risk_level) AS risk_rank,
+                   COALESCE(u.last_risk_flag, '-infinity') AS flagged_at
+            FROM users u LEFT JOIN user_balances b ON b.email = u.email
+            WHERE {where}
+            ORDER BY risk_rank(u.highest_risk_level) DESC, COALESCE(u.last_risk_flag, '-infinity') DESC, u.email DESC
+            LIMIT ?
+            """,
+            params,
+        )
+        out = self._admin_rows(rows)
+        for row in out:
+            if row["latest_risk_flag"] is not None:
+                row["latest_risk_flag"] = json.loads(row["latest_risk_flag"])
+        return out
+
+    def _rpc_upsert_metric_rollups(self, p_rows: List[Dict[str, Any]]) -> int:
+        upserted = 0
+        with self._atomic():
+            for row in p_rows or []:
+                upserted += len(self._execute(
+                    f"""
+                    INSERT INTO metric_rollups (granularity, metric, bucket, value) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (granularity, metric, bucket)
+                    DO UPDATE SET value = MAX(value, excluded.value), updated_at = {_NOW}
+                    RETURNING 1
+                    """,
+                    (row.get("granularity"), row.get("metric"), row.get("bucket"), row.get("value")),
+                ))
+        return upserted
+
+    def _rpc_claim_next_task(self) -> List[Dict[str, Any]]:
+        # One statement under SQLite's single writer lock: no two workers get the same task
+        rows = self._execute(
+            f"""
+            UPDATE tasks SET status = 'processing', started_at = {_NOW}
+            WHERE id = (SELECT id FROM tasks WHERE status = 'pending' ORDER BY created_at LIMIT 1)
+            RETURNING *
+            """
+        )
+        return [self._decode("tasks", row) for row in rows]
@@ -0,0 +1,114 @@
+"""
+Offline smoke test: boots the app on DB_BACKEND=sqlite with REDIS_URL=memory://
+and drives the main user and admin flows through the Flask test client.
+
+    pip install pytest
+    python -m pytest tests
+"""
+import hashlib
+import hmac
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+EMAIL = "smoke@example.com"
+PASSWORD = "Passw0rd!smoke"
+RAZORPAY_SECRET = "smoke-secret"
+
+
+@pytest.fixture(scope="module")
+def app_module(tmp_path_factory):
+    env = {
+        "ENVIRONMENT": "development",
+        "DB_BACKEND": "sqlite",
+        "SQLITE_PATH": str(tmp_path_factory.mktemp("db") / "app.db"),
+        "REDIS_URL": "memory://",
+        "RAZORPAY_KEY_SECRET": RAZORPAY_SECRET,
+        "BILLING_MODE": "direct",
+        "READ_REPLICA_URL": "",
+    }
+    with pytest.MonkeyPatch.context() as mp:
+        for key, value in env.items():
+            mp.setenv(key, value)
+        yield importlib.import_module("app")
+
+
+@pytest.fixture(scope="module")
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture(scope="module")
+def user_headers(app_module, client):
+    r = client.post("/api/auth/signup", json={"email": EMAIL, "password": PASSWORD, "name": "Smoke"})
+    assert r.status_code == 200, r.json
+    r = client.post("/api/auth/login", json={"email": EMAIL, "password": PASSWORD})
+    assert r.status_code == 200, r.json
+    app_module.supabase.table("users").update({"is_community_member": True}).eq("email", EMAIL).execute()
+    app_module.user_cache.invalidate(EMAIL)
+    return {"Authorization": f"Bearer {r.json['token']}"}
+
+
+@pytest.fixture(scope="module")
+def admin_headers(app_module, client):
+    r = client.post("/api/admin/login", json={
+        "username": app_module.Config.ADMIN_USERNAME,
+        "password": app_module.Config.ADMIN_PASSWORD,
+    })
+    assert r.status_code == 200, r.json
+    return {"Authorization": f"Bearer {r.json['token']}"}
+
+
+def _balance(app_module) -> float:
+    rows = app_module.supabase.table("user_balances").select("talktime").eq("email", EMAIL).execute().data
+    return float(rows[0]["talktime"])
+
+
+def test_boots_offline(app_module, client):
+    assert type(app_module.supabase).__name__ == "SQLiteClient"
+    assert client.get("/healthz").status_code == 200
+
+
+def test_talktime_and_session(app_module, client, user_headers):
+    r = client.get("/api/user/talktime", headers=user_headers)
+    assert r.status_code == 200 and r.json["ok"]
+
+    assert client.post("/api/session/start", headers=user_headers).status_code == 200
+    r = client.post("/api/session/heartbeat", headers=user_headers, json={})
+    assert r.status_code == 200 and r.json["ok"]
+    assert client.post("/api/session/end", headers=user_headers, json={}).status_code == 200
+
+
+def test_payment_is_credited_once(app_module, client, user_headers):
+    before = _balance(app_module)
+    order = "order_smoke_1"
+    signature = hmac.new(RAZORPAY_SECRET.encode(), f"{order}|pay_1".encode(), hashlib.sha256).hexdigest()
+    payload = {"razorpay_order_id": order, "razorpay_payment_id": "pay_1", "razorpay_signature": signature}
+
+    r = client.post("/api/payments/razorpay/verify", headers=user_headers, json=payload)
+    assert r.status_code == 200, r.json
+    assert _balance(app_module) == before + 100
+
+    r = client.post("/api/payments/razorpay/verify", headers=user_headers, json=payload)
+    assert r.status_code != 200
+    assert _balance(app_module) == before + 100
+
+
+def test_admin_views(client, user_headers, admin_headers):
+    r = client.get("/api/admin/users?limit=5", headers=admin_headers)
+    assert r.status_code == 200 and EMAIL in [u["email"] for u in r.json["users"]]
+    r = client.get("/api/admin/search?q=smoke", headers=admin_headers)
+    assert r.status_code == 200 and [u["email"] for u in r.json["users"]] == [EMAIL]
+    assert client.get("/api/admin/stats", headers=admin_headers).status_code == 200
+
+
+def test_admin_reset(app_module, client, user_headers, admin_headers):
+    r = client.post(f"/api/admin/users/{EMAIL}/reset", headers=admin_headers, json={"type": "all"})
+    assert r.status_code == 200, r.json
+    row = app_module.supabase.table("users").select("total_sessions").eq("email", EMAIL).execute().data[0]
+    assert row["total_sessions"] == 0
+    assert _balance(app_module) == 0
@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import Optional, Dict, Any, List
+
+import numpy as np
+
+# Columnar users snapshot
+# A local copy of the analytics columns of `users`, one memory-mapped .npy
+# file per column under DATA_DIR/users_snapshot/v{version}/. Syncs pull only
+# rows whose updated_at is past the watermark, so admin analytics never read
+# the whole table or parse timestamps per request. talktime lives in
+# user_balances, which is synced the same way on its own watermark.
+
+logger = logging.getLogger("app")
+
+SNAPSHOT_SOURCE_COLUMNS = (
+    "email,total_sessions,created_at,last_login,updated_at,"
+    "is_community_member,is_flagged,highest_risk_level,user_balances(talktime)"
+)
+BALANCE_SOURCE_COLUMNS = "email,talktime,updated_at"
+
+# name -> dtype. Timestamps are epoch seconds (NaN = never), key is a 64-bit email hash.
+SNAPSHOT_COLUMNS = {
+    "key": np.uint64,
+    "talktime": np.float64,
+    "total_sessions": np.int64,
+    "created_at": np.float64,
+    "last_login": np.float64,
+    "updated_at": np.float64,
+    "is_community_member": np.bool_,
+    "is_flagged": np.bool_,
+    "risk_rank": np.int8,
+}
+
+RISK_RANKS = {"high": 3, "medium": 2}
+
+def email_key(email: str) -> int:
+    return int.from_bytes(hashlib.blake2b(email.lower().encode(), digest_size=8).digest(), "little")
+
+def _epoch(value) -> float:
+    if not value:
+        return np.nan
+    try:
+        dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return np.nan
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+def _flatten(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Merge the embedded user_balances row into the user row."""
+    balance = row.pop("user_balances", None)
+    if isinstance(balance, list):
+        balance = balance[0] if balance else None
+    return {**row, **(balance or {})}
+
+def _to_columns(rows: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    """Parse PostgREST rows into column arrays (the only place timestamps are parsed)."""
+    rows = [_flatten(r) for r in rows]
+    return {
+        "key": np.fromiter((email_key(r["email"]) for r in rows), np.uint64, len(rows)),
+        "talktime": np.fromiter((float(r.get("talktime") or 0) for r in rows), np.float64, len(rows)),
+        "total_sessions": np.fromiter((int(r.get("total_sessions") or 0) for r in rows), np.int64, len(rows)),
+        "created_at": np.fromiter((_epoch(r.get("created_at")) for r in rows), np.float64, len(rows)),
+        "last_login": np.fromiter((_epoch(r.get("last_login")) for r in rows), np.float64, len(rows)),
+        "updated_at": np.fromiter((_epoch(r.get("updated_at")) for r in rows), np.float64, len(rows)),
+        "is_community_member": np.fromiter((bool(r.get("is_community_member")) for r in rows), np.bool_, len(rows)),
+        "is_flagged": np.fromiter((bool(r.get("is_flagged")) for r in rows), np.bool_, len(rows)),
+        "risk_rank": np.fromiter((RISK_RANKS.get(r.get("highest_risk_level"), 1) for r in rows), np.int8, len(rows)),
+    }
+
+def _empty_columns() -> Dict[str, np.ndarray]:
+    return {name: np.empty(0, dtype) for name, dtype in SNAPSHOT_COLUMNS.items()}
+
+def _merge(base: Dict[str, np.ndarray], changes: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Upsert `changes` into `base` by key; the result stays sorted by key."""
+    if len(changes["key"]) == 0:
+        return base
+    # Last occurrence of a key within the changes wins
+    _, last = np.unique(changes["key"][::-1], return_index=True)
+    changes = {name: col[::-1][last] for name, col in changes.items()}
+
+    keep = ~np.isin(base["key"], changes["key"])
+    merged = {name: np.concatenate([base[name][keep], changes[name]]) for name in SNAPSHOT_COLUMNS}
+    order = np.argsort(merged["key"], kind="stable")
+    return {name: col[order] for name, col in merged.items()}
+
+def _apply_talktime(base: Dict[str, np.ndarray], keys: np.ndarray, talktime: np.ndarray) -> Dict[str, np.ndarray]:
+    """Overwrite talktime for keys already in `base` (sorted by key); unknown keys are skipped."""
+    if len(keys) == 0 or len(base["key"]) == 0:
+        return base
+    idx = np.searchsorted(base["key"], keys)
+    idx[idx >= len(base["key"])] = 0
+    found = base["key"][idx] == keys
+    column = np.array(base["talktime"])
+    column[idx[found]] = talktime[found]
+    return dict(base, talktime=column)
+
+
+class UsersSnapshot:
+    """Memory-mapped users columns plus the watermark they were synced to."""
+
+    def __init__(self, directory: Path, supabase, redis_client, batch: int = 5000,
+                 overlap: float = 5.0, rebuild_interval: float = 86400):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.supabase = supabase
+        self.redis = redis_client
+        self.batch = batch
+        self.overlap = overlap
+        self.rebuild_interval = rebuild_interval
+        self._version = None
+        self._columns: Dict[str, np.ndarray] = _empty_columns()
+        self.meta: Dict[str, Any] = {}
+
+    # ----- storage -----
+
+    @property
+    def _meta_path(self) -> Path:
+        return self.directory / "meta.json"
+
+    def _read_meta(self) -> Dict[str, Any]:
+        try:
+            return json.loads(self._meta_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """Current columns, re-mapped if another process published a newer version."""
+        meta = self._read_meta()
+        version = meta.get("version")
+        if version is not None and version != self._version:
+            path = self.directory / f"v{version}"
+            try:
+                self._columns = {
+                    name: np.load(path / f"{name}.npy", mmap_mode="r") for name in SNAPSHOT_COLUMNS
+                }
+                self._version, self.meta = version, meta
+            except FileNotFoundError:
+                pass  # Superseded while we were reading; the next call picks up the newer one
+        return self._columns
+
+    def _publish(self, columns: Dict[str, np.ndarray], meta: Dict[str, Any]):
+        version = max(int(time.time() * 1000), (self._version or 0) + 1)
+        path = self.directory / f"v{version}"
+        path.mkdir()
+        for name, col in columns.items():
+            np.save(path / f"{name}.npy", np.ascontiguousarray(col, dtype=SNAPSHOT_COLUMNS[name]))
+        meta = dict(meta, version=version, rows=int(len(columns["key"])))
+        tmp = self._meta_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(meta))
+        os.replace(tmp, self._meta_path)
+
+        # Keep the previous version for readers that still have it mapped
+        versions = sorted(int(p.name[1:]) for p in self.directory.glob("v*") if p.name[1:].isdigit())
+        for old in versions[:-2]:
+            shutil.rmtree(self.directory / f"v{old}", ignore_errors=True)
+
+    # ----- sync -----
+
+    def _fetch_since(self, db, since_iso: Optional[str], table: str = "users", columns: str = SNAPSHOT_SOURCE_COLUMNS):
+        """Yield row batches with updated_at >= since (everything if None), keyset on (updated_at, email)."""
+        after = None
+        while True:
+            query = db.table(table).select(columns)
+            if after is not None:
+                ts, email = after
+                query = query.or_(f'updated_at.gt."{ts}",and(updated_at.eq."{ts}",email.gt."{email}")')
+            elif since_iso is not None:
+                query = query.gte("updated_at", since_iso)
+            rows = query.order("updated_at").order("email").limit(self.batch).execute().data or []
+            if rows:
+                yield rows
+            if len(rows) < self.batch:
+                return
+            after = (rows[-1]["updated_at"], rows[-1]["email"])
+
+    def _since(self, watermark: float) -> str:
+        return (datetime.fromtimestamp(watermark, timezone.utc) - timedelta(seconds=self.overlap)).isoformat()
+
+    def sync(self, expected_rows: Optional[int] = None, force_rebuild: bool = False, source=None) -> Dict[str, Any]:
+        """
+        Pull changed rows and publish a new version. Only one process syncs at
+        a time. source is the client to read from (default: the primary); a
+        replica needs overlap to cover its maximum lag.
+        """
+        db = source or self.supabase
+        lock = self.redis.lock("lock:users_snapshot", timeout=600, blocking_timeout=0)
+        if not lock.acquire(blocking=False):
+            self.columns()
+            return {"synced": False, "reason": "locked"}
+        try:
+            base = self.columns()
+            meta = self._read_meta()
+            rebuild = (
+                force_rebuild
+                or not meta
+                or "balance_watermark" not in meta  # built before talktime moved to user_balances
+                or time.time() - meta.get("built_at", 0) > self.rebuild_interval
+                # Incremental sync never sees deletes; a shrinking table means a rebuild
+                or (expected_rows is not None and expected_rows < meta.get("rows", 0))
+            )
+            started = time.time()
+            since = None
+            if not rebuild and meta.get("watermark"):
+                since = self._since(meta["watermark"])
+
+            batches = [_to_columns(rows) for rows in self._fetch_since(db, since)]
+            fetched = sum(len(b["key"]) for b in batches)
+
+            # Balance changes (talktime) since the balance watermark; a rebuild
+            # already read current balances through the embed
+            balance_keys, balance_talktime, balance_watermark = [], [], meta.get("balance_watermark")
+            if not rebuild and balance_watermark:
+                for rows in self._fetch_since(db, self._since(balance_watermark), "user_balances", BALANCE_SOURCE_COLUMNS):
+                    balance_keys.extend(email_key(r["email"]) for r in rows)
+                    balance_talktime.extend(float(r.get("talktime") or 0) for r in rows)
+                    balance_watermark = max(balance_watermark, np.nanmax([_epoch(r.get("updated_at")) for r in rows] + [0]))
+            else:
+                balance_watermark = started
+
+            if not rebuild and fetched == 0 and not balance_keys:
+                return {"synced": True, "fetched": 0, "balances": 0, "rows": meta.get("rows", 0)}
+
+            changes = {name: np.concatenate([b[name] for b in batches]) if batches else col
+                       for name, col in _empty_columns().items()}
+            merged = _merge(_empty_columns() if rebuild else base, changes)
+            merged = _apply_talktime(merged, np.array(balance_keys, dtype=np.uint64),
+                                     np.array(balance_talktime, dtype=np.float64))
+
+            now = time.time()
+            updated = merged["updated_at"][~np.isnan(merged["updated_at"])]
+            watermark = float(updated.max()) if len(updated) else meta.get("watermark")
+            self._publish(merged, {
+                "watermark": watermark,
+                "balance_watermark": float(balance_watermark),
+                "built_at": now if rebuild else meta.get("built_at", now),
+                "synced_at": now,
+            })
+            self.columns()
+            logger.info(f"📊 Users snapshot {'rebuilt' if rebuild else 'synced'}: {fetched} rows fetched, "
+                        f"{len(balance_keys)} balances, {len(merged['key'])} total")
+            return {"synced": True, "fetched": fetched, "balances": len(balance_keys),
+                    "rows": int(len(merged["key"])), "rebuilt": rebuild}
+        finally:
+            try:
+                lock.release()
+            except Exception:
+                pass
+
+    # ----- analytics -----
+
+    def analytics(self, now: Optional[float] = None, cohort_weeks: int = 12) -> Dict[str, Any]:
+        """Vectorized admin aggregates over the current snapshot."""
+        cols = self.columns()
+        now = now or time.time()
+        talktime = cols["talktime"]
+        last_login = cols["last_login"]
+        created = cols["created_at"]
+        community = cols["is_community_member"]
+        total = int(len(talktime))
+
+        # Talktime distribution (seconds)
+        edges = np.array([0, 1, 60, 300, 900, 3600, np.inf])
+        labels = ["0", "<1m", "1-5m", "5-15m", "15-60m", "60m+"]
+        counts = np.histogram(talktime, bins=edges)[0].tolist() if total else [0] * len(labels)
+        percentiles = np.percentile(talktime, [50, 90, 99]).round(1).tolist() if total else [0, 0, 0]
+
+        # Login recency
+        with np.errstate(invalid="ignore"):
+            age = now - last_login
+            recency = {
+                "1d": int(np.count_nonzero(age <= 86400)),
+                "7d": int(np.count_nonzero(age <= 7 * 86400)),
+                "30d": int(np.count_nonzero(age <= 30 * 86400)),
+                "never": int(np.count_nonzero(np.isnan(last_login))),
+            }
+
+        # Weekly signup cohorts (UTC weeks starting Monday)
+        today = datetime.fromtimestamp(now, timezone.utc).date()
+        week0 = today - timedelta(days=today.weekday())
+        starts = [datetime(w.year, w.month, w.day, tzinfo=timezone.utc).timestamp()
+                  for w in (week0 - timedelta(weeks=i) for i in range(cohort_weeks - 1, -1, -1))]
+        bounds = np.array(starts + [np.inf])
+        idx = np.searchsorted(bounds, created, side="right") - 1
+        in_range = (idx >= 0) & (idx < cohort_weeks) & ~np.isnan(created)
+        idx = idx[in_range]
+        with np.errstate(invalid="ignore"):
+            active = (now - last_login[in_range]) <= 7 * 86400
+        signups = np.bincount(idx, minlength=cohort_weeks)
+        converted = np.bincount(idx, weights=community[in_range], minlength=cohort_weeks)
+        retained = np.bincount(idx, weights=active, minlength=cohort_weeks)
+        cohorts = [{
+            "week": datetime.fromtimestamp(start, timezone.utc).date().isoformat(),
+            "signups": int(signups[i]),
+            "community": int(converted[i]),
+            "active_7d": int(retained[i]),
+        } for i, start in enumerate(starts)]
+
+        return {
+            "users": total,
+            "community_members": int(np.count_nonzero(community)),
+            "flagged": {level: int(np.count_nonzero(cols["is_flagged"] & (cols["risk_rank"] == rank)))
+                        for level, rank in (("high", 3), ("medium", 2), ("low", 1))},
+            "talktime": {
+                "total": float(talktime.sum()),
+                "p50": percentiles[0], "p90": percentiles[1], "p99": percentiles[2],
+                "histogram": dict(zip(labels, counts)),
+            },
+            "sessions_total": int(cols["total_sessions"].sum()),
+            "logins": recency,
+            "signup_cohorts": cohorts,
+            "snapshot": {
+                "rows": total,
+                "synced_at": self.meta.get("synced_at"),
+                "watermark": self.meta.get("watermark"),
+            },
+        }
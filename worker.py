@@ -6,13 +6,17 @@ import threading
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 from supabase import create_client
-from app import app, _call_gemini_mindmap_blueprint, save_blueprint_to_disk, record_user_session, _delayed_email_with_link, Config, logger
+from app import app, _call_gemini_mindmap_blueprint, save_blueprint_to_disk, record_user_session, _delayed_email_with_link, publish_user_event, record_metric, Config, logger
 
 # Initialize Supabase independently to avoid circular issues or context confusion
 load_dotenv()
-supabase_url = os.getenv("SUPABASE_URL")
-supabase_key = os.getenv("SUPABASE_KEY")
-supabase = create_client(supabase_url, supabase_key)
+if Config.DB_BACKEND in ("postgres", "sqlite"):
+    # Direct connection: share the app's client (one pool per process)
+    from app import supabase
+else:
+    supabase_url = os.getenv("SUPABASE_URL")
+    supabase_key = os.getenv("SUPABASE_KEY")
+    supabase = create_client(supabase_url, supabase_key)
 
 logger.setLevel(logging.INFO)
 logger.info("👷 Background Worker Started")
@@ -47,6 +51,7 @@ def process_task(task):
                 "transcript": transcript
             }
             save_blueprint_to_disk(blueprint_id, blueprint_data)
+            record_metric("care_plans")
             
             # 3. Record Session
             try:
@@ -58,8 +63,15 @@ def process_task(task):
             except Exception as e:
                 logger.warning(f"Failed to record session stats: {e}")
                 
-            # 4. Email
+            # 4. Tell any open browser tab (SSE) that the blueprint is ready
             care_plan_link = f"{host_url.rstrip('/')}/blueprint/{blueprint_id}"
+            publish_user_event(email, "blueprint", {
+                "blueprint_id": blueprint_id,
+                "session_id": session_id,
+                "link": care_plan_link
+            })
+
+            # 5. Email
             # Send immediately (0 delay) with care plan content included
             _delayed_email_with_link(email, care_plan_link, care_plan, 0)
             